@@ -0,0 +1,166 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import argparse
+import time
+import pdb
+import logging
+
+import torch
+
+from model import DSA, compute_bert_hidden_states, compute_bert_token_states, enable_checkpointing, SavedTensorsCounter
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------- #
+# Micro benchmarks of model components on random inputs
+#   usage)
+#     python benchmark.py --target=dsa --device=cuda --batch_size=5760
+#     python benchmark.py --target=bert_pooling --device=cuda --bert_model_name_or_path=./embeddings/bert-large-cased
+#     python benchmark.py --target=checkpointing --device=cuda --bert_model_name_or_path=./embeddings/bert-base-cased
+# ---------------------------------------------------------------------------- #
+
+def time_fn(opt, fn):
+    """Average latency(ms) and peak allocated memory(MB) of fn().
+    """
+    use_cuda = opt.device.startswith('cuda')
+    for _ in range(opt.warmup):
+        fn()
+    if use_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(opt.device)
+    st_time = time.perf_counter()
+    for _ in range(opt.iterations):
+        fn()
+    if use_cuda: torch.cuda.synchronize()
+    duration_time = (time.perf_counter() - st_time) * 1000 / opt.iterations
+    peak_mb = torch.cuda.max_memory_allocated(opt.device) / 2**20 if use_cuda else 0
+    return duration_time, peak_mb
+
+def benchmark_dsa(opt):
+    # DSA pooling over the layers of feature-based bert, batch_size == number of tokens(batch x n_ctx)
+    config = {'opt': opt}
+    dsa = DSA(config, opt.dsa_num_attentions, opt.dsa_input_dim, opt.dsa_dim, dsa_r=opt.dsa_r).to(opt.device)
+    x = torch.randn(opt.batch_size, opt.seq_size, opt.dsa_input_dim, device=opt.device)
+    mask = torch.ones(opt.batch_size, opt.seq_size, device=opt.device)
+
+    # outputs and gradients
+    x.requires_grad_(True)
+    ref = dsa.forward_reference(x, mask)
+    ref_grad, = torch.autograd.grad(ref.sum(), x)
+    out = dsa(x)
+    out_grad, = torch.autograd.grad(out.sum(), x)
+    logger.info("[dsa] max abs diff, output {:.3e}, grad {:.3e}".\
+        format((out - ref).abs().max().item(), (out_grad - ref_grad).abs().max().item()))
+    x.requires_grad_(False)
+
+    results = []
+    with torch.no_grad():
+        results.append(('reference, inference',) + time_fn(opt, lambda: dsa.forward_reference(x, mask)))
+        results.append(('fused, inference',) + time_fn(opt, lambda: dsa(x)))
+    x.requires_grad_(True)
+    results.append(('reference, forward+backward',) + time_fn(opt, lambda: dsa.forward_reference(x, mask).sum().backward()))
+    results.append(('fused, forward+backward',) + time_fn(opt, lambda: dsa(x).sum().backward()))
+    for name, duration_time, peak_mb in results:
+        logger.info("[dsa] {:<28} {:10.3f}ms, peak memory {:.1f}MB".format(name, duration_time, peak_mb))
+
+def benchmark_bert_pooling(opt):
+    # feature-based bert + DSA pooling, all positions vs non-pad tokens only
+    from transformers import AutoConfig, AutoModel
+    config = {'opt': opt, 'emb_class': opt.emb_class}
+    bert_config = AutoConfig.from_pretrained(opt.bert_model_name_or_path)
+    bert_model = AutoModel.from_pretrained(opt.bert_model_name_or_path, config=bert_config).to(opt.device)
+    bert_model.eval()
+    dsa = DSA(config, opt.dsa_num_attentions, bert_config.hidden_size, opt.dsa_dim, dsa_r=opt.dsa_r).to(opt.device)
+    dsa.eval()
+    batch_size, seq_size = opt.bert_batch_size, opt.n_ctx
+    lengths = torch.randint(opt.min_length, seq_size + 1, (batch_size,))
+    input_mask = (torch.arange(seq_size).unsqueeze(0) < lengths.unsqueeze(1)).to(torch.long)
+    input_ids = torch.randint(1000, bert_config.vocab_size, (batch_size, seq_size)) * input_mask
+    x = [input_ids.to(opt.device), input_mask.to(opt.device), torch.zeros_like(input_ids).to(opt.device)]
+    token_mask = x[1] != 0
+    logger.info("[bert pooling] {} x {}, non-pad tokens {:.1f}%".format(batch_size, seq_size, token_mask.float().mean().item() * 100))
+
+    def full():
+        stack = compute_bert_hidden_states(config, bert_model, x)
+        return dsa(stack.view(-1, stack.shape[2], stack.shape[3])).view(batch_size, seq_size, -1)
+    def lean():
+        return dsa(compute_bert_token_states(config, bert_model, x, token_mask))
+
+    with torch.no_grad():
+        logger.info("[bert pooling] max abs diff on non-pad tokens {:.3e}".format((full()[token_mask] - lean()).abs().max().item()))
+        full_ms, full_mb = time_fn(opt, full)
+        lean_ms, lean_mb = time_fn(opt, lean)
+    logger.info("[bert pooling] all positions   {:10.3f}ms, peak memory {:.1f}MB".format(full_ms, full_mb))
+    logger.info("[bert pooling] non-pad tokens  {:10.3f}ms, peak memory {:.1f}MB".format(lean_ms, lean_mb))
+    logger.info("[bert pooling] latency {:+.1f}%, peak memory {:+.1f}%".\
+        format((lean_ms / max(1e-6, full_ms) - 1) * 100, (lean_mb / max(1e-6, full_mb) - 1) * 100))
+
+def benchmark_checkpointing(opt):
+    # forward+backward of the bert encoder with and without recomputing the layers(train.py --activation_checkpointing=bert)
+    from transformers import AutoConfig, AutoModel
+    bert_config = AutoConfig.from_pretrained(opt.bert_model_name_or_path)
+    # random weights, memory and compute do not depend on them
+    bert_model = AutoModel.from_config(bert_config).to(opt.device)
+    bert_model.train()
+    batch_size, seq_size = opt.bert_batch_size, opt.n_ctx
+    input_ids = torch.randint(1000, bert_config.vocab_size, (batch_size, seq_size), device=opt.device)
+    input_mask = torch.ones_like(input_ids)
+    layer_list = bert_model.encoder.layer if hasattr(bert_model, 'encoder') else bert_model.transformer.layer
+
+    results = []
+    for enabled in [False, True]:
+        for layer in layer_list:
+            if enabled and not hasattr(layer, 'use_checkpointing'): enable_checkpointing(layer)
+            if hasattr(layer, 'use_checkpointing'): layer.use_checkpointing = enabled
+        with SavedTensorsCounter() as counter:
+            loss = bert_model(input_ids=input_ids, attention_mask=input_mask)[0].sum()
+        # the recomputation in backward is not counted
+        loss.backward()
+        bert_model.zero_grad()
+        def step():
+            bert_model(input_ids=input_ids, attention_mask=input_mask)[0].sum().backward()
+            bert_model.zero_grad()
+        results.append((enabled, counter.bytes / 2**20) + time_fn(opt, step))
+    for enabled, saved_mb, duration_time, peak_mb in results:
+        logger.info("[checkpointing] {:<5} {:10.3f}ms, activations {:.1f}MB, peak memory {:.1f}MB".format(str(enabled), duration_time, saved_mb, peak_mb))
+    (_, off_mb, off_ms, off_peak), (_, on_mb, on_ms, on_peak) = results
+    # peak memory is measured on cuda only
+    logger.info("[checkpointing] compute {:+.1f}%, activations {:+.1f}%, peak memory {}".\
+        format((on_ms / max(1e-6, off_ms) - 1) * 100, (on_mb / max(1e-6, off_mb) - 1) * 100,
+               '{:+.1f}%'.format((on_peak / off_peak - 1) * 100) if off_peak > 0 else 'n/a'))
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--target', type=str, default='dsa', choices=['dsa', 'bert_pooling', 'checkpointing'])
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--num_threads', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', default=42, type=int)
+    # for dsa
+    parser.add_argument('--batch_size', type=int, default=32*180, help="Number of tokens, ex) batch size x n_ctx.")
+    parser.add_argument('--seq_size', type=int, default=25, help="Number of bert layers + 1.")
+    parser.add_argument('--dsa_input_dim', type=int, default=1024)
+    parser.add_argument('--dsa_num_attentions', type=int, default=4)
+    parser.add_argument('--dsa_dim', type=int, default=300)
+    parser.add_argument('--dsa_r', type=int, default=3)
+    # for bert_pooling, checkpointing
+    parser.add_argument('--bert_model_name_or_path', type=str, default='embeddings/bert-base-cased')
+    parser.add_argument('--emb_class', type=str, default='bert')
+    parser.add_argument('--bert_batch_size', type=int, default=32)
+    parser.add_argument('--n_ctx', type=int, default=180)
+    parser.add_argument('--min_length', type=int, default=10, help="Sentence lengths are sampled from [min_length, n_ctx].")
+    opt = parser.parse_args()
+
+    if opt.num_threads > 0: torch.set_num_threads(opt.num_threads)
+    torch.manual_seed(opt.seed)
+    if opt.target == 'dsa': benchmark_dsa(opt)
+    if opt.target == 'bert_pooling': benchmark_bert_pooling(opt)
+    if opt.target == 'checkpointing': benchmark_checkpointing(opt)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import argparse
+import time
+import inspect
+import pdb
+import logging
+
+import torch
+import numpy as np
+
+from checkpoint import restore_frozen, FROZEN_REFS_KEY
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------- #
+# Single-file model bundle(config, dicts, vocab, bert config/tokenizer, weights)
+#   usage)
+#     python bundle.py --config=configs/config-glove.json --data_dir=data/conll2003 --model_path=pytorch-model-glove.pt --use_crf --bundle_path=pytorch-model-glove.bundle
+#     python inference.py --bundle_path=pytorch-model-glove.bundle --input_path=... --output_path=...
+# ---------------------------------------------------------------------------- #
+
+BERT_CLASSES = ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']
+
+# flags which decide the model structure, restored from the bundle.
+MODEL_OPTS = ['use_crf', 'use_char_cnn', 'bert_use_pos', 'bert_disable_lstm', 'bert_use_feature_based', 'bert_exit_layers',
+              'elmo_options_file', 'elmo_weights_file']
+
+def load_dict(input_path):
+    # id -> key, same as BaseModel.load_dict()
+    dic = {}
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            toks = line.strip().split()
+            dic[int(toks[1])] = toks[0]
+    return dic
+
+def read_files(input_dir, exclude=['pytorch_model.bin']):
+    files = {}
+    for name in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, name)
+        if name in exclude or not os.path.isfile(path): continue
+        with open(path, 'rb') as f:
+            files[name] = f.read()
+    return files
+
+def extract_files(files, output_dir):
+    for name, data in files.items():
+        with open(os.path.join(output_dir, name), 'wb') as f:
+            f.write(data)
+
+def save_bundle(config, checkpoint, bundle_path):
+    """Save everything load_model() needs into one file, weights are stored as a zip archive torch.load() can memory-map.
+
+    the bert weights are included in checkpoint(bert_model.*), only config and tokenizer files are taken from bert_output_dir.
+    """
+    opt = config['opt']
+    bundle = {
+        'config': {key: value for key, value in config.items() if key != 'opt'},
+        'opt': {key: getattr(opt, key) for key in MODEL_OPTS if hasattr(opt, key)},
+        'labels': load_dict(opt.label_path),
+        'poss': load_dict(opt.pos_path),
+        'state_dict': checkpoint,
+    }
+    if config['emb_class'] in ['glove', 'elmo']:
+        bundle['vocab'] = load_dict(opt.vocab_path)
+    if config['emb_class'] in BERT_CLASSES:
+        bundle['bert_files'] = read_files(opt.bert_output_dir)
+    torch.save(bundle, bundle_path)
+
+def load_bundle(opt):
+    """Return config and checkpoint from opt.bundle_path, the model flags in opt are overwritten by the bundle's.
+
+    the bundle itself is kept in config['bundle'], load_model() and inference.SentenceConverter read dicts from it.
+    """
+    load_kwargs = {'map_location': 'cpu'}
+    # torch>=2.1, tensors are paged in from the file on demand and shared with other processes reading the same file.
+    if 'mmap' in inspect.signature(torch.load).parameters: load_kwargs['mmap'] = True
+    bundle = torch.load(opt.bundle_path, **load_kwargs)
+    config = dict(bundle['config'])
+    config['opt'] = opt
+    config['bundle'] = bundle
+    for key, value in bundle['opt'].items():
+        setattr(opt, key, value)
+    logger.info("[Loading bundle done] : {}, mmap {}".format(opt.bundle_path, load_kwargs.get('mmap', False)))
+    return config, bundle['state_dict']
+
+def load_state_dict(model, checkpoint):
+    # use the checkpoint tensors as parameters instead of copying them(torch>=2.1), mmap pages are not touched.
+    if 'assign' in inspect.signature(model.load_state_dict).parameters:
+        model.load_state_dict(checkpoint, assign=True)
+    else:
+        model.load_state_dict(checkpoint)
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--config', type=str, default='configs/config-glove.json')
+    parser.add_argument('--data_dir', type=str, default='data/conll2003')
+    parser.add_argument('--model_path', type=str, default='pytorch-model-glove.pt')
+    parser.add_argument('--bundle_path', type=str, default='pytorch-model-glove.bundle')
+    parser.add_argument('--use_crf', action='store_true', help="Add CRF layer")
+    parser.add_argument('--use_char_cnn', action='store_true', help="Add Character features")
+    # for BERT
+    parser.add_argument('--bert_output_dir', type=str, default='bert-checkpoint',
+                        help="The output directory where the model predictions and checkpoints will be written.")
+    parser.add_argument('--bert_use_feature_based', action='store_true',
+                        help="Use BERT as feature-based, default fine-tuning")
+    parser.add_argument('--bert_disable_lstm', action='store_true',
+                        help="Disable lstm layer")
+    parser.add_argument('--bert_use_pos', action='store_true', help="Add Part-Of-Speech features")
+    parser.add_argument('--bert_exit_layers', type=str, default='',
+                        help="Comma separated layers with exit heads, same as train.py.")
+    # for ELMo
+    parser.add_argument('--elmo_options_file', type=str, default='embeddings/elmo_2x4096_512_2048cnn_2xhighway_5.5B_options.json')
+    parser.add_argument('--elmo_weights_file', type=str, default='embeddings/elmo_2x4096_512_2048cnn_2xhighway_5.5B_weights.hdf5')
+
+    opt = parser.parse_args()
+
+    from util import load_config
+    from evaluate import set_path
+    config = load_config(opt)
+    config['opt'] = opt
+    set_path(config)
+    st_time = time.time()
+    checkpoint = torch.load(opt.model_path, map_location='cpu')
+    if 'embed_token.weight' in checkpoint.get(FROZEN_REFS_KEY, {}):
+        # the bundle carries the embedding, checkpoints only reference it unless saved with train.py --save_frozen_params
+        embedding = torch.as_tensor(np.load(opt.embedding_path)).to(torch.float)
+        checkpoint = restore_frozen(checkpoint, {'embed_token.weight': embedding})
+    save_bundle(config, checkpoint, opt.bundle_path)
+    logger.info("[Bundle saved] : {}, {:.1f}MB, {:.2f}ms".\
+        format(opt.bundle_path, os.path.getsize(opt.bundle_path) / 2**20, (time.time() - st_time) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import pdb
+import glob
+import json
+import threading
+import queue
+import logging
+import hashlib
+from collections import OrderedDict
+
+import torch
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def to_cpu(obj):
+    """Snapshot(copy) tensors in a nested dict/list/tuple to cpu memory.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [to_cpu(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(to_cpu(v) for v in obj)
+    return obj
+
+# key of the references to the parameters left out of a checkpoint, see exclude_frozen()
+FROZEN_REFS_KEY = 'frozen_refs'
+
+def content_hash(tensor):
+    """sha1 of dtype, shape and data of a tensor."""
+    array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+    h = hashlib.sha1()
+    h.update('{} {}'.format(array.dtype, array.shape).encode())
+    h.update(array.data)
+    return h.hexdigest()
+
+class HashCache():
+    """content_hash() of the parameters built from an artifact file, kept in <artifact>.sha1 until the file changes.
+
+    the parameters are rebuilt from the artifact deterministically, its size and mtime stand for their contents.
+    """
+
+    def __init__(self, artifact_path):
+        self.path = artifact_path + '.sha1'
+        stat = os.stat(artifact_path)
+        self.stat = [stat.st_size, stat.st_mtime_ns]
+        self.hashes = {}
+        self.dirty = False
+        try:
+            with open(self.path, 'r') as f:
+                cache = json.load(f)
+            if cache['stat'] == self.stat: self.hashes = cache['hashes']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def get(self, name, tensor):
+        if name not in self.hashes:
+            self.hashes[name] = content_hash(tensor)
+            self.dirty = True
+        return self.hashes[name]
+
+    def save(self):
+        if not self.dirty: return
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({'stat': self.stat, 'hashes': self.hashes}, f)
+            self.dirty = False
+        except OSError as e:
+            logger.warning("[Hash cache not saved] : {}, {}".format(self.path, str(e)))
+
+def exclude_frozen(state_dict, frozen_refs):
+    """Leave out the frozen parameters rebuilt from data artifacts at load time, ex) embed_token.weight from embedding.npy.
+
+    Args:
+      frozen_refs: {name: {'artifact': file name, 'sha1': content_hash()}}, kept in the checkpoint instead of the values.
+    """
+    if not frozen_refs: return state_dict
+    slim = OrderedDict((k, v) for k, v in state_dict.items() if k not in frozen_refs)
+    slim[FROZEN_REFS_KEY] = frozen_refs
+    return slim
+
+def restore_frozen(state_dict, sources, verify=True, artifact_paths=None):
+    """Fill the parameters left out by exclude_frozen() from sources, ex) state_dict of the model built from the artifacts.
+
+    references not found in sources are kept, the result is a complete state_dict once all of them are restored.
+    Args:
+      artifact_paths: {artifact: path}, hashes of the parameters built from these files are cached in HashCache,
+        otherwise every parameter is hashed on each call.
+    """
+    frozen_refs = state_dict.get(FROZEN_REFS_KEY)
+    if frozen_refs is None: return state_dict
+    state_dict = OrderedDict((k, v) for k, v in state_dict.items() if k != FROZEN_REFS_KEY)
+    remains = {}
+    caches = {}
+    for name, ref in frozen_refs.items():
+        if name not in sources:
+            remains[name] = ref
+            continue
+        value = sources[name]
+        if verify:
+            path = (artifact_paths or {}).get(ref['artifact'])
+            if path and path not in caches: caches[path] = HashCache(path)
+            sha1 = caches[path].get(name, value) if path else content_hash(value)
+            if sha1 != ref['sha1']:
+                raise ValueError("{} differs from the one at training time, {} was changed".format(name, ref['artifact']))
+        state_dict[name] = value
+    for cache in caches.values(): cache.save()
+    if remains: state_dict[FROZEN_REFS_KEY] = remains
+    return state_dict
+
+def get_artifact_paths(opt):
+    # artifact name in the references(train.py get_frozen_refs()) -> path
+    paths = [getattr(opt, 'embedding_path', None), getattr(opt, 'elmo_weights_file', None)]
+    return {os.path.basename(path): path for path in paths if isinstance(path, str) and os.path.isfile(path)}
+
+class AsyncCheckpointer():
+    """Write checkpoints on a background thread.
+
+    the caller takes a cpu snapshot, so that training can go on updating the parameters
+    while the snapshot is written to a temporary file and renamed atomically.
+    """
+
+    def __init__(self, keep=2):
+        self.keep = keep
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            snapshot, path, rotate_pattern = item
+            try:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    torch.save(snapshot, f)
+                os.replace(tmp_path, path)
+                if rotate_pattern: self.__rotate(rotate_pattern)
+                logger.info("[Checkpoint saved] : {}".format(path))
+            except Exception as e:
+                logger.error("[Checkpoint failed] : {}, {}".format(path, str(e)))
+                self.error = e
+            self.queue.task_done()
+
+    def __rotate(self, pattern):
+        paths = sorted(glob.glob(pattern))
+        for path in paths[:max(0, len(paths) - self.keep)]:
+            os.remove(path)
+
+    def save(self, state, path, rotate_pattern=None, snapshot=True):
+        """Snapshot state on the caller thread and write it in background.
+
+        Args:
+          rotate_pattern: glob pattern of checkpoints to rotate, keep the last 'keep' ones in sorted order.
+          snapshot: if False, state is already a cpu snapshot(see to_cpu()) that nobody modifies.
+        """
+        if self.error: raise self.error
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname): os.makedirs(dirname)
+        if snapshot: state = to_cpu(state)
+        self.queue.put((state, path, rotate_pattern))
+
+    def wait(self):
+        self.queue.join()
+        if self.error: raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error: raise self.error
+
+def latest_checkpoint(checkpoint_dir, prefix='checkpoint-'):
+    paths = sorted(glob.glob(os.path.join(checkpoint_dir, prefix + '*.pt')))
+    if not paths: return None
+    return paths[-1]
@@ -4,9 +4,11 @@ import os
 import pdb
 
 import torch
+import numpy as np
 from torch.utils.data.dataset import Dataset
 from torch.utils.data import TensorDataset
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Sampler, Subset, ConcatDataset
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 
 import logging
@@ -14,20 +16,184 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 def prepare_dataset(config, filepath, DatasetClass, sampling=False, num_workers=1, batch_size=0):
-    opt = config['opt']
     dataset = DatasetClass(config, filepath)
+    loader = create_loader(config, dataset, sampling=sampling, num_workers=num_workers, batch_size=batch_size)
+    logger.info("[{} data loaded]".format(filepath))
+    return loader
+
+def create_loader(config, dataset, sampling=False, num_workers=1, batch_size=0):
+    opt = config['opt']
+    distributed = hasattr(opt, 'distributed') and opt.distributed
+    max_tokens = getattr(opt, 'max_tokens_per_batch', 0)
+    # keep DistributedSampler for distributed evaluation, the gathered predictions depend on its order.
+    if max_tokens > 0 and (sampling or not distributed):
+        batch_sampler = TokenBudgetBatchSampler(get_lengths(config, dataset), max_tokens, shuffle=sampling,
+                                                seed=getattr(opt, 'seed', 0),
+                                                num_replicas=opt.world_size if distributed else 1,
+                                                rank=opt.rank if distributed else 0)
+        collate_fn = TrimPaddingCollate(config)
+        if has_features(dataset): collate_fn = FeatureCollate(collate_fn)
+        loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers,
+                            collate_fn=collate_fn, pin_memory=True)
+        return loader
     if sampling:
-        sampler = RandomSampler(dataset)
+        sampler = EpochRandomSampler(dataset, seed=getattr(opt, 'seed', 0))
     else:
         sampler = SequentialSampler(dataset)
     if hasattr(opt, 'distributed') and opt.distributed:
-        sampler = DistributedSampler(dataset)
+        sampler = DistributedSampler(dataset, shuffle=sampling)
     bz = opt.batch_size
     if batch_size > 0: bz = batch_size
-    loader = DataLoader(dataset, batch_size=bz, num_workers=num_workers, sampler=sampler, pin_memory=True)
-    logger.info("[{} data loaded]".format(filepath))
+    collate_fn = FeatureCollate() if has_features(dataset) else None
+    loader = DataLoader(dataset, batch_size=bz, num_workers=num_workers, sampler=sampler, collate_fn=collate_fn, pin_memory=True)
     return loader
 
+class EpochRandomSampler(RandomSampler):
+    """RandomSampler which shuffles by seed + epoch(set_epoch()), same as DistributedSampler,
+    so that the order of an epoch does not depend on the global rng, ex) to resume in the middle of it.
+    """
+
+    def __init__(self, data_source, seed=0):
+        super().__init__(data_source, generator=torch.Generator())
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        self.generator.manual_seed(self.seed + self.epoch)
+        return super().__iter__()
+
+def skip_batches(loader, n_batches):
+    """Loader over the batches of the current epoch(after set_epoch()) but the first n_batches, the skipped examples are not loaded.
+    """
+    batches = list(loader.batch_sampler)[n_batches:]
+    # own generator for the worker seeds, the restored global rng is already past the creation of the epoch iterator.
+    return DataLoader(loader.dataset, batch_sampler=batches, num_workers=loader.num_workers, collate_fn=loader.collate_fn,
+                      pin_memory=loader.pin_memory, generator=torch.Generator())
+
+def has_features(dataset):
+    # examples of BertFeatureDataset, see FeatureCollate
+    if isinstance(dataset, ConcatDataset): return any(has_features(d) for d in dataset.datasets)
+    if isinstance(dataset, Subset): return has_features(dataset.dataset)
+    return isinstance(dataset, BertFeatureDataset)
+
+def get_lengths(config, dataset):
+    """Number of non-pad tokens of each example.
+    """
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([get_lengths(config, d) for d in dataset.datasets])
+    if isinstance(dataset, Subset):
+        return get_lengths(config, dataset.dataset)[np.asarray(dataset.indices)]
+    if isinstance(dataset, (BertFeatureDataset, DistillDataset)):
+        return get_lengths(config, dataset.dataset)
+    tensors = dataset.x.tensors
+    if isinstance(dataset, CoNLLBertDataset): mask = tensors[1] != 0 # input_mask
+    else: mask = tensors[0] != config['pad_token_id']
+    return mask.sum(dim=1).numpy()
+
+class TokenBudgetBatchSampler(Sampler):
+    """Pack examples into batches of at most max_tokens padded tokens(number of examples * max length in the batch).
+
+    Args:
+      shuffle: if True, sort by length within shuffled pools so that a batch has similar lengths,
+        and shuffle the batches at every epoch(set_epoch()). otherwise, keep the order of examples.
+      num_replicas, rank: for distributed training, every rank takes the same number of batches.
+      pool_size: number of batches in a pool to sort.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=False, seed=0, num_replicas=1, rank=0, pool_size=100):
+        self.lengths = np.maximum(1, np.asarray(lengths))
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pool_examples = pool_size * max(1, max_tokens // int(self.lengths.max()))
+        self.epoch = 0
+        self.cache = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __pack(self, indices):
+        batches = []
+        batch = []
+        max_len = 0
+        for idx in indices:
+            length = int(self.lengths[idx])
+            if batch and (len(batch) + 1) * max(max_len, length) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                max_len = 0
+            batch.append(int(idx))
+            max_len = max(max_len, length)
+        if batch: batches.append(batch)
+        return batches
+
+    def __batches(self):
+        if self.cache and self.cache[0] == self.epoch: return self.cache[1]
+        if self.shuffle:
+            rs = np.random.RandomState(self.seed + self.epoch)
+            indices = rs.permutation(len(self.lengths))
+            batches = []
+            for begin in range(0, len(indices), self.pool_examples):
+                pool = indices[begin:begin+self.pool_examples]
+                pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+                batches.extend(self.__pack(pool))
+            batches = [batches[i] for i in rs.permutation(len(batches))]
+        else:
+            batches = self.__pack(range(len(self.lengths)))
+        if self.num_replicas > 1:
+            # repeat some batches to split evenly
+            num_batches = (len(batches) + self.num_replicas - 1) // self.num_replicas * self.num_replicas
+            batches = (batches + batches[:num_batches - len(batches)])[self.rank::self.num_replicas]
+        self.cache = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.__batches())
+
+    def __len__(self):
+        return len(self.__batches())
+
+class TrimPaddingCollate():
+    """Collate a batch and trim the padding beyond the longest example along the sequence dimension.
+    """
+
+    def __init__(self, config):
+        self.seq_size = config['n_ctx']
+        self.pad_token_id = config['pad_token_id'] if 'pad_token_id' in config else 0
+        self.use_input_mask = config['emb_class'] in ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']
+
+    def __trim(self, t, max_len):
+        if torch.is_tensor(t):
+            if t.dim() >= 2 and t.shape[1] == self.seq_size: return t[:, :max_len].contiguous()
+            return t
+        return [self.__trim(e, max_len) for e in t]
+
+    def __call__(self, batch):
+        x, y = default_collate(batch)
+        if self.use_input_mask: mask = x[1] != 0
+        else: mask = x[0] != self.pad_token_id
+        max_len = max(1, int(mask.sum(dim=1).max()))
+        return self.__trim(x, max_len), self.__trim(y, max_len)
+
+class FeatureCollate():
+    """Collate examples of BertFeatureDataset, the features of the examples are concatenated without padding.
+
+    x[-1] of a batch is [num_tokens, bert_num_layers + 1, bert_hidden_size], in the order of the non-pad tokens(x[1] != 0).
+    """
+
+    def __init__(self, collate=default_collate):
+        self.collate = collate
+
+    def __call__(self, batch):
+        features = torch.cat([x[-1] for x, _ in batch], dim=0)
+        x, y = self.collate([(x[:-1], y) for x, y in batch])
+        return list(x) + [features], y
+
 class CoNLLGloveDataset(Dataset):
     def __init__(self, config, path):
         from allennlp.modules.elmo import batch_to_ids
@@ -87,6 +253,58 @@ class CoNLLBertDataset(Dataset):
     def __getitem__(self, idx):
         return self.x[idx], self.y[idx]
 
+class BertFeatureDataset(Dataset):
+    """Append cached bert hidden states to x of CoNLLBertDataset, for feature-based training.
+
+    the cache stores only non-pad tokens, [total_tokens, bert_num_layers + 1, bert_hidden_size] in float16,
+    and offsets[i] is the first token of i-th example. examples are batched by FeatureCollate.
+    """
+
+    def __init__(self, config, dataset, feature_path, offsets, num_layers, hidden_size):
+        self.dataset = dataset
+        self.feature_path = feature_path
+        self.offsets = offsets
+        self.num_layers = num_layers
+        self.hidden_size = hidden_size
+        self.features = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        # open lazily, in each DataLoader worker
+        if self.features is None:
+            self.features = np.memmap(self.feature_path, dtype=np.float16, mode='r').\
+                reshape(-1, self.num_layers, self.hidden_size)
+        x, y = self.dataset[idx]
+        begin, end = self.offsets[idx], self.offsets[idx+1]
+        feature = torch.from_numpy(np.array(self.features[begin:end]))
+        # feature : [end - begin, bert_num_layers + 1, bert_hidden_size]
+        return tuple(x) + (feature,), y
+
+class DistillDataset(Dataset):
+    """Pair y with the word-level teacher logits for distillation, y -> (label_ids, teacher_logits).
+
+    teacher logits are [num_examples, seq_size, label_size] float16 in a .npy file, memory-mapped.
+    """
+
+    def __init__(self, dataset, logits_path):
+        self.dataset = dataset
+        self.logits_path = logits_path
+        self.logits = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        # open lazily, in each DataLoader worker
+        if self.logits is None:
+            self.logits = np.load(self.logits_path, mmap_mode='r')
+        x, y = self.dataset[idx]
+        teacher_logits = torch.from_numpy(np.array(self.logits[idx]))
+        # teacher_logits : [seq_size, label_size]
+        return x, (y, teacher_logits)
+
 class CoNLLElmoDataset(Dataset):
     def __init__(self, config, path):
         from allennlp.modules.elmo import batch_to_ids
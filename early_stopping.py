@@ -32,7 +32,14 @@ class EarlyStopping():
 
     def step(self):
         return self._step
- 
+
+    def state_dict(self):
+        return {'step': self._step, 'value': self._value}
+
+    def load_state_dict(self, state):
+        self._step = state['step']
+        self._value = state['value']
+
     def validate(self, value, measure='loss'):
         going_worse = False
         if measure == 'loss': # loss
@@ -1,150 +1,238 @@
 from __future__ import print_function
 import sys
+import json
 import argparse
+from multiprocessing import Pool
 import numpy as np
 
 class TokenEval:
-    """Token-based evaluation
+    """Token-based evaluation over a label-indexed confusion matrix
+
+    confusion[t, p] : number of tokens whose tag is labels[t] and prediction is labels[p].
     """
 
-    def __init__(self):
-        self.cls = {}
-        self.tp = {}
-        self.fp = {}
-        self.fn = {}
-        self.precision = {}
-        self.recall = {}
-        self.fscore = {}
-
-    def __eval_bucket(self, bucket):
-        line_num = 0
-        for line in bucket:
+    def __init__(self, out_classes=['O', 'X'], in_class='I'):
+        self.labels = []
+        self.label_index = {}
+        self.confusion = np.zeros((0, 0), dtype=np.int64)
+        self.out_classes = out_classes
+        self.in_class = in_class
+        self.num_skipped = 0
+
+    def __index(self, label):
+        if label not in self.label_index:
+            self.label_index[label] = len(self.labels)
+            self.labels.append(label)
+        return self.label_index[label]
+
+    def __grow(self):
+        size = len(self.labels)
+        if self.confusion.shape[0] == size: return
+        confusion = np.zeros((size, size), dtype=np.int64)
+        n = self.confusion.shape[0]
+        confusion[:n, :n] = self.confusion
+        self.confusion = confusion
+
+    def update(self, tags, preds):
+        """Accumulate arrays of tag and prediction labels(str or bytes) into the confusion matrix.
+        """
+        if len(tags) == 0: return
+        tags = np.asarray(tags)
+        preds = np.asarray(preds)
+        # map labels to indices once per unique label, not per token
+        uniq, inverse = np.unique(np.concatenate([tags, preds]), return_inverse=True)
+        ids = np.array([self.__index(u.decode('utf-8') if isinstance(u, bytes) else str(u)) for u in uniq], dtype=np.int64)
+        self.__grow()
+        size = len(self.labels)
+        inverse = ids[inverse]
+        t, p = inverse[:len(tags)], inverse[len(tags):]
+        self.confusion += np.bincount(t * size + p, minlength=size * size).reshape(size, size)
+
+    def merge(self, labels, confusion):
+        """Merge a confusion matrix indexed by other labels.
+        """
+        ids = np.array([self.__index(label) for label in labels], dtype=np.int64)
+        self.__grow()
+        self.confusion[np.ix_(ids, ids)] += confusion
+
+    def update_lines(self, lines):
+        """Accumulate lines of 'word pos chunk tag pred'.
+        """
+        # the width of every line, not the total, misformed lines could add up to 5 columns per line
+        widths = set(map(len, map(bytes.split, lines)))
+        if widths <= {0, 5}:
+            # fast path, every non-empty line has 5 columns
+            flat = b' '.join(lines).split()
+            self.update(flat[3::5], flat[4::5])
+            return
+        tags = []
+        preds = []
+        for line in lines:
             tokens = line.split()
-            size = len(tokens)
-            if line_num == 0 and size == 3: # skip 'USING SKIP CONNECTIONS'
-                line_num += 1
+            if len(tokens) == 0: continue
+            if len(tokens) != 5: # skip 'USING SKIP CONNECTIONS', etc
+                self.num_skipped += 1
                 continue
-            assert(size == 5)
-            w = tokens[0]
-            pos = tokens[1]
-            chunk = tokens[2]
-            tag = tokens[3]
-            pred = tokens[4]
-            if pred not in self.tp: self.tp[pred] = 0
-            if tag not in self.tp:  self.tp[tag] = 0
-            if pred not in self.fp: self.fp[pred] = 0
-            if tag not in self.fp:  self.fp[tag] = 0
-            if pred not in self.fn: self.fn[pred] = 0
-            if tag not in self.fn:  self.fn[tag] = 0
-            if tag == pred:
-                self.tp[pred] += 1
-            else:
-                self.fp[pred] += 1
-                self.fn[tag] += 1
-            self.cls[pred] = None
-            self.cls[tag] = None
-            line_num += 1
-
-    def eval(self):
-        """Compute micro precision, recall, fscore given file.
+            tags.append(tokens[3])
+            preds.append(tokens[4])
+        self.update(tags, preds)
+
+    def read(self, f, chunk_size=1<<24):
+        """Stream a binary file object chunk by chunk.
         """
-        bucket = []
         while 1:
-            try: line = sys.stdin.readline()
-            except KeyboardInterrupt: break
-            if not line: break
-            line = line.strip()
-            if not line and len(bucket) >= 1:
-                self.__eval_bucket(bucket)
-                bucket = []
-            if line : bucket.append(line)
-        if len(bucket) != 0:
-            self.__eval_bucket(bucket)
-
-        # in_class vs out_class
-        in_class  = 'I'
-        out_classes = ['O', 'X']
-        self.tp[in_class] = 0
-        self.fp[in_class] = 0
-        self.fn[in_class] = 0
-        for c, _ in self.cls.items():
-            if c not in out_classes:
-                self.tp[in_class] += self.tp[c]
-                self.fp[in_class] += self.fp[c]
-                self.fn[in_class] += self.fn[c]
-        self.cls[in_class] = None
-
-        print(self.tp)
-        print(self.fp)
-        print(self.fn)
-
-        for c, _ in self.cls.items():
-            if self.tp[c] + self.fp[c] != 0:
-                self.precision[c] = self.tp[c]*1.0 / (self.tp[c] + self.fp[c])
-            else:
-                self.precision[c] = 0
-            if self.tp[c] + self.fn[c] != 0:
-                self.recall[c] = self.tp[c]*1.0 / (self.tp[c] + self.fn[c])
-            else:
-                self.recall[c] = 0
-            if self.precision[c] + self.recall[c] != 0:
-                self.fscore[c] = 2.0*self.precision[c]*self.recall[c] / (self.precision[c] + self.recall[c])
-            else:
-                self.fscore[c] = 0
+            lines = f.readlines(chunk_size)
+            if not lines: break
+            self.update_lines(lines)
+
+    def scores(self):
+        """Compute per-label and in_class(micro over labels except out_classes), macro precision, recall, fscore.
+        """
+        confusion = self.confusion
+        tp = np.diag(confusion).astype(np.float64)
+        fp = confusion.sum(axis=0) - tp
+        fn = confusion.sum(axis=1) - tp
+        precision, recall, fscore = self.__prf(tp, fp, fn)
+        per_label = {}
+        for i, label in enumerate(self.labels):
+            per_label[label] = {'tp': int(tp[i]), 'fp': int(fp[i]), 'fn': int(fn[i]),
+                                'precision': float(precision[i]), 'recall': float(recall[i]), 'fscore': float(fscore[i])}
+        in_ids = [i for i, label in enumerate(self.labels) if label not in self.out_classes]
+        m_tp, m_fp, m_fn = tp[in_ids].sum(), fp[in_ids].sum(), fn[in_ids].sum()
+        m_precision, m_recall, m_fscore = self.__prf(np.array([m_tp]), np.array([m_fp]), np.array([m_fn]))
+        per_label[self.in_class] = {'tp': int(m_tp), 'fp': int(m_fp), 'fn': int(m_fn),
+                                    'precision': float(m_precision[0]), 'recall': float(m_recall[0]), 'fscore': float(m_fscore[0])}
+        ret = {
+            'labels': self.labels,
+            'per_label': per_label,
+            'micro': {'precision': float(m_precision[0]), 'recall': float(m_recall[0]), 'fscore': float(m_fscore[0])},
+            'macro': {'precision': float(precision[in_ids].mean()) if in_ids else 0.0,
+                      'recall': float(recall[in_ids].mean()) if in_ids else 0.0,
+                      'fscore': float(fscore[in_ids].mean()) if in_ids else 0.0},
+            'accuracy': float(tp.sum() / max(1, confusion.sum())),
+            'num_tokens': int(confusion.sum()),
+            'num_skipped': self.num_skipped,
+            'confusion': confusion.tolist(),
+        }
+        return ret
+
+    @staticmethod
+    def __prf(tp, fp, fn):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(tp + fp != 0, tp / (tp + fp), 0.0)
+            recall = np.where(tp + fn != 0, tp / (tp + fn), 0.0)
+            fscore = np.where(precision + recall != 0, 2.0 * precision * recall / (precision + recall), 0.0)
+        return precision, recall, fscore
+
+    def eval(self, f=None):
+        """Compute micro precision, recall, fscore given file(default stdin) and print them.
+        """
+        if f is None: f = sys.stdin.buffer
+        try:
+            self.read(f)
+        except KeyboardInterrupt:
+            pass
+        ret = self.scores()
+        per_label = ret['per_label']
+
+        print(dict((c, s['tp']) for c, s in per_label.items()))
+        print(dict((c, s['fp']) for c, s in per_label.items()))
+        print(dict((c, s['fn']) for c, s in per_label.items()))
 
         print('')
         print('precision:')
-        for c, _ in self.precision.items():
-            print(c + ',' + str(self.precision[c]))
+        for c, s in per_label.items():
+            print(c + ',' + str(s['precision']))
         print('')
         print('recall:')
-        for c, _ in self.recall.items():
-            print(c + ',' + str(self.recall[c]))
+        for c, s in per_label.items():
+            print(c + ',' + str(s['recall']))
         print('')
         print('fscore:')
-        for c, _ in self.fscore.items():
-            print(c + ',' + str(self.fscore[c]))
+        for c, s in per_label.items():
+            print(c + ',' + str(s['fscore']))
         print('')
         print('total fscore:')
-        print(self.fscore[in_class])
+        print(per_label[self.in_class]['fscore'])
+        return ret
 
     @staticmethod
     def compute_f1(class_size, prediction, target, length):
         """Compute micro Fscore given prediction and target
         along with list of Precision, Recall, Fscore for each class.
         """
-        tp = np.array([0] * (class_size + 1))
-        fp = np.array([0] * (class_size + 1))
-        fn = np.array([0] * (class_size + 1))
-        for i in range(len(target)):
-            for j in range(length[i]):
-                if target[i, j] == prediction[i, j]:
-                    tp[prediction[i, j]] += 1
-                else:
-                    fp[prediction[i, j]] += 1
-                    fn[target[i, j]] += 1
+        prediction = np.asarray(prediction)
+        target = np.asarray(target)
+        length = np.asarray(length)
+        valid = np.arange(target.shape[1])[None, :] < length[:, None]
+        t = target[valid]
+        p = prediction[valid]
+        hit = t == p
+        tp = np.bincount(p[hit], minlength=class_size + 1)[:class_size + 1]
+        fp = np.bincount(p[~hit], minlength=class_size + 1)[:class_size + 1]
+        fn = np.bincount(t[~hit], minlength=class_size + 1)[:class_size + 1]
         out_of_classes = [0, 1] # SEE embvec.oot_tid, embvec.xot_tid
-        for i in range(class_size):
-            if i not in out_of_classes:
-                tp[class_size] += tp[i]
-                fp[class_size] += fp[i]
-                fn[class_size] += fn[i]
-        precision = []
-        recall = []
-        fscore = []
-        for i in range(class_size + 1):
-            if tp[i] + fp[i] == 0: precision.append(0.0)
-            else: precision.append(tp[i] * 1.0 / (tp[i] + fp[i]))
-            if tp[i] + fn[i] == 0: recall.append(0.0)
-            else: recall.append(tp[i] * 1.0 / (tp[i] + fn[i]))
-            if precision[i] + recall[i] == 0: fscore.append(0.0)
-            else: fscore.append(2.0 * precision[i] * recall[i] / (precision[i] + recall[i]))
+        in_classes = [i for i in range(class_size) if i not in out_of_classes]
+        tp[class_size] = tp[in_classes].sum()
+        fp[class_size] = fp[in_classes].sum()
+        fn[class_size] = fn[in_classes].sum()
+        precision, recall, fscore = TokenEval.__prf(tp.astype(np.float64), fp, fn)
+        precision, recall, fscore = precision.tolist(), recall.tolist(), fscore.tolist()
         return fscore[class_size], precision, recall, fscore
 
+def eval_file(path):
+    ev = TokenEval()
+    with open(path, 'rb') as f:
+        ev.read(f)
+    return ev.labels, ev.confusion, ev.num_skipped
+
+def eval_files(paths, num_processes=0):
+    """Stream every file in its own process, return TokenEval per path.
+    """
+    if num_processes <= 0: num_processes = len(paths)
+    num_processes = min(num_processes, len(paths))
+    if num_processes > 1:
+        with Pool(processes=num_processes) as pool:
+            results = pool.map(eval_file, paths)
+    else:
+        results = [eval_file(path) for path in paths]
+    evs = {}
+    for path, (labels, confusion, num_skipped) in zip(paths, results):
+        ev = TokenEval()
+        ev.merge(labels, confusion)
+        ev.num_skipped = num_skipped
+        evs[path] = ev
+    return evs
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='*', help="Prediction files('word pos chunk tag pred'), stdin if not given.")
+    parser.add_argument('--json', action='store_true', help="Print scores and confusion matrix as json.")
+    parser.add_argument('--num_processes', type=int, default=0, help="Number of processes for multiple files, 0 means one per file.")
+    parser.add_argument('--min_fscore', type=float, default=-1.0,
+                        help="Exit with status 1 if micro fscore of any file is lower than this value.")
 
     args = parser.parse_args()
 
-    ev = TokenEval()
-    ev.eval()
+    if not args.paths:
+        ev = TokenEval()
+        if args.json:
+            ev.read(sys.stdin.buffer)
+            rets = {'-': ev.scores()}
+            print(json.dumps(rets))
+        else:
+            rets = {'-': ev.eval()}
+    else:
+        evs = eval_files(args.paths, num_processes=args.num_processes)
+        rets = dict((path, ev.scores()) for path, ev in evs.items())
+        if args.json:
+            print(json.dumps(rets))
+        else:
+            for path, ret in rets.items():
+                print('{}\tmicro fscore {:.6f}\tmacro fscore {:.6f}\taccuracy {:.6f}\ttokens {}'.\
+                      format(path, ret['micro']['fscore'], ret['macro']['fscore'], ret['accuracy'], ret['num_tokens']))
+
+    failed = [path for path, ret in rets.items() if ret['micro']['fscore'] < args.min_fscore]
+    if failed:
+        sys.stderr.write('fscore lower than {} : {}\n'.format(args.min_fscore, ', '.join(failed)))
+        sys.exit(1)
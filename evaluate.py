@@ -7,17 +7,20 @@ import json
 import time
 import pdb
 import logging
+import queue
+import copy
+import contextlib
+import inspect
 
 import torch
-import torch.quantization
 import torch.nn as nn
 import numpy as np
-from seqeval.metrics import precision_score, recall_score, f1_score, classification_report
 
 from tqdm import tqdm
-from util import load_config, to_device, to_numpy
-from model import GloveLSTMCRF, GloveDensenetCRF, BertLSTMCRF, ElmoLSTMCRF
-from dataset import prepare_dataset, CoNLLGloveDataset, CoNLLBertDataset, CoNLLElmoDataset
+from util import load_config, to_device, to_numpy, pad_to_seq_size, load_conll_words, get_memory_usage
+from checkpoint import restore_frozen, get_artifact_paths
+import util_profile
+# model(torchcrf), dataset, seqeval, torch.quantization are imported where they are used, for a fast startup of inference.py
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -45,31 +48,69 @@ def load_checkpoint(config):
     logger.info("[Loading checkpoint done]")
     return checkpoint
 
+def skip_init_weights():
+    """Context in which transformers models are built without the random initialization, for the weights loaded afterwards.
+    """
+    try:
+        from transformers.initialization import no_init_weights # transformers>=5
+    except ImportError:
+        try:
+            from transformers.modeling_utils import no_init_weights
+        except ImportError:
+            return contextlib.nullcontext()
+    return no_init_weights()
+
 def load_model(config, checkpoint):
     opt = config['opt']
+    from model import GloveLSTMCRF, GloveDensenetCRF, BertLSTMCRF, ElmoLSTMCRF
+    from bundle import load_state_dict
+    embedding_path, label_path, pos_path = opt.embedding_path, opt.label_path, opt.pos_path
+    bundle = config.get('bundle')
+    if bundle:
+        # everything from the bundle(bundle.py), the embedding is the checkpoint tensor itself.
+        embedding_path = checkpoint.get('embed_token.weight')
+        label_path, pos_path = bundle['labels'], bundle['poss']
     if config['emb_class'] == 'glove':
         if config['enc_class'] == 'bilstm':
-            model = GloveLSTMCRF(config, opt.embedding_path, opt.label_path, opt.pos_path,
+            model = GloveLSTMCRF(config, embedding_path, label_path, pos_path,
                                  emb_non_trainable=True, use_crf=opt.use_crf, use_char_cnn=opt.use_char_cnn)
         if config['enc_class'] == 'densenet':
-            model = GloveDensenetCRF(config, opt.embedding_path, opt.label_path, opt.pos_path,
+            model = GloveDensenetCRF(config, embedding_path, label_path, pos_path,
                                      emb_non_trainable=True, use_crf=opt.use_crf, use_char_cnn=opt.use_char_cnn)
     if config['emb_class'] in ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']:
         from transformers import AutoTokenizer, AutoConfig, AutoModel
-        bert_config = AutoConfig.from_pretrained(opt.bert_output_dir)
-        bert_tokenizer = AutoTokenizer.from_pretrained(opt.bert_output_dir)
-        bert_model = AutoModel.from_config(bert_config)
+        bert_dir = opt.bert_output_dir
+        if bundle:
+            import tempfile
+            from bundle import extract_files
+            tmp_dir = tempfile.TemporaryDirectory()
+            bert_dir = tmp_dir.name
+            extract_files(bundle['bert_files'], bert_dir)
+        bert_config = AutoConfig.from_pretrained(bert_dir)
+        bert_tokenizer = AutoTokenizer.from_pretrained(bert_dir)
+        if bundle: tmp_dir.cleanup()
+        # weights are loaded only once, from checkpoint below, not initialized randomly before that.
+        # load_state_dict() is strict, a weight missing in checkpoint fails instead of staying uninitialized.
+        with skip_init_weights():
+            bert_model = AutoModel.from_config(bert_config)
         ModelClass = BertLSTMCRF
-        model = ModelClass(config, bert_config, bert_model, bert_tokenizer, opt.label_path, opt.pos_path,
+        model = ModelClass(config, bert_config, bert_model, bert_tokenizer, label_path, pos_path,
                            use_crf=opt.use_crf, use_pos=opt.bert_use_pos, disable_lstm=opt.bert_disable_lstm,
-                           feature_based=opt.bert_use_feature_based)
+                           feature_based=opt.bert_use_feature_based,
+                           exit_layers=[int(layer) for layer in getattr(opt, 'bert_exit_layers', '').split(',') if layer.strip()])
     if config['emb_class'] == 'elmo':
         from allennlp.modules.elmo import Elmo
         elmo_model = Elmo(opt.elmo_options_file, opt.elmo_weights_file, 2, dropout=0)
-        model = ElmoLSTMCRF(config, elmo_model, opt.embedding_path, opt.label_path, opt.pos_path,
+        model = ElmoLSTMCRF(config, elmo_model, embedding_path, label_path, pos_path,
                             emb_non_trainable=True, use_crf=opt.use_crf, use_char_cnn=opt.use_char_cnn)
-    model.load_state_dict(checkpoint)
+    # frozen embeddings left out of the checkpoint are the ones just built from the embedding files(train.py get_frozen_refs())
+    checkpoint = restore_frozen(checkpoint, model.state_dict(), artifact_paths=get_artifact_paths(opt))
+    load_state_dict(model, checkpoint)
     model = model.to(opt.device)
+    if getattr(opt, 'char_cache_size', 0) > 0 and hasattr(model, 'charcnn'):
+        model.charcnn.enable_cache(opt.char_cache_size)
+    if getattr(opt, 'elmo_token_cache', False) and config['emb_class'] == 'elmo':
+        model.enable_token_cache(load_conll_words(os.path.join(opt.data_dir, 'train.txt')), max_size=opt.elmo_token_cache_size)
     logger.info("[Loaded]")
     return model
 
@@ -100,6 +141,9 @@ def convert_onnx(config, torch_model, x):
             output_names += ['prediction']
             dynamic_axes['prediction'] = {0: 'batch', 1: 'sequence'}
         
+    export_kwargs = {}
+    # torch>=2.9 exports with dynamo by default, the names and dynamic_axes above are for the torchscript exporter
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters: export_kwargs['dynamo'] = False
     with torch.no_grad():
         torch.onnx.export(torch_model,                  # model being run
                           x,                            # model input (or a tuple for multiple inputs)
@@ -110,7 +154,8 @@ def convert_onnx(config, torch_model, x):
                           verbose=True,
                           input_names=input_names,      # the model's input names
                           output_names=output_names,    # the model's output names
-                          dynamic_axes=dynamic_axes)    # variable length axes
+                          dynamic_axes=dynamic_axes,    # variable length axes
+                          **export_kwargs)
 
 # ------------------------------------------------------------------------------ #
 # source code from https://github.com/huggingface/transformers/blob/master/src/transformers/convert_graph_to_onnx.py#L374
@@ -199,6 +244,7 @@ def write_prediction(opt, ys, preds, labels, pad_label_id, default_label):
 
 def prepare_datasets(config):
     opt = config['opt']
+    from dataset import prepare_dataset, CoNLLGloveDataset, CoNLLBertDataset, CoNLLElmoDataset
     if config['emb_class'] == 'glove':
         DatasetClass = CoNLLGloveDataset
     if config['emb_class'] in ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']:
@@ -208,104 +254,64 @@ def prepare_datasets(config):
     test_loader = prepare_dataset(config, opt.data_path, DatasetClass, sampling=False, num_workers=1)
     return test_loader
 
-def evaluate(opt):
-    # set config
-    config = load_config(opt)
-    if opt.num_threads > 0: torch.set_num_threads(opt.num_threads)
-    config['opt'] = opt
-    logger.info("%s", config)
-
-    # set path
-    set_path(config)
-
-    # prepare test dataset
-    test_loader = prepare_datasets(config)
- 
-    # load pytorch model checkpoint
-    checkpoint = load_checkpoint(config)
-
-    # prepare model and load parameters
-    model = load_model(config, checkpoint)
-    model.eval()
-
-    # convert to onnx format
-    if opt.convert_onnx:
-        (x, y) = next(iter(test_loader))
-        x = to_device(x, opt.device)
-        y = to_device(y, opt.device)
-        convert_onnx(config, model, x)
-        check_onnx(config)
-        logger.info("[ONNX model saved at {}".format(opt.onnx_path))
-        # quantize onnx
-        if opt.quantize_onnx:
-            quantize_onnx(opt.onnx_path, opt.quantized_onnx_path)
-            logger.info("[Quantized ONNX model saved at {}".format(opt.quantized_onnx_path))
-        return
+def prepare_ort_session(config, label_size):
+    opt = config['opt']
+    from util_ort import OrtBackend
+    providers = [p for p in opt.ort_providers.split(',') if p]
+    inter_op_num_threads = opt.ort_inter_op_num_threads if opt.ort_inter_op_num_threads > 0 else opt.num_threads
+    ort_session = OrtBackend(config, opt.onnx_path, label_size,
+                             providers=providers,
+                             intra_op_num_threads=opt.num_threads,
+                             inter_op_num_threads=inter_op_num_threads,
+                             graph_optimization_level=opt.ort_graph_optimization_level,
+                             execution_mode=opt.ort_execution_mode,
+                             optimized_model_path=opt.ort_optimized_model_path,
+                             use_io_binding=not opt.ort_disable_io_binding)
+    return ort_session
+
+def predict_batch(config, model, x, ort_session=None, word_mask=None):
+    # word_mask : [batch_size, seq_size], first sub-tokens of the words for early exit, see BertLSTMCRF.forward_early_exit()
+    opt = config['opt']
+    prediction = None
+    if ort_session:
+        logits, prediction = ort_session.run(x)
+    elif getattr(opt, 'exit_threshold', 0) > 0:
+        logits, prediction, exit_layer = model.forward_early_exit(x, opt.exit_threshold, word_mask=word_mask)
+        config.setdefault('exit_layers', []).extend(exit_layer.tolist())
+    else:
+        if opt.use_crf: logits, prediction = model(x)
+        else: logits = model(x)
+    return logits, prediction
 
-    # load onnx model for using onnxruntime
-    if opt.enable_ort:
-        import onnxruntime as ort
-        sess_options = ort.SessionOptions()
-        sess_options.inter_op_num_threads = opt.num_threads
-        sess_options.intra_op_num_threads = opt.num_threads
-        ort_session = ort.InferenceSession(opt.onnx_path, sess_options=sess_options)
-    
-    # enable to use dynamic quantized model (pytorch>=1.3.0)
-    if opt.enable_dqm and opt.device == 'cpu':
-        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
-        print(model)
- 
-    # evaluation
+def predict_loader(config, model, loader, ort_session=None, verbose=True):
+    opt = config['opt']
     preds = None
     ys    = None
-    n_batches = len(test_loader)
+    n_batches = len(loader)
     total_examples = 0
     whole_st_time = time.time()
     first_time = time.time()
     first_examples = 0
     total_duration_time = 0.0
     with torch.no_grad():
-        for i, (x,y) in enumerate(tqdm(test_loader, total=n_batches)):
+        for i, (x,y) in enumerate(tqdm(loader, total=n_batches, disable=not verbose)):
             start_time = time.time()
             x = to_device(x, opt.device)
             y = to_device(y, opt.device)
 
-            if opt.enable_ort:
-                x = to_numpy(x)
-                if config['emb_class'] == 'glove':
-                    ort_inputs = {ort_session.get_inputs()[0].name: x[0],
-                                  ort_session.get_inputs()[1].name: x[1]}
-                    if opt.use_char_cnn:
-                        ort_inputs[ort_session.get_inputs()[2].name] = x[2]
-                if config['emb_class'] in ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']:
-                    if config['emb_class'] in ['distilbert', 'bart']:
-                        ort_inputs = {ort_session.get_inputs()[0].name: x[0],
-                                      ort_session.get_inputs()[1].name: x[1]}
-                    else:
-                        ort_inputs = {ort_session.get_inputs()[0].name: x[0],
-                                      ort_session.get_inputs()[1].name: x[1],
-                                      ort_session.get_inputs()[2].name: x[2]}
-                    if opt.bert_use_pos:
-                        ort_inputs[ort_session.get_inputs()[3].name] = x[3]
-                if opt.use_crf:
-                    logits, prediction = ort_session.run(None, ort_inputs)
-                    prediction = to_device(torch.tensor(prediction), opt.device)
-                    logits = to_device(torch.tensor(logits), opt.device)
-                else:
-                    logits = ort_session.run(None, ort_inputs)[0]
-                    logits = to_device(torch.tensor(logits), opt.device)
-            else:
-                if opt.use_crf: logits, prediction = model(x)
-                else: logits = model(x)
+            # labeled positions are the first sub-tokens of the words
+            logits, prediction = predict_batch(config, model, x, ort_session=ort_session, word_mask=(y != config['pad_label_id']))
 
+            # batches may be trimmed to their longest example(--max_tokens_per_batch), pad back to n_ctx.
+            if opt.use_crf: pred = pad_to_seq_size(to_numpy(prediction), config['n_ctx'])
+            else: pred = pad_to_seq_size(to_numpy(logits), config['n_ctx'])
+            y_np = pad_to_seq_size(to_numpy(y), config['n_ctx'], value=config['pad_label_id'])
             if preds is None:
-                if opt.use_crf: preds = to_numpy(prediction)
-                else: preds = to_numpy(logits)
-                ys = to_numpy(y)
+                preds = pred
+                ys = y_np
             else:
-                if opt.use_crf: preds = np.append(preds, to_numpy(prediction), axis=0)
-                else: preds = np.append(preds, to_numpy(logits), axis=0)
-                ys = np.append(ys, to_numpy(y), axis=0)
+                preds = np.append(preds, pred, axis=0)
+                ys = np.append(ys, y_np, axis=0)
             cur_examples = y.size(0)
             total_examples += cur_examples
             if i == 0: # first one may take longer time, so ignore in computing duration.
@@ -320,33 +326,307 @@ def evaluate(opt):
             logger.info("[Elapsed Time] : {}ms".format(duration_time))
             '''
     whole_time = float((time.time()-whole_st_time)*1000)
-    avg_time = (whole_time - first_time) / (total_examples - first_examples)
     if not opt.use_crf: preds = np.argmax(preds, axis=2)
+    stats = {
+        'total_examples': total_examples,
+        'whole_time': whole_time,
+        'first_time': first_time,
+        'first_examples': first_examples,
+        'total_duration_time': total_duration_time,
+    }
+    return preds, ys, stats
+
+def compute_measure(config, labels, ys, preds):
     # compute measure using seqeval
-    labels = model.labels
+    pad_label_id = config['pad_label_id']
     ys_lbs = [[] for _ in range(ys.shape[0])]
     preds_lbs = [[] for _ in range(ys.shape[0])]
-    pad_label_id = config['pad_label_id']
     for i in range(ys.shape[0]):     # foreach sentence
         for j in range(ys.shape[1]): # foreach token
             if ys[i][j] != pad_label_id:
                 ys_lbs[i].append(labels[ys[i][j]])
                 preds_lbs[i].append(labels[preds[i][j]])
+    from seqeval.metrics import precision_score, recall_score, f1_score, classification_report
     ret = {
         "precision": precision_score(ys_lbs, preds_lbs),
         "recall": recall_score(ys_lbs, preds_lbs),
         "f1": f1_score(ys_lbs, preds_lbs),
         "report": classification_report(ys_lbs, preds_lbs, digits=4),
     }
+    return ret
+
+# ---------------------------------------------------------------------------- #
+# Sharded evaluation over multiple processes
+# ---------------------------------------------------------------------------- #
+
+def get_shard_cores(rank, opt):
+    if opt.cores_per_process <= 0: return None
+    begin = opt.core_offset + rank * opt.cores_per_process
+    return list(range(begin, begin + opt.cores_per_process))
+
+def prepare_workers(config, model):
+    """Prepare the model before starting the workers of evaluate_sharded() or inference.serve().
+    """
+    opt = config['opt']
+    # write the optimized onnx graph once, before workers load it concurrently
+    if opt.enable_ort and opt.ort_optimized_model_path:
+        prepare_ort_session(config, model.label_size)
+    # weights are placed in shared memory once and attached read-only by every worker
+    model.share_memory()
+
+def prepare_worker(rank, config, model):
+    """Set up a worker process started after prepare_workers(), return the model(quantized in the worker) and the ort session.
+    """
+    opt = config['opt']
+    # pin this worker to its own core set before torch spins up the intra-op thread pool
+    cores = get_shard_cores(rank, opt)
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    if opt.num_threads > 0: torch.set_num_threads(opt.num_threads)
+
+    ort_session = None
+    if opt.enable_ort:
+        ort_session = prepare_ort_session(config, model.label_size)
+    # quantized tensors can not be passed to the workers, quantize per worker.
+    # in place, only the linear layers get a private int8 copy, the other weights(embedding, lstm, ...) stay shared.
+    if opt.enable_dqm and opt.device == 'cpu':
+        from torch.quantization import quantize_dynamic
+        model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if opt.stage_profile:
+        util_profile.enable(use_cuda=(opt.device != 'cpu'))
+    return model, ort_session
+
+def evaluate_shard(rank, config, model, dataset, shard, result_queue):
+    opt = config['opt']
+    model, ort_session = prepare_worker(rank, config, model)
+    cores = get_shard_cores(rank, opt)
+
+    from torch.utils.data import Subset
+    from dataset import create_loader
+    shard_dataset = Subset(dataset, range(shard[0], shard[1]))
+    shard_loader = create_loader(config, shard_dataset, sampling=False, num_workers=0)
+    cpu_st_time = time.process_time()
+    preds, ys, stats = predict_loader(config, model, shard_loader, ort_session=ort_session, verbose=(rank == 0))
+    stats['cpu_time'] = float((time.process_time()-cpu_st_time)*1000)
+    stats['num_threads'] = torch.get_num_threads()
+    stats['cores'] = cores
+    stats['memory'] = get_memory_usage()
+    if ort_session: stats['ort'] = ort_session.overhead()
+    profiler = util_profile.disable()
+    if profiler:
+        stats['stage_stats'] = profiler.stats
+        stats['stage_events'] = profiler.events
+    report_char_cache(model, rank=rank)
+    result_queue.put((rank, preds, ys, stats))
+
+def get_result(result_queue, procs, timeout=1.0):
+    """Next item of result_queue, raise RuntimeError if a worker died instead of waiting for it forever.
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=timeout)
+        except queue.Empty:
+            pass
+        # a worker exits with 0 only after its last item is flushed to the queue
+        for rank, p in enumerate(procs):
+            if p.exitcode is not None and p.exitcode != 0:
+                raise RuntimeError("[Worker {}] exited with code {}".format(rank, p.exitcode))
+
+def evaluate_sharded(config, model, dataset):
+    opt = config['opt']
+    import torch.multiprocessing as mp
+
+    num_examples = len(dataset)
+    if opt.num_examples != 0: num_examples = min(num_examples, opt.num_examples)
+    # every worker runs its whole shard, on a copy of opt, the caller's opt is left as it is
+    worker_config = dict(config)
+    worker_config['opt'] = copy.copy(opt)
+    worker_config['opt'].num_examples = 0
+    num_processes = min(opt.num_processes, num_examples)
+    # contiguous shards, so that merging by rank keeps the original order
+    shard_size = (num_examples + num_processes - 1) // num_processes
+    shards = [(r * shard_size, min((r + 1) * shard_size, num_examples)) for r in range(num_processes)]
+    shards = [shard for shard in shards if shard[0] < shard[1]]
+
+    prepare_workers(config, model)
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    whole_st_time = time.time()
+    procs = []
+    for rank, shard in enumerate(shards):
+        p = ctx.Process(target=evaluate_shard, args=(rank, worker_config, model, dataset, shard, result_queue))
+        p.start()
+        procs.append(p)
+    results = [None] * len(procs)
+    try:
+        for _ in range(len(procs)):
+            rank, preds, ys, stats = get_result(result_queue, procs)
+            results[rank] = (preds, ys, stats)
+    except RuntimeError:
+        for p in procs:
+            p.terminate()
+        raise
+    for p in procs:
+        p.join()
+    whole_time = float((time.time()-whole_st_time)*1000)
+
+    preds = np.concatenate([r[0] for r in results], axis=0)
+    ys = np.concatenate([r[1] for r in results], axis=0)
+    total_examples = 0
+    total_duration_time = 0.0
+    profiler = util_profile.get_profiler()
+    for rank, (_, _, stats) in enumerate(results):
+        if profiler and 'stage_stats' in stats:
+            profiler.merge(stats['stage_stats'], stats['stage_events'])
+        total_examples += stats['total_examples']
+        total_duration_time += stats['total_duration_time']
+        busy = stats['whole_time'] / whole_time
+        util = stats['cpu_time'] / max(1e-6, stats['whole_time'] * stats['num_threads'])
+        memory = stats['memory']
+        logger.info("[Worker {}] : shard {}, cores {}, threads {}, {} examples, {:.2f}ms, {:.2f} examples/sec, busy {:.2%}, cpu utilisation {:.2%}, rss {:.1f}MB, uss {:.1f}MB".\
+            format(rank, shards[rank], stats['cores'], stats['num_threads'], stats['total_examples'], stats['whole_time'],
+                   stats['total_examples'] / max(1e-6, stats['whole_time'] / 1000), busy, util, memory.get('rss', 0), memory.get('uss', 0)))
+    logger.info("[Throughput] : {} workers, {} examples, {:.2f}ms, {:.2f} examples/sec".\
+        format(len(results), total_examples, whole_time, total_examples / max(1e-6, whole_time / 1000)))
+    stats = {
+        'total_examples': total_examples,
+        'whole_time': whole_time,
+        'first_time': 0.0,
+        'first_examples': 0,
+        'total_duration_time': total_duration_time,
+    }
+    return preds, ys, stats
+
+def evaluate(opt):
+    # set config
+    st_time = time.time()
+    if opt.bundle_path:
+        # config, dicts and checkpoint from a single file
+        from bundle import load_bundle
+        config, checkpoint = load_bundle(opt)
+    else:
+        config = load_config(opt)
+        config['opt'] = opt
+    if opt.num_threads > 0: torch.set_num_threads(opt.num_threads)
+    logger.info("%s", {key: value for key, value in config.items() if key != 'bundle'})
+
+    # set path
+    set_path(config)
+
+    # prepare test dataset
+    test_loader = prepare_datasets(config)
+ 
+    # load pytorch model checkpoint
+    if not opt.bundle_path:
+        checkpoint = load_checkpoint(config)
+
+    # prepare model and load parameters
+    model = load_model(config, checkpoint)
+    model.eval()
+    logger.info("[Startup time] : {:.2f}ms, config, test data and model loaded".format((time.time() - st_time) * 1000))
+
+    # convert to onnx format
+    if opt.convert_onnx:
+        (x, y) = next(iter(test_loader))
+        x = to_device(x, opt.device)
+        y = to_device(y, opt.device)
+        convert_onnx(config, model, x)
+        check_onnx(config)
+        logger.info("[ONNX model saved at {}".format(opt.onnx_path))
+        # quantize onnx
+        if opt.quantize_onnx:
+            quantize_onnx(opt.onnx_path, opt.quantized_onnx_path)
+            logger.info("[Quantized ONNX model saved at {}".format(opt.quantized_onnx_path))
+        return
+
+    # latency and f1 of early-exit inference for each threshold
+    if opt.exit_thresholds:
+        evaluate_exit_thresholds(config, model, test_loader)
+        return
+
+    # per-stage profiling inside the model
+    if opt.stage_profile:
+        util_profile.enable(use_cuda=(opt.device != 'cpu'))
+
+    if opt.num_processes > 1:
+        # evaluation, sharded over multiple processes
+        preds, ys, stats = evaluate_sharded(config, model, test_loader.dataset)
+    else:
+        # load onnx model for using onnxruntime
+        ort_session = None
+        if opt.enable_ort:
+            ort_session = prepare_ort_session(config, model.label_size)
+
+        # enable to use dynamic quantized model (pytorch>=1.3.0)
+        if opt.enable_dqm and opt.device == 'cpu':
+            from torch.quantization import quantize_dynamic
+            model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            print(model)
+
+        # evaluation
+        preds, ys, stats = predict_loader(config, model, test_loader, ort_session=ort_session)
+        if ort_session:
+            logger.info("[ONNX Runtime per batch] : {}".format(ort_session.overhead()))
+    total_examples = stats['total_examples']
+    whole_time = stats['whole_time']
+    total_duration_time = stats['total_duration_time']
+    avg_time = (whole_time - stats['first_time']) / (total_examples - stats['first_examples'])
+    # compute measure using seqeval
+    labels = model.labels
+    ret = compute_measure(config, labels, ys, preds)
     print(ret['report'])
     f1 = ret['f1']
     # write predicted labels to file
+    pad_label_id = config['pad_label_id']
     default_label = config['default_label']
     write_prediction(opt, ys, preds, labels, pad_label_id, default_label)
 
     logger.info("[F1] : {}, {}".format(f1, total_examples))
     logger.info("[Elapsed Time] : {} examples, {}ms, {}ms on average".format(total_examples, whole_time, avg_time))
     logger.info("[Elapsed Time(total_duration_time, average)] : {}ms, {}ms".format(total_duration_time, total_duration_time/(total_examples-1)))
+    if opt.num_processes <= 1: report_char_cache(model)
+    report_stage_profile(opt)
+
+def evaluate_exit_thresholds(config, model, test_loader):
+    opt = config['opt']
+    thresholds = [0.0] + [float(t) for t in opt.exit_thresholds.split(',') if t.strip()]
+    if opt.enable_ort:
+        logger.info("[Early exit] --enable_ort is ignored, the onnx graph runs the full model")
+    if opt.enable_dqm and opt.device == 'cpu':
+        from torch.quantization import quantize_dynamic
+        model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    rows = []
+    for threshold in thresholds:
+        # 0 means the full model without early exit
+        opt.exit_threshold = threshold
+        config['exit_layers'] = []
+        preds, ys, stats = predict_loader(config, model, test_loader, verbose=False)
+        ret = compute_measure(config, model.labels, ys, preds)
+        avg_time = stats['whole_time'] / max(1, stats['total_examples'])
+        exit_layers = config['exit_layers'] or [model.bert_num_layers]
+        rows.append((threshold, ret['f1'], avg_time, sum(exit_layers) / len(exit_layers)))
+    logger.info("[Early exit] {} model, threshold | f1 | ms/example | speedup | avg exit layer".\
+        format('dynamic quantized' if opt.enable_dqm and opt.device == 'cpu' else 'pytorch'))
+    for threshold, f1, avg_time, avg_layer in rows:
+        logger.info("[Early exit] {:9.4f} | {:.4f} | {:10.3f} | {:6.2f}x | {:.2f}".\
+            format(threshold, f1, avg_time, rows[0][2] / max(1e-6, avg_time), avg_layer))
+
+def report_stage_profile(opt):
+    profiler = util_profile.get_profiler()
+    if not profiler: return
+    print(profiler.table())
+    if opt.stage_trace_path:
+        profiler.export_chrome_trace(opt.stage_trace_path)
+        logger.info("[Chrome trace saved at {}]".format(opt.stage_trace_path))
+
+def report_char_cache(model, rank=0):
+    caches = []
+    if hasattr(model, 'charcnn') and model.charcnn.cache is not None: caches.append(('char-CNN cache', model.charcnn.cache))
+    if getattr(model, 'token_cache', None) is not None: caches.append(('elmo token cache', model.token_cache))
+    for name, cache in caches:
+        stats = cache.stats()
+        logger.info("[{}] rank {} : hit rate {:.2f}%, {} hits, {} misses, size {} / {}".\
+            format(name, rank, stats['hit_rate'] * 100, stats['hits'], stats['misses'], stats['size'], stats['capacity']))
 
 # ---------------------------------------------------------------------------- #
 # Inference
@@ -358,15 +638,33 @@ def main():
     parser.add_argument('--config', type=str, default='configs/config-glove.json')
     parser.add_argument('--data_dir', type=str, default='data/conll2003')
     parser.add_argument('--model_path', type=str, default='pytorch-model-glove.pt')
+    parser.add_argument('--bundle_path', type=str, default='',
+                        help="Model bundle made by bundle.py, used instead of --config, --model_path and the files in --data_dir/--bert_output_dir.")
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--num_threads', type=int, default=0)
     parser.add_argument('--batch_size', type=int, default=1)
     parser.add_argument('--num_examples', default=0, type=int, help="Number of examples to evaluate, 0 means all of them.")
+    parser.add_argument('--char_cache_size', type=int, default=0,
+                        help="Capacity of the LRU cache of char-CNN word vectors, 0 means no cache.")
+    parser.add_argument('--max_tokens_per_batch', type=int, default=0,
+                        help="Pack examples in order into batches of at most this many padded tokens and trim padding, 0 means fixed --batch_size.")
+    # for sharded evaluation
+    parser.add_argument('--num_processes', type=int, default=1,
+                        help="Number of worker processes, each tags a contiguous shard of the data. 1 means single process.")
+    parser.add_argument('--cores_per_process', type=int, default=0,
+                        help="Number of cores each worker is pinned to, 0 means no pinning.")
+    parser.add_argument('--core_offset', type=int, default=0, help="First core id used for pinning workers.")
     parser.add_argument('--use_crf', action='store_true', help="Add CRF layer")
     parser.add_argument('--use_char_cnn', action='store_true', help="Add Character features")
     # for BERT
     parser.add_argument('--bert_output_dir', type=str, default='bert-checkpoint',
                         help="The output directory where the model predictions and checkpoints will be written.")
+    parser.add_argument('--bert_exit_layers', type=str, default='',
+                        help="Comma separated layers with exit heads, same as train.py.")
+    parser.add_argument('--exit_threshold', type=float, default=0,
+                        help="Stop a sentence at the first exit head whose confidence is over this value, 0 means no early exit.")
+    parser.add_argument('--exit_thresholds', type=str, default='',
+                        help="Comma separated thresholds to report latency and f1 of early exit, ex) 0.9,0.95,0.99.")
     parser.add_argument('--bert_use_feature_based', action='store_true',
                         help="Use BERT as feature-based, default fine-tuning")
     parser.add_argument('--bert_disable_lstm', action='store_true',
@@ -375,12 +673,25 @@ def main():
     # for ELMo
     parser.add_argument('--elmo_options_file', type=str, default='embeddings/elmo_2x4096_512_2048cnn_2xhighway_5.5B_options.json')
     parser.add_argument('--elmo_weights_file', type=str, default='embeddings/elmo_2x4096_512_2048cnn_2xhighway_5.5B_weights.hdf5')
+    parser.add_argument('--elmo_token_cache', action='store_true',
+                        help="Cache the elmo character encoder outputs per word, prebuilt from the training words.")
+    parser.add_argument('--elmo_token_cache_size', type=int, default=0,
+                        help="Max number of cached words for --elmo_token_cache, 0 means no limit.")
     # for ONNX
     parser.add_argument('--convert_onnx', action='store_true',
                         help="Set this flag to convert to onnx format.")
     parser.add_argument('--enable_ort', action='store_true',
                         help="Set this flag to evaluate using onnxruntime.")
     parser.add_argument('--onnx_path', type=str, default='pytorch-model.onnx')
+    parser.add_argument('--ort_providers', type=str, default='',
+                        help="Comma separated onnxruntime execution providers, ex) CUDAExecutionProvider,CPUExecutionProvider. default by onnxruntime.")
+    parser.add_argument('--ort_graph_optimization_level', type=str, default='all', choices=['disable', 'basic', 'extended', 'all'])
+    parser.add_argument('--ort_execution_mode', type=str, default='sequential', choices=['sequential', 'parallel'])
+    parser.add_argument('--ort_inter_op_num_threads', type=int, default=0, help="0 means same as --num_threads.")
+    parser.add_argument('--ort_optimized_model_path', type=str, default='',
+                        help="Path to save the optimized graph at the first run and to load it without re-optimizing later.")
+    parser.add_argument('--ort_disable_io_binding', action='store_true',
+                        help="Feed numpy arrays and copy outputs back instead of io binding.")
     parser.add_argument('--onnx_opset', default=11, type=int, help="ONNX opset version.")
     parser.add_argument('--quantize_onnx', action='store_true',
                         help="Set this flag to quantize ONNX.")
@@ -388,6 +699,11 @@ def main():
     # for Quantization
     parser.add_argument('--enable_dqm', action='store_true',
                         help="Set this flag to use dynamic quantized model.")
+    # for Profiling
+    parser.add_argument('--stage_profile', action='store_true',
+                        help="Set this flag to measure time and memory of each stage(embedding, encoder, crf, ...) in the model.")
+    parser.add_argument('--stage_trace_path', type=str, default='',
+                        help="Path to export the per-stage profile as a chrome trace(chrome://tracing), used with --stage_profile.")
 
     opt = parser.parse_args()
 
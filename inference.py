@@ -0,0 +1,601 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+import os
+import argparse
+import time
+import pdb
+import logging
+import threading
+import queue
+import io
+from collections import defaultdict
+
+# cold start is measured from here, see inference()
+START_TIME = time.time()
+
+import torch
+import numpy as np
+
+from util import load_config, to_device, to_numpy, get_memory_usage
+from evaluate import set_path, load_checkpoint, load_model, prepare_ort_session, predict_batch, report_stage_profile, report_char_cache, get_shard_cores, get_result, \
+                     prepare_workers, prepare_worker
+import util_profile
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ---------------------------------------------------------------------------- #
+# Reader
+# ---------------------------------------------------------------------------- #
+
+def read_sentences(f, input_format='conll'):
+    """Yield sentences as list of entries(list of columns) without holding the whole stream.
+
+    Args:
+      input_format: conll | text.
+        conll : 'word pos chunk label' per line, sentences separated by a blank line.
+        text  : one whitespace-tokenized sentence per line.
+    """
+    bucket = []
+    for line in f:
+        line = line.strip()
+        if input_format == 'text':
+            if line == "": continue
+            yield [[token] for token in line.split()]
+            continue
+        if line == "":
+            if len(bucket) != 0: yield bucket
+            bucket = []
+        else:
+            bucket.append(line.split())
+    if len(bucket) != 0:
+        yield bucket
+
+def load_key_to_id(input_path):
+    dic = {}
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            toks = line.strip().split()
+            dic[toks[0]] = int(toks[1])
+    return dic
+
+def invert(id_to_key):
+    # id -> key dict of a bundle to key -> id, same as load_key_to_id()
+    return {key: _id for _id, key in id_to_key.items()}
+
+# ---------------------------------------------------------------------------- #
+# Converter
+# ---------------------------------------------------------------------------- #
+
+def split_windows(lengths, budget, overlap):
+    """Split words into windows [(begin, end), ...] of at most budget model tokens,
+    consecutive windows share up to overlap words.
+
+    Args:
+      lengths: number of model tokens of each word, ex) 1 for glove, number of sub-tokens for bert.
+    """
+    spans = []
+    begin = 0
+    while True:
+        end = begin
+        total = 0
+        # at least one word, a single word longer than budget is truncated by the converter
+        while end < len(lengths) and (total + lengths[end] <= budget or end == begin):
+            total += lengths[end]
+            end += 1
+        spans.append((begin, end))
+        if end >= len(lengths): break
+        begin = max(begin + 1, end - overlap)
+    return spans
+
+def merge_windows(num_words, windows, preds):
+    """Label ids of the words, from the window where the word is farthest from a cut, None for words without prediction.
+    """
+    label_ids = [None] * num_words
+    best = [-1] * num_words
+    for (_, word_positions, begin, end), pred in zip(windows, preds):
+        for k, position in enumerate(word_positions):
+            if position is None or position >= len(pred): continue
+            i = begin + k
+            # document boundaries are not cuts
+            left = i - begin if begin > 0 else num_words
+            right = end - 1 - i if end < num_words else num_words
+            if min(left, right) > best[i]:
+                best[i] = min(left, right)
+                label_ids[i] = pred[position]
+    return label_ids
+
+class SentenceConverter():
+    """Convert a sentence to the model inputs on the fly, same as preprocess.py does for the whole file.
+
+    returns a list of windows (x, word_positions, begin, end), a single window truncated to n_ctx
+    unless --sliding_window is set.
+    """
+
+    def __init__(self, config, model):
+        opt = config['opt']
+        self.config = config
+        self.emb_class = config['emb_class']
+        self.pad_label_id = config['pad_label_id']
+        pad_pos_id = config['pad_pos_id']
+        bundle = config.get('bundle')
+        self.poss = defaultdict(lambda: pad_pos_id)
+        self.poss.update(invert(bundle['poss']) if bundle else load_key_to_id(opt.pos_path))
+        if self.emb_class in ['glove', 'elmo']:
+            from tokenizer import Tokenizer
+            vocab = invert(bundle['vocab']) if bundle else load_key_to_id(opt.vocab_path)
+            self.tokenizer = Tokenizer(vocab, config)
+        else:
+            self.tokenizer = model.bert_tokenizer
+            # every word is labeled by default label, only to mark the first sub-token of each word.
+            self.labels = {config['default_label']: self.pad_label_id + 1}
+
+    def __call__(self, entries):
+        opt = self.config['opt']
+        words = [entry[0] for entry in entries]
+        poss = [entry[1] if len(entry) > 1 else self.config['pad_pos'] for entry in entries]
+        if self.emb_class in ['glove', 'elmo']:
+            lengths = [1] * len(words)
+            budget = self.config['n_ctx']
+            convert = self.__convert_glove
+        else:
+            lengths = [len(self.tokenizer.tokenize(word)) for word in words]
+            # [CLS], [SEP] and the extra [SEP] of RoBERTa
+            budget = self.config['n_ctx'] - (3 if self.emb_class in ['roberta'] else 2)
+            convert = self.__convert_bert
+        if opt.sliding_window: spans = split_windows(lengths, budget, opt.window_overlap)
+        else: spans = [(0, len(words))]
+        windows = []
+        for begin, end in spans:
+            x, word_positions = convert(words[begin:end], poss[begin:end], lengths[begin:end])
+            windows.append((x, word_positions, begin, end))
+        return windows
+
+    def __convert_glove(self, words, poss, lengths):
+        config = self.config
+        n_ctx = config['n_ctx']
+        token_ids = self.tokenizer.convert_tokens_to_ids(words)
+        pos_ids = [self.poss[pos] for pos in poss][:n_ctx]
+        pos_ids += [config['pad_pos_id']] * (n_ctx - len(pos_ids))
+        char_ids = self.tokenizer.convert_tokens_to_cids(words[:n_ctx])
+        x = [torch.tensor(token_ids, dtype=torch.long),
+             torch.tensor(pos_ids, dtype=torch.long),
+             torch.tensor(char_ids, dtype=torch.long)]
+        # word_positions : position of each word in the model input
+        word_positions = list(range(min(len(words), n_ctx)))
+        return x, word_positions
+
+    def __convert_bert(self, words, poss, lengths):
+        from util_bert import InputExample, convert_single_example_to_feature
+        config = self.config
+        tokenizer = self.tokenizer
+        example = InputExample(guid='stream', words=words, poss=poss, labels=[config['default_label']] * len(words))
+        feature = convert_single_example_to_feature(example, self.poss, self.labels, config['n_ctx'], tokenizer,
+                                                    cls_token=tokenizer.cls_token,
+                                                    cls_token_segment_id=0,
+                                                    sep_token=tokenizer.sep_token,
+                                                    sep_token_extra=bool(config['emb_class'] in ['roberta']),
+                                                    pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+                                                    pad_token_pos_id=config['pad_pos_id'],
+                                                    pad_token_label_id=self.pad_label_id,
+                                                    pad_token_segment_id=0,
+                                                    sequence_a_segment_id=0)
+        x = [torch.tensor(feature.input_ids, dtype=torch.long),
+             torch.tensor(feature.input_mask, dtype=torch.long),
+             torch.tensor(feature.segment_ids, dtype=torch.long),
+             torch.tensor(feature.pos_ids, dtype=torch.long)]
+        # word_positions : position of the first sub-token of each word, None for the words without sub-token or truncated
+        starts = iter([j for j, label_id in enumerate(feature.label_ids) if label_id != self.pad_label_id])
+        word_positions = [next(starts, None) if length > 0 else None for length in lengths]
+        return x, word_positions
+
+# ---------------------------------------------------------------------------- #
+# Streaming
+# ---------------------------------------------------------------------------- #
+
+_END_OF_STREAM = None
+
+def produce(f, input_format, converter, read_queue):
+    # read and convert ahead of the model, bounded by read_queue.maxsize
+    # an error is put in place of the end of stream and raised by the consumer, a failed read must not look like the end of input.
+    try:
+        for entries in read_sentences(f, input_format=input_format):
+            read_queue.put((entries, converter(entries)))
+    except Exception as e:
+        read_queue.put(e)
+    else:
+        read_queue.put(_END_OF_STREAM)
+
+def write_batch(fout, docs, docs_label_ids, labels, default_label):
+    for (entries, _), label_ids in zip(docs, docs_label_ids):
+        for entry, label_id in zip(entries, label_ids):
+            pred_label = default_label if label_id is None else labels[label_id]
+            fout.write(' '.join(entry + [pred_label]) + '\n')
+        fout.write('\n')
+    fout.flush()
+
+def get_length(config, x, word_positions):
+    # number of model input positions used by the window
+    if config['emb_class'] in ['glove', 'elmo']: return max(1, len(word_positions))
+    return int(x[1].sum()) # input_mask
+
+def make_batches(config, windows):
+    # split windows into batches of --batch_size, flushed earlier by --max_tokens_per_batch
+    opt = config['opt']
+    batches = []
+    batch = []
+    max_len = 0
+    for window in windows:
+        length = get_length(config, window[0], window[1])
+        if batch and (len(batch) >= opt.batch_size or \
+           (opt.max_tokens_per_batch > 0 and (len(batch) + 1) * max(max_len, length) > opt.max_tokens_per_batch)):
+            batches.append(batch)
+            batch = []
+            max_len = 0
+        batch.append(window)
+        max_len = max(max_len, length)
+    if batch: batches.append(batch)
+    return batches
+
+def tag_batch(config, model, batch, ort_session=None):
+    # batch : list of windows (x, word_positions, begin, end)
+    opt = config['opt']
+    x = [torch.stack([window[0][k] for window in batch]) for k in range(len(batch[0][0]))]
+    if opt.max_tokens_per_batch > 0:
+        # trim padding beyond the longest window in the batch
+        seq_size = config['n_ctx']
+        max_len = max(get_length(config, window[0], window[1]) for window in batch)
+        x = [t[:, :max_len].contiguous() if t.shape[1] == seq_size else t for t in x]
+    word_mask = None
+    if getattr(opt, 'exit_threshold', 0) > 0:
+        # early exit decides over the first sub-tokens of the words only
+        word_mask = torch.zeros(x[0].shape, dtype=torch.bool)
+        for i, window in enumerate(batch):
+            positions = [position for position in window[1] if position is not None and position < x[0].shape[1]]
+            word_mask[i, positions] = True
+    x = to_device(x, opt.device)
+    if word_mask is not None: word_mask = word_mask.to(opt.device)
+    logits, prediction = predict_batch(config, model, x, ort_session=ort_session, word_mask=word_mask)
+    if opt.use_crf: return to_numpy(prediction)
+    return np.argmax(to_numpy(logits), axis=2)
+
+def tag_docs(config, model, docs, ort_session=None, window_stats=None):
+    # docs : list of (entries, windows), windows of many documents are batched together
+    windows = [window for _, doc_windows in docs for window in doc_windows]
+    preds = []
+    for batch in make_batches(config, windows):
+        preds.extend(tag_batch(config, model, batch, ort_session=ort_session))
+    docs_label_ids = []
+    offset = 0
+    for entries, doc_windows in docs:
+        docs_label_ids.append(merge_windows(len(entries), doc_windows, preds[offset:offset+len(doc_windows)]))
+        offset += len(doc_windows)
+        if window_stats is not None: update_window_stats(config, window_stats, entries, doc_windows)
+    return docs_label_ids
+
+def update_window_stats(config, stats, entries, windows):
+    # compare with plain truncation, which runs the first window only
+    lengths = [get_length(config, window[0], window[1]) for window in windows]
+    stats['windows'] += len(windows)
+    stats['tokens'] += sum(lengths)
+    stats['truncated_tokens'] += lengths[0]
+    if len(windows) > 1:
+        stats['long_docs'] += 1
+        stats['recovered_words'] += len(entries) - windows[0][3]
+
+def report_window_stats(stats, total_examples):
+    overhead = stats['tokens'] / max(1, stats['truncated_tokens']) - 1
+    logger.info("[Sliding window] : {} documents, {} longer than n_ctx, {} windows | {} tokens vs {} with truncation, overhead {:+.2f}% | {} words tagged beyond truncation".\
+        format(total_examples, stats['long_docs'], stats['windows'], stats['tokens'], stats['truncated_tokens'], overhead * 100, stats['recovered_words']))
+
+# ---------------------------------------------------------------------------- #
+# Serving with multiple worker processes
+# ---------------------------------------------------------------------------- #
+
+def serve_worker(rank, config, model, task_queue, result_queue):
+    opt = config['opt']
+    model, ort_session = prepare_worker(rank, config, model)
+    cores = get_shard_cores(rank, opt)
+
+    converter = SentenceConverter(config, model)
+    labels = model.labels
+    default_label = config['default_label']
+    stats = {'total_examples': 0, 'busy_time': 0.0}
+    window_stats = {'long_docs': 0, 'windows': 0, 'tokens': 0, 'truncated_tokens': 0, 'recovered_words': 0}
+    cpu_st_time = time.process_time()
+    with torch.no_grad():
+        while True:
+            item = task_queue.get()
+            if item is _END_OF_STREAM: break
+            chunk_id, docs_entries = item
+            st_time = time.time()
+            docs = [(entries, converter(entries)) for entries in docs_entries]
+            docs_label_ids = tag_docs(config, model, docs, ort_session=ort_session, window_stats=window_stats if opt.sliding_window else None)
+            fout = io.StringIO()
+            write_batch(fout, docs, docs_label_ids, labels, default_label)
+            stats['busy_time'] += float((time.time()-st_time)*1000)
+            stats['total_examples'] += len(docs)
+            result_queue.put((chunk_id, fout.getvalue()))
+    stats['cpu_time'] = float((time.process_time()-cpu_st_time)*1000)
+    stats['num_threads'] = torch.get_num_threads()
+    stats['cores'] = cores
+    stats['memory'] = get_memory_usage()
+    stats['window_stats'] = window_stats
+    if ort_session: stats['ort'] = ort_session.overhead()
+    profiler = util_profile.disable()
+    if profiler:
+        stats['stage_stats'] = profiler.stats
+        stats['stage_events'] = profiler.events
+    report_char_cache(model, rank=rank)
+    result_queue.put((_END_OF_STREAM, rank, stats))
+
+def write_results(fout, result_queue, procs, results, errors):
+    # write the tagged chunks in the input order, collect the stats of the workers into results
+    # stops when a worker died, the error is kept in errors for serve()
+    pending = {}
+    next_id = 0
+    while len(results) < len(procs):
+        try:
+            item = get_result(result_queue, procs)
+        except RuntimeError as e:
+            errors.append(e)
+            break
+        if item[0] is _END_OF_STREAM:
+            results[item[1]] = item[2]
+            continue
+        chunk_id, text = item
+        pending[chunk_id] = text
+        while next_id in pending:
+            fout.write(pending.pop(next_id))
+            next_id += 1
+    fout.flush()
+
+def put_task(task_queue, item, writer, timeout=1.0):
+    # False when the writer stopped, the queue may never be drained by dead workers
+    while writer.is_alive():
+        try:
+            task_queue.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def serve(config, model):
+    """Tag the input stream with opt.num_processes workers, the weights are placed in shared memory once and attached read-only.
+
+    chunks of --batch_size sentences are read by this process and tagged by any idle worker, the outputs are written in the input order.
+    """
+    opt = config['opt']
+    import torch.multiprocessing as mp
+
+    if opt.stage_profile:
+        util_profile.enable(use_cuda=(opt.device != 'cpu'))
+
+    prepare_workers(config, model)
+    # every worker builds its own converter, pass only the dicts of a bundle, not the weights again
+    worker_config = {key: value for key, value in config.items() if key != 'bundle'}
+    if config.get('bundle'):
+        worker_config['bundle'] = {key: config['bundle'][key] for key in ['poss', 'vocab'] if key in config['bundle']}
+    ctx = mp.get_context('spawn')
+    task_queue = ctx.Queue(maxsize=opt.queue_size)
+    result_queue = ctx.Queue()
+    procs = []
+    for rank in range(opt.num_processes):
+        p = ctx.Process(target=serve_worker, args=(rank, worker_config, model, task_queue, result_queue))
+        p.start()
+        procs.append(p)
+
+    fin = sys.stdin if opt.input_path == '-' else open(opt.input_path, 'r', encoding='utf-8')
+    fout = sys.stdout if opt.output_path == '-' else open(opt.output_path, 'w', encoding='utf-8')
+    results = {}
+    errors = []
+    writer = threading.Thread(target=write_results, args=(fout, result_queue, procs, results, errors), daemon=True)
+    writer.start()
+    st_time = time.time()
+    num_chunks = 0
+    chunk = []
+    for entries in read_sentences(fin, input_format=opt.input_format):
+        chunk.append(entries)
+        if len(chunk) >= opt.batch_size:
+            if not put_task(task_queue, (num_chunks, chunk), writer): break
+            num_chunks += 1
+            chunk = []
+    if chunk: put_task(task_queue, (num_chunks, chunk), writer)
+    for _ in procs:
+        put_task(task_queue, _END_OF_STREAM, writer)
+    writer.join()
+    if errors:
+        # the tasks left in the queue are dropped, abort with a non-zero exit status
+        task_queue.cancel_join_thread()
+        for p in procs:
+            p.terminate()
+        raise errors[0]
+    for p in procs:
+        p.join()
+    whole_time = float((time.time()-st_time)*1000)
+    if fin is not sys.stdin: fin.close()
+    if fout is not sys.stdout: fout.close()
+
+    total_examples = 0
+    window_stats = defaultdict(int)
+    profiler = util_profile.get_profiler()
+    for rank in range(len(procs)):
+        stats = results[rank]
+        if profiler and 'stage_stats' in stats:
+            profiler.merge(stats['stage_stats'], stats['stage_events'])
+        for key, value in stats['window_stats'].items(): window_stats[key] += value
+        total_examples += stats['total_examples']
+        memory = stats['memory']
+        logger.info("[Worker {}] : cores {}, threads {}, {} examples, {:.2f} examples/sec, busy {:.2%}, cpu utilisation {:.2%}, rss {:.1f}MB, pss {:.1f}MB, uss {:.1f}MB".\
+            format(rank, stats['cores'], stats['num_threads'], stats['total_examples'],
+                   stats['total_examples'] / max(1e-6, stats['busy_time'] / 1000), stats['busy_time'] / max(1e-6, whole_time),
+                   stats['cpu_time'] / max(1e-6, whole_time * stats['num_threads']),
+                   memory.get('rss', 0), memory.get('pss', 0), memory.get('uss', 0)))
+        if 'ort' in stats: logger.info("[Worker {}] ONNX Runtime per batch : {}".format(rank, stats['ort']))
+    memory = get_memory_usage()
+    logger.info("[Throughput] : {} workers, {} examples, {:.2f}ms, {:.2f} examples/sec | parent rss {:.1f}MB(shared weights)".\
+        format(len(procs), total_examples, whole_time, total_examples / max(1e-6, whole_time / 1000), memory.get('rss', 0)))
+    if opt.sliding_window: report_window_stats(window_stats, total_examples)
+    report_stage_profile(opt)
+
+def inference(opt):
+    import_time = float((time.time()-START_TIME)*1000)
+    # set config
+    if opt.bundle_path:
+        # config, dicts and checkpoint from a single file
+        from bundle import load_bundle
+        config, checkpoint = load_bundle(opt)
+    else:
+        config = load_config(opt)
+        config['opt'] = opt
+    if opt.num_threads > 0: torch.set_num_threads(opt.num_threads)
+    logger.info("%s", {key: value for key, value in config.items() if key != 'bundle'})
+
+    # set path
+    set_path(config)
+
+    # prepare model and load parameters
+    if not opt.bundle_path:
+        checkpoint = load_checkpoint(config)
+    model = load_model(config, checkpoint)
+    del checkpoint
+    model.eval()
+    load_time = float((time.time()-START_TIME)*1000) - import_time
+    if opt.num_processes > 1:
+        # worker processes share the weights of this process
+        serve(config, model)
+        return
+    ort_session = None
+    if opt.enable_ort:
+        ort_session = prepare_ort_session(config, model.label_size)
+    if opt.enable_dqm and opt.device == 'cpu':
+        from torch.quantization import quantize_dynamic
+        model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if opt.stage_profile:
+        util_profile.enable(use_cuda=(opt.device != 'cpu'))
+
+    converter = SentenceConverter(config, model)
+    labels = model.labels
+    default_label = config['default_label']
+
+    fin = sys.stdin if opt.input_path == '-' else open(opt.input_path, 'r', encoding='utf-8')
+    fout = sys.stdout if opt.output_path == '-' else open(opt.output_path, 'w', encoding='utf-8')
+    read_queue = queue.Queue(maxsize=opt.queue_size)
+    producer = threading.Thread(target=produce, args=(fin, opt.input_format, converter, read_queue), daemon=True)
+    producer.start()
+
+    total_examples = 0
+    window_stats = {'long_docs': 0, 'windows': 0, 'tokens': 0, 'truncated_tokens': 0, 'recovered_words': 0}
+    first_time = None
+    st_time = time.time()
+    with torch.no_grad():
+        done = False
+        while not done:
+            # windows of many documents are batched together
+            docs = []
+            num_windows = 0
+            while num_windows < opt.batch_size:
+                item = read_queue.get()
+                if isinstance(item, Exception): raise item
+                if item is _END_OF_STREAM:
+                    done = True
+                    break
+                docs.append(item)
+                num_windows += len(item[1])
+            if len(docs) == 0: break
+            docs_label_ids = tag_docs(config, model, docs, ort_session=ort_session, window_stats=window_stats if opt.sliding_window else None)
+            if first_time is None: first_time = float((time.time()-START_TIME)*1000)
+            write_batch(fout, docs, docs_label_ids, labels, default_label)
+            total_examples += len(docs)
+    producer.join()
+    if fin is not sys.stdin: fin.close()
+    if fout is not sys.stdout: fout.close()
+    whole_time = float((time.time()-st_time)*1000)
+    logger.info("[Elapsed Time] : {} examples, {}ms, {}ms on average".format(total_examples, whole_time, whole_time/max(1, total_examples)))
+    if first_time is not None:
+        logger.info("[Cold start] : {:.2f}ms to the first prediction, imports {:.2f}ms, config and model loading {:.2f}ms".\
+            format(first_time, import_time, load_time))
+    if ort_session:
+        logger.info("[ONNX Runtime per batch] : {}".format(ort_session.overhead()))
+    if opt.sliding_window: report_window_stats(window_stats, total_examples)
+    report_char_cache(model)
+    report_stage_profile(opt)
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--config', type=str, default='configs/config-glove.json')
+    parser.add_argument('--data_dir', type=str, default='data/conll2003')
+    parser.add_argument('--model_path', type=str, default='pytorch-model-glove.pt')
+    parser.add_argument('--bundle_path', type=str, default='',
+                        help="Model bundle made by bundle.py, used instead of --config, --model_path and the files in --data_dir/--bert_output_dir.")
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--num_threads', type=int, default=0)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--char_cache_size', type=int, default=0,
+                        help="Capacity of the LRU cache of char-CNN word vectors, 0 means no cache.")
+    parser.add_argument('--max_tokens_per_batch', type=int, default=0,
+                        help="Flush a batch before it exceeds this many padded tokens and trim padding, 0 means fixed --batch_size.")
+    parser.add_argument('--use_crf', action='store_true', help="Add CRF layer")
+    parser.add_argument('--use_char_cnn', action='store_true', help="Add Character features")
+    # for streaming
+    parser.add_argument('--input_path', type=str, default='-', help="Input file, '-' means stdin.")
+    parser.add_argument('--output_path', type=str, default='-', help="Output file, '-' means stdout.")
+    parser.add_argument('--input_format', type=str, default='conll', choices=['conll', 'text'],
+                        help="conll : CoNLL columns, blank line between sentences. text : one whitespace-tokenized sentence per line.")
+    parser.add_argument('--queue_size', type=int, default=256, help="Max number of converted sentences(chunks with --num_processes) to read ahead.")
+    # for serving with multiple processes
+    parser.add_argument('--num_processes', type=int, default=1,
+                        help="Number of worker processes sharing the weights in shared memory, each tags chunks of --batch_size sentences. 1 means single process.")
+    parser.add_argument('--cores_per_process', type=int, default=0,
+                        help="Number of cores each worker is pinned to, 0 means no pinning.")
+    parser.add_argument('--core_offset', type=int, default=0, help="First core id used for pinning workers.")
+    parser.add_argument('--sliding_window', action='store_true',
+                        help="Tag sentences longer than n_ctx with overlapping windows instead of truncating them.")
+    parser.add_argument('--window_overlap', type=int, default=16,
+                        help="Number of words shared by consecutive windows, used with --sliding_window.")
+    # for BERT
+    parser.add_argument('--bert_output_dir', type=str, default='bert-checkpoint',
+                        help="The output directory where the model predictions and checkpoints will be written.")
+    parser.add_argument('--bert_exit_layers', type=str, default='',
+                        help="Comma separated layers with exit heads, same as train.py.")
+    parser.add_argument('--exit_threshold', type=float, default=0,
+                        help="Stop a sentence at the first exit head whose confidence is over this value, 0 means no early exit.")
+    parser.add_argument('--bert_use_feature_based', action='store_true',
+                        help="Use BERT as feature-based, default fine-tuning")
+    parser.add_argument('--bert_disable_lstm', action='store_true',
+                        help="Disable lstm layer")
+    parser.add_argument('--bert_use_pos', action='store_true', help="Add Part-Of-Speech features")
+    # for ELMo
+    parser.add_argument('--elmo_options_file', type=str, default='embeddings/elmo_2x4096_512_2048cnn_2xhighway_5.5B_options.json')
+    parser.add_argument('--elmo_weights_file', type=str, default='embeddings/elmo_2x4096_512_2048cnn_2xhighway_5.5B_weights.hdf5')
+    # for ONNX
+    parser.add_argument('--enable_ort', action='store_true',
+                        help="Set this flag to tag using onnxruntime.")
+    parser.add_argument('--onnx_path', type=str, default='pytorch-model.onnx')
+    parser.add_argument('--ort_providers', type=str, default='',
+                        help="Comma separated onnxruntime execution providers, ex) CUDAExecutionProvider,CPUExecutionProvider. default by onnxruntime.")
+    parser.add_argument('--ort_graph_optimization_level', type=str, default='all', choices=['disable', 'basic', 'extended', 'all'])
+    parser.add_argument('--ort_execution_mode', type=str, default='sequential', choices=['sequential', 'parallel'])
+    parser.add_argument('--ort_inter_op_num_threads', type=int, default=0, help="0 means same as --num_threads.")
+    parser.add_argument('--ort_optimized_model_path', type=str, default='',
+                        help="Path to save the optimized graph at the first run and to load it without re-optimizing later.")
+    parser.add_argument('--ort_disable_io_binding', action='store_true',
+                        help="Feed numpy arrays and copy outputs back instead of io binding.")
+    # for Quantization
+    parser.add_argument('--enable_dqm', action='store_true',
+                        help="Set this flag to use dynamic quantized model.")
+    # for Profiling
+    parser.add_argument('--stage_profile', action='store_true',
+                        help="Set this flag to measure time and memory of each stage(embedding, encoder, crf, ...) in the model.")
+    parser.add_argument('--stage_trace_path', type=str, default='',
+                        help="Path to export the per-stage profile as a chrome trace(chrome://tracing), used with --stage_profile.")
+
+    opt = parser.parse_args()
+
+    inference(opt)
+
+if __name__ == '__main__':
+    main()
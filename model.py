@@ -6,16 +6,77 @@ import pdb
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from torch.cuda.amp import autocast
 import numpy as np
 import random
+from collections import OrderedDict
 
 from torchcrf import CRF
+from util_profile import stage
+
+def is_autocast_enabled(device_type):
+    # torch.is_autocast_enabled() without device_type is for cuda only
+    try:
+        return torch.is_autocast_enabled(device_type)
+    except TypeError:
+        if device_type == 'cpu': return getattr(torch, 'is_autocast_cpu_enabled', lambda: False)()
+        return torch.is_autocast_enabled()
+
+def autocast_disabled(device_type):
+    # torch.cuda.amp.autocast(enabled=False) leaves cpu autocast on
+    if hasattr(torch, 'autocast'): return torch.autocast(device_type, enabled=False)
+    return autocast(enabled=False)
+
+def checkpointed_call(fn, *args, **kwargs):
+    """Call fn without storing its intermediate activations, they are recomputed in backward.
+
+    non-reentrant checkpoint works with DistributedDataParallel(find_unused_parameters) and inputs without grad,
+    ex) frozen embedding. it saves and restores the autocast state for the recomputation itself.
+    """
+    return checkpoint(fn, *args, use_reentrant=False, **kwargs)
+
+def enable_checkpointing(module):
+    """Recompute the activations of module in backward while training.
+
+    forward is wrapped on the instance, so the parameter names(saved checkpoints) are not changed.
+    """
+    forward = module.forward
+    def checkpointed_forward(*args, **kwargs):
+        if module.use_checkpointing and module.training and torch.is_grad_enabled():
+            return checkpointed_call(forward, *args, **kwargs)
+        return forward(*args, **kwargs)
+    module.forward = checkpointed_forward
+    module.use_checkpointing = True
+
+class SavedTensorsCounter():
+    """Count the bytes of activations saved for backward in the with block, the memory checkpointing saves on any device.
+
+    parameters are not counted, tensors saved more than once are counted each time.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+
+    def __pack(self, tensor):
+        if not isinstance(tensor, nn.Parameter): self.bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def __enter__(self):
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.__pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
 
 class BaseModel(nn.Module):
     def __init__(self, config=None):
         super(BaseModel, self).__init__()
         if config and hasattr(config['opt'], 'seed'):
             self.set_seed(config['opt'])
+        # recompute lstm activations in backward, see encode_lstm()
+        self.use_lstm_checkpointing = False
 
     def set_seed(self, opt):
         random.seed(opt.seed)
@@ -24,19 +85,26 @@ class BaseModel(nn.Module):
         torch.cuda.manual_seed(opt.seed)
 
     def load_embedding(self, input_path):
+        # already loaded weights are used as they are, ex) from a model bundle(bundle.py)
+        if torch.is_tensor(input_path): return input_path
         weights_matrix = np.load(input_path)
         weights_matrix = torch.as_tensor(weights_matrix)
         return weights_matrix
 
-    def create_embedding_layer(self, vocab_dim, emb_dim, weights_matrix=None, non_trainable=True, padding_idx=0):
-        emb_layer = nn.Embedding(vocab_dim, emb_dim, padding_idx=padding_idx)
+    def create_embedding_layer(self, vocab_dim, emb_dim, weights_matrix=None, non_trainable=True, padding_idx=0, sparse=False):
+        # sparse : gradients only for the rows in a batch, see prepare_osws() in train.py
         if torch.is_tensor(weights_matrix):
-            emb_layer.load_state_dict({'weight': weights_matrix})
+            # wrap the weights without random initialization and copy
+            emb_layer = nn.Embedding(vocab_dim, emb_dim, padding_idx=padding_idx, sparse=sparse, _weight=weights_matrix.to(torch.float))
+        else:
+            emb_layer = nn.Embedding(vocab_dim, emb_dim, padding_idx=padding_idx, sparse=sparse)
         if non_trainable:
             emb_layer.weight.requires_grad = False
         return emb_layer
 
     def load_dict(self, input_path):
+        # id -> key, a dict is used as it is, ex) from a model bundle(bundle.py)
+        if isinstance(input_path, dict): return input_path
         dic = {}
         with open(input_path, 'r', encoding='utf-8') as f:
             for idx, line in enumerate(f):
@@ -46,6 +114,31 @@ class BaseModel(nn.Module):
                 dic[_id] = _key
         return dic
 
+    def encode_lstm(self, embed_out, lengths):
+        # embed_out : [batch_size, seq_size, emb_dim]
+        def run(embed_out, lengths):
+            packed_embed_out = torch.nn.utils.rnn.pack_padded_sequence(embed_out, lengths, batch_first=True, enforce_sorted=False)
+            lstm_out, (h_n, c_n) = self.lstm(packed_embed_out)
+            lstm_out, _ = torch.nn.utils.rnn.pad_packed_sequence(lstm_out, batch_first=True, total_length=embed_out.shape[1])
+            return lstm_out
+        if self.use_lstm_checkpointing and self.training and torch.is_grad_enabled():
+            lstm_out = checkpointed_call(run, embed_out, lengths)
+        else:
+            lstm_out = run(embed_out, lengths)
+        # lstm_out : [batch_size, seq_size, lstm_hidden_dim*2]
+        return lstm_out
+
+    def decode_crf(self, logits, mask):
+        # padding is masked out, its emissions(which differ with trimmed batches and pooling) must not move the best path.
+        # logits : [batch_size, seq_size, label_size], mask : [batch_size, seq_size]
+        with stage('crf.decode'):
+            tags = self.crf.decode(logits, mask=mask.bool())
+        prediction = torch.full(logits.shape[:2], self.config['pad_label_id'], dtype=torch.long)
+        for i, seq_tags in enumerate(tags):
+            prediction[i, :len(seq_tags)] = torch.as_tensor(seq_tags, dtype=torch.long)
+        # prediction : [batch_size, seq_size], pad_label_id for the padding
+        return prediction
+
     def forward(self, x):
         return x
 
@@ -99,6 +192,59 @@ class DenseNet(nn.Module):
         padding = (ks - 1)//2
         self.conv_last = nn.Conv1d(in_channels=in_channels, out_channels=out_channels, kernel_size=ks, padding=padding)
         self.last_dim = last_num_filters
+        # recompute the activations of each branch(densenet width) in backward
+        self.use_checkpointing = False
+
+    def __branch(self, j, x, masks):
+        conv_results = []
+        for i, kss in enumerate(self.densenet_kernels):
+            if i == 0: conv_in = x
+            else: conv_in  = torch.cat(conv_results, dim=-2)
+            conv_out = self.densenet_block[i][j](conv_in)
+            # conv_out first : [batch_size, first_num_filters, seq_size]
+            # conv_out other : [batch_size, num_filters, seq_size]
+            conv_out *= masks # masking, auto broadcasting along with second dimension
+            conv_out = self.activation(conv_out)
+            conv_results.append(conv_out)
+        return conv_results[-1] # last one only
+
+    def __activation_(self, t):
+        if self.activation in [F.relu, torch.relu]: return t.relu_()
+        return t.copy_(self.activation(t))
+
+    def __branch_into(self, j, x, masks, buf, out):
+        # same as __branch(), but every block writes its masked and activated output into a slice of buf
+        # and the next block convolves over the growing view buf[:, :offset], the last block writes into out.
+        # buf : [batch_size, first_num_filters + num_filters * (depth-2), seq_size]
+        # out : [batch_size, num_filters, seq_size]
+        depth = len(self.densenet_kernels)
+        offset = 0
+        for i in range(depth):
+            if i == 0: conv_in = x
+            else: conv_in = buf[:, :offset]
+            conv_out = self.densenet_block[i][j](conv_in)
+            if i == depth - 1: dst = out
+            else: dst = buf[:, offset:offset+conv_out.shape[1]]
+            torch.mul(conv_out, masks, out=dst)
+            self.__activation_(dst)
+            offset += conv_out.shape[1]
+
+    def __forward_into(self, x, masks):
+        # no autograd: in-place writes into the buffers would invalidate the inputs saved for backward.
+        batch_size, emb_dim, seq_size = x.shape
+        last_convs = [self.densenet_block[-1][j] for j in range(self.densenet_width)]
+        merged = x.new_empty(batch_size, emb_dim + sum(conv.out_channels for conv in last_convs), seq_size)
+        # merged : [batch_size, emb_dim + num_filters * densenet_width, seq_size]
+        merged[:, :emb_dim].copy_(x)
+        buf = None
+        if len(self.densenet_kernels) > 1:
+            buf = x.new_empty(batch_size, last_convs[0].in_channels, seq_size)
+        offset = emb_dim
+        for j, conv in enumerate(last_convs):
+            # buf is reused across the width columns, only the last output of each column is kept
+            self.__branch_into(j, x, masks, buf, merged[:, offset:offset+conv.out_channels])
+            offset += conv.out_channels
+        return merged
 
     def forward(self, x, mask):
         # x     : [batch_size, seq_size, emb_dim]
@@ -110,21 +256,18 @@ class DenseNet(nn.Module):
         masks = masks.permute(0, 2, 1)
         # masks : [batch_size, 1, seq_size]
 
-        merge_list = []
-        for j in range(self.densenet_width):
-            conv_results = []
-            for i, kss in enumerate(self.densenet_kernels):
-                if i == 0: conv_in = x
-                else: conv_in  = torch.cat(conv_results, dim=-2)
-                conv_out = self.densenet_block[i][j](conv_in)
-                # conv_out first : [batch_size, first_num_filters, seq_size]
-                # conv_out other : [batch_size, num_filters, seq_size]
-                conv_out *= masks # masking, auto broadcasting along with second dimension
-                conv_out = self.activation(conv_out)
-                conv_results.append(conv_out)
-            merge_list.append(conv_results[-1]) # last one only
-
-        conv_last = self.conv_last(torch.cat([x] + merge_list, dim=-2))
+        if not torch.is_grad_enabled() and not is_autocast_enabled(x.device.type) and not torch.jit.is_tracing():
+            # inference, preallocated buffers instead of concatenating all previous outputs at every block
+            merged = self.__forward_into(x, masks)
+        else:
+            merge_list = []
+            use_checkpointing = self.use_checkpointing and self.training and torch.is_grad_enabled()
+            for j in range(self.densenet_width):
+                if use_checkpointing: merge_list.append(checkpointed_call(self.__branch, j, x, masks))
+                else: merge_list.append(self.__branch(j, x, masks))
+            merged = torch.cat([x] + merge_list, dim=-2)
+
+        conv_last = self.conv_last(merged)
         conv_last *= masks
         conv_last = F.relu(conv_last)
         # conv_last : [batch_size, last_num_filters, seq_size]
@@ -141,6 +284,8 @@ class DSA(nn.Module):
         for i in range(dsa_num_attentions):
             dsa.append(nn.Linear(dsa_input_dim, dsa_dim))
         self.dsa = nn.ModuleList(dsa)
+        self.dsa_num_attentions = dsa_num_attentions
+        self.dsa_dim = dsa_dim
         self.dsa_r = dsa_r # r iterations
         self.last_dim = dsa_num_attentions * dsa_dim
 
@@ -180,7 +325,50 @@ class DSA(nn.Module):
             # q : [batch_size, seq_size]
         return z_list[-1]
 
-    def forward(self, x, mask):
+    def forward(self, x, mask=None):
+        """All attentions at once, one projection and r iterations on [batch_size * dsa_num_attentions, ...] tensors.
+        same as forward_reference() up to float rounding, on the same parameters.
+        """
+        # x     : [batch_size, seq_size, dsa_input_dim]
+        # mask  : [batch_size, seq_size], None if there is no padding
+        batch_size, seq_size = x.shape[0], x.shape[1]
+        h, d = self.dsa_num_attentions, self.dsa_dim
+        weight = torch.cat([p.weight for p in self.dsa], dim=0)
+        bias = torch.cat([p.bias for p in self.dsa], dim=0)
+        # weight : [dsa_num_attentions * dsa_dim, dsa_input_dim]
+        p_out = F.leaky_relu(F.linear(x, weight, bias))
+        # p_out : [batch_size, seq_size, dsa_num_attentions * dsa_dim]
+        with autocast_disabled(x.device.type):
+            # attention weights are computed in float32 as in forward_reference()
+            p_out = p_out.float().view(batch_size, seq_size, h, d).transpose(1, 2).reshape(batch_size * h, seq_size, d)
+            # p_out : [batch_size * dsa_num_attentions, seq_size, dsa_dim]
+            if mask is not None:
+                mask = mask.to(torch.float).unsqueeze(1).expand(batch_size, h, seq_size).reshape(batch_size * h, seq_size, 1)
+                softmax_mask = mask.masked_fill(mask.eq(0.0), -1e20)
+                # mask, softmax_mask : [batch_size * dsa_num_attentions, seq_size, 1]
+            q = p_out.new_zeros(batch_size * h, seq_size, 1)
+            # q : [batch_size * dsa_num_attentions, seq_size, 1]
+            # no gradient flows through the attention weights, so that q is updated in-place without autograd
+            # and only the last iteration is recorded.
+            x_const = p_out.detach()
+            with torch.no_grad():
+                for idx in range(self.dsa_r - 1):
+                    if mask is not None: q *= softmax_mask
+                    a = torch.softmax(q, dim=1)
+                    if mask is not None: a *= mask
+                    z = torch.tanh(torch.bmm(a.transpose(1, 2), x_const))
+                    # z : [batch_size * dsa_num_attentions, 1, dsa_dim]
+                    q.baddbmm_(x_const, z.transpose(1, 2))
+                if mask is not None: q *= softmax_mask
+                a = torch.softmax(q, dim=1)
+                if mask is not None: a *= mask
+            z = torch.tanh(torch.bmm(a.transpose(1, 2), p_out))
+        z = z.view(batch_size, h * d)
+        # z : [batch_size, dsa_num_attentions * dsa_dim]
+        return z
+
+    def forward_reference(self, x, mask):
+        # per-attention loop, the original implementation. see benchmark.py
         # x     : [batch_size, seq_size, dsa_input_dim]
         # mak   : [batch_size, seq_size]
         z_list = []
@@ -195,6 +383,41 @@ class DSA(nn.Module):
         # z : [batch_size, dsa_num_attentions * dsa_dim]
         return z
 
+class CharCNNCache():
+    """LRU cache of char-CNN vectors for inference.
+
+    keyed by the character ids of a word, which are determined by the word string(truncated to char_n_ctx).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'capacity': self.capacity,
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
 class CharCNN(BaseModel):
     def __init__(self, config):
         super().__init__(config=config)
@@ -211,26 +434,58 @@ class CharCNN(BaseModel):
         self.embed_char = super().create_embedding_layer(char_vocab_size, self.char_emb_dim, weights_matrix=None, non_trainable=False, padding_idx=self.char_padding_idx)
         self.textcnn = TextCNN(self.char_emb_dim, char_num_filters, char_kernel_sizes)
         self.last_dim = len(char_kernel_sizes) * char_num_filters
+        # word-level cache for inference, see enable_cache()
+        self.cache = None
 
-    def forward(self, x):
-        # x : [batch_size, seq_size, char_n_ctx]
+    def enable_cache(self, capacity):
+        self.cache = CharCNNCache(capacity) if capacity > 0 else None
 
-        char_ids = x
-        # char_ids : [batch_size, seq_size, char_n_ctx]
-        mask = char_ids.view(-1, self.char_n_ctx).ne(self.char_padding_idx) # broadcasting
-        # mask : [batch_size*seq_size, char_n_ctx]
+    def __encode(self, char_ids):
+        # char_ids : [num_words, char_n_ctx]
+        mask = char_ids.ne(self.char_padding_idx) # broadcasting
+        # mask : [num_words, char_n_ctx]
         mask = mask.unsqueeze(2).to(torch.float)
-        # mask : [batch_size*seq_size, char_n_ctx, 1]
+        # mask : [num_words, char_n_ctx, 1]
 
         char_embed_out = self.embed_char(char_ids)
-        # char_embed_out : [batch_size, seq_size, char_n_ctx, char_emb_dim]
-        char_embed_out = char_embed_out.view(-1, self.char_n_ctx, self.char_emb_dim)
-        # char_embed_out : [batch_size*seq_size, char_n_ctx, char_emb_dim]
+        # char_embed_out : [num_words, char_n_ctx, char_emb_dim]
         char_embed_out *= mask # masking, auto-broadcasting
 
         charcnn_out = self.textcnn(char_embed_out)
+        # charcnn_out : [num_words, last_dim]
+        return charcnn_out
+
+    def __encode_cached(self, char_ids):
+        # char_ids : [num_words, char_n_ctx], unique words
+        keys = [row.tobytes() for row in char_ids.cpu().numpy()]
+        vectors = [self.cache.get(key) for key in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            computed = self.__encode(char_ids[torch.tensor(missing, device=char_ids.device)])
+            for j, i in enumerate(missing):
+                vectors[i] = computed[j].clone() # do not keep the whole batch alive
+                self.cache.put(keys[i], vectors[i])
+        return torch.stack(vectors)
+
+    def forward(self, x):
+        # x : [batch_size, seq_size, char_n_ctx]
+
+        char_ids = x.reshape(-1, self.char_n_ctx)
+        # char_ids : [batch_size*seq_size, char_n_ctx]
+        if torch.jit.is_tracing():
+            charcnn_out = self.__encode(char_ids)
+        else:
+            # encode every distinct word once(padding positions are a single all-pad word), then scatter back.
+            unique_ids, inverse = torch.unique(char_ids, dim=0, return_inverse=True)
+            # unique_ids : [num_unique_words, char_n_ctx], inverse : [batch_size*seq_size]
+            # vectors computed under autocast are not cached, they would be reused at full precision.
+            if self.cache is not None and not self.training and not torch.is_grad_enabled() and not is_autocast_enabled(char_ids.device.type):
+                unique_out = self.__encode_cached(unique_ids)
+            else:
+                unique_out = self.__encode(unique_ids)
+            charcnn_out = unique_out.index_select(0, inverse)
         # charcnn_out : [batch_size*seq_size, last_dim]
-        charcnn_out = charcnn_out.view(-1, self.seq_size, charcnn_out.shape[-1])
+        charcnn_out = charcnn_out.view(-1, x.shape[1], charcnn_out.shape[-1])
         # charcnn_out : [batch_size, seq_size, last_dim]
         return charcnn_out
 
@@ -252,7 +507,8 @@ class GloveLSTMCRF(BaseModel):
         weights_matrix = super().load_embedding(embedding_path)
         vocab_dim, token_emb_dim = weights_matrix.size()
         padding_idx = config['pad_token_id']
-        self.embed_token = super().create_embedding_layer(vocab_dim, token_emb_dim, weights_matrix=weights_matrix, non_trainable=emb_non_trainable, padding_idx=padding_idx)
+        self.embed_token = super().create_embedding_layer(vocab_dim, token_emb_dim, weights_matrix=weights_matrix, non_trainable=emb_non_trainable, padding_idx=padding_idx,
+                                                          sparse=getattr(config['opt'], 'embedding_sparse', False))
 
         # pos embedding layer
         self.poss = super().load_dict(pos_path)
@@ -297,14 +553,16 @@ class GloveLSTMCRF(BaseModel):
         # lengths : [batch_size]
 
         # 1. Embedding
-        token_embed_out = self.embed_token(token_ids)
-        # token_embed_out : [batch_size, seq_size, token_emb_dim]
-        pos_embed_out = self.embed_pos(pos_ids)
-        # pos_embed_out : [batch_size, seq_size, pos_emb_dim]
+        with stage('embedding'):
+            token_embed_out = self.embed_token(token_ids)
+            # token_embed_out : [batch_size, seq_size, token_emb_dim]
+            pos_embed_out = self.embed_pos(pos_ids)
+            # pos_embed_out : [batch_size, seq_size, pos_emb_dim]
         if self.use_char_cnn:
             char_ids = x[2]
             # char_ids : [batch_size, seq_size, char_n_ctx]
-            charcnn_out = self.charcnn(char_ids)
+            with stage('charcnn'):
+                charcnn_out = self.charcnn(char_ids)
             # charcnn_out : [batch_size, seq_size, self.charcnn.last_dim]
             embed_out = torch.cat([token_embed_out, pos_embed_out, charcnn_out], dim=-1)
             # embed_out : [batch_size, seq_size, emb_dim]
@@ -314,18 +572,17 @@ class GloveLSTMCRF(BaseModel):
         embed_out = self.dropout(embed_out)
 
         # 2. LSTM
-        packed_embed_out = torch.nn.utils.rnn.pack_padded_sequence(embed_out, lengths, batch_first=True, enforce_sorted=False)
-        lstm_out, (h_n, c_n) = self.lstm(packed_embed_out)
-        lstm_out, _ = torch.nn.utils.rnn.pad_packed_sequence(lstm_out, batch_first=True, total_length=self.seq_size)
+        with stage('encoder.lstm'):
+            lstm_out = self.encode_lstm(embed_out, lengths)
         # lstm_out : [batch_size, seq_size, lstm_hidden_dim*2]
         lstm_out = self.dropout(lstm_out)
 
         # 3. Output
-        logits = self.linear(lstm_out)
+        with stage('linear'):
+            logits = self.linear(lstm_out)
         # logits : [batch_size, seq_size, label_size]
         if not self.use_crf: return logits
-        prediction = self.crf.decode(logits)
-        prediction = torch.as_tensor(prediction, dtype=torch.long)
+        prediction = self.decode_crf(logits, mask)
         # prediction : [batch_size, seq_size]
         return logits, prediction
 
@@ -344,7 +601,8 @@ class GloveDensenetCRF(BaseModel):
         weights_matrix = super().load_embedding(embedding_path)
         vocab_dim, token_emb_dim = weights_matrix.size()
         padding_idx = config['pad_token_id']
-        self.embed_token = super().create_embedding_layer(vocab_dim, token_emb_dim, weights_matrix=weights_matrix, non_trainable=emb_non_trainable, padding_idx=padding_idx)
+        self.embed_token = super().create_embedding_layer(vocab_dim, token_emb_dim, weights_matrix=weights_matrix, non_trainable=emb_non_trainable, padding_idx=padding_idx,
+                                                          sparse=getattr(config['opt'], 'embedding_sparse', False))
 
         # pos embedding layer
         self.poss = super().load_dict(pos_path)
@@ -387,14 +645,16 @@ class GloveDensenetCRF(BaseModel):
         # mask : [batch_size, seq_size]
 
         # 1. Embedding
-        token_embed_out = self.embed_token(token_ids)
-        # token_embed_out : [batch_size, seq_size, token_emb_dim]
-        pos_embed_out = self.embed_pos(pos_ids)
-        # pos_embed_out   : [batch_size, seq_size, pos_emb_dim]
+        with stage('embedding'):
+            token_embed_out = self.embed_token(token_ids)
+            # token_embed_out : [batch_size, seq_size, token_emb_dim]
+            pos_embed_out = self.embed_pos(pos_ids)
+            # pos_embed_out   : [batch_size, seq_size, pos_emb_dim]
         if self.use_char_cnn:
             char_ids = x[2]
             # char_ids : [batch_size, seq_size, char_n_ctx]
-            charcnn_out = self.charcnn(char_ids)
+            with stage('charcnn'):
+                charcnn_out = self.charcnn(char_ids)
             # charcnn_out : [batch_size, seq_size, self.charcnn.last_dim]
             embed_out = torch.cat([token_embed_out, pos_embed_out, charcnn_out], dim=-1)
             # embed_out : [batch_size, seq_size, emb_dim]
@@ -404,22 +664,116 @@ class GloveDensenetCRF(BaseModel):
         embed_out = self.dropout(embed_out)
 
         # 2. DenseNet
-        densenet_out = self.densenet(embed_out, mask)
-        # densenet_out : [batch_size, seq_size, last_num_filters]
-        densenet_out = self.layernorm_densenet(densenet_out)
+        with stage('encoder.densenet'):
+            densenet_out = self.densenet(embed_out, mask)
+            # densenet_out : [batch_size, seq_size, last_num_filters]
+            densenet_out = self.layernorm_densenet(densenet_out)
         densenet_out = self.dropout(densenet_out)
 
         # 3. Output
-        logits = self.linear(densenet_out)
+        with stage('linear'):
+            logits = self.linear(densenet_out)
         # logits : [batch_size, seq_size, label_size]
         if not self.use_crf: return logits
-        prediction = self.crf.decode(logits)
-        prediction = torch.as_tensor(prediction, dtype=torch.long)
+        prediction = self.decode_crf(logits, mask)
         # prediction : [batch_size, seq_size]
         return logits, prediction
 
+def compute_bert_hidden_states(config, bert_model, x):
+    """Compute the stack of all hidden states for feature-based, without gradients.
+    """
+    with torch.no_grad():
+        if config['emb_class'] in ['bart', 'distilbert']:
+            bert_outputs = bert_model(input_ids=x[0],
+                                      attention_mask=x[1],
+                                      output_hidden_states=True)
+            # bart model's output(output_hidden_states == True)
+            # [0] last decoder layer's output : [batch_size, seq_size, bert_hidden_size]
+            # [1] all hidden states of decoder layer's
+            # [2] last encoder layer's output : [seq_size, batch_size, bert_hidden_size]
+            # [3] all hidden states of encoder layer's
+            all_hidden_states = bert_outputs[1][0:]
+        elif 'electra' in config['emb_class']:
+            bert_outputs = bert_model(input_ids=x[0],
+                                      attention_mask=x[1],
+                                      token_type_ids=x[2],
+                                      output_hidden_states=True)
+            # electra model's output
+            # list of each layer's hidden states
+            all_hidden_states = bert_outputs
+        else:
+            bert_outputs = bert_model(input_ids=x[0],
+                                      attention_mask=x[1],
+                                      token_type_ids=None if config['emb_class'] in ['roberta'] else x[2], # RoBERTa don't use segment_ids
+                                      output_hidden_states=True)
+            all_hidden_states = bert_outputs[2][0:]
+            # last hidden states, pooled output,   initial embedding layer, 1 ~ last layer's hidden states
+            # bert_outputs[0],    bert_outputs[1], bert_outputs[2][0],      bert_outputs[2][1:]
+
+        '''
+        # 1) last layer
+        embedded = bert_outputs[0]
+        # embedded : [batch_size, seq_size, bert_hidden_size]
+        '''
+        '''
+        # 2) mean pooling
+        stack = torch.stack(all_hidden_states, dim=-1)
+        embedded = torch.mean(stack, dim=-1)
+        # ([batch_size, seq_size, bert_hidden_size], ..., [batch_size, seq_size, bert_hidden_size])
+        # -> stack(-1) -> [batch_size, seq_size, bert_hidden_size, *], ex) * == 25 for bert large
+        # -> max/mean(-1) ->  [batch_size, seq_size, bert_hidden_size]
+        '''
+        # 3) DSA pooling
+        stack = torch.stack(all_hidden_states, dim=-2)
+        # stack : [batch_size, seq_size, bert_num_layers + 1, bert_hidden_size]
+    return stack
+
+def get_bert_state_modules(bert_model):
+    """Modules whose outputs are hidden_states[0], hidden_states[1], ..., None if not supported(ex, albert shares its layers, bart).
+    """
+    if hasattr(bert_model, 'encoder') and hasattr(bert_model.encoder, 'layer'):        # bert, roberta, electra
+        first = bert_model.embeddings_project if hasattr(bert_model, 'embeddings_project') else bert_model.embeddings
+        return [first] + list(bert_model.encoder.layer)
+    if hasattr(bert_model, 'transformer') and hasattr(bert_model.transformer, 'layer'): # distilbert
+        return [bert_model.embeddings] + list(bert_model.transformer.layer)
+    return None
+
+def compute_bert_token_states(config, bert_model, x, token_mask):
+    """Hidden states of all layers for the non-pad tokens only, without gradients.
+
+    each layer output is gathered into one buffer by a forward hook as soon as it is computed,
+    so that the padded states of all layers are neither kept by bert_model nor stacked.
+    """
+    # token_mask : [batch_size, seq_size], bool
+    index = token_mask.reshape(-1).nonzero().squeeze(1)
+    # index : [num_tokens]
+    modules = get_bert_state_modules(bert_model)
+    if modules is None:
+        return compute_bert_hidden_states(config, bert_model, x)[token_mask]
+    states = {}
+    def store(i, output):
+        hidden = output[0] if isinstance(output, tuple) else output
+        # hidden : [batch_size, seq_size, bert_hidden_size]
+        if 'buf' not in states:
+            states['buf'] = hidden.new_empty(index.shape[0], len(modules), hidden.shape[-1])
+        states['buf'][:, i] = hidden.reshape(-1, hidden.shape[-1]).index_select(0, index)
+    handles = [m.register_forward_hook(lambda module, inputs, output, i=i: store(i, output)) for i, m in enumerate(modules)]
+    try:
+        with torch.no_grad():
+            if config['emb_class'] in ['distilbert']:
+                bert_model(input_ids=x[0], attention_mask=x[1])
+            else:
+                bert_model(input_ids=x[0],
+                           attention_mask=x[1],
+                           token_type_ids=None if config['emb_class'] in ['roberta'] else x[2]) # RoBERTa don't use segment_ids
+    finally:
+        for handle in handles: handle.remove()
+    # buf : [num_tokens, bert_num_layers + 1, bert_hidden_size]
+    return states['buf']
+
 class BertLSTMCRF(BaseModel):
-    def __init__(self, config, bert_config, bert_model, bert_tokenizer, label_path, pos_path, use_crf=False, use_pos=False, disable_lstm=False, feature_based=False):
+    def __init__(self, config, bert_config, bert_model, bert_tokenizer, label_path, pos_path, use_crf=False, use_pos=False, disable_lstm=False, feature_based=False,
+                 exit_layers=None):
         super().__init__(config=config)
 
         self.config = config
@@ -491,62 +845,41 @@ class BertLSTMCRF(BaseModel):
         if self.use_crf:
             self.crf = CRF(num_tags=self.label_size, batch_first=True)
 
+        # exit heads on the intermediate layers(1 ~ bert_num_layers-1) for early-exit inference, see forward_early_exit()
+        self.exit_layers = sorted(exit_layers or [])
+        if self.exit_layers:
+            if self.bert_feature_based or not hasattr(bert_model, 'encoder') or not hasattr(bert_model.encoder, 'layer'):
+                raise ValueError("exit layers are supported for fine-tuning bert, roberta and electra only")
+            if not all(0 < layer < self.bert_num_layers for layer in self.exit_layers):
+                raise ValueError("exit layers should be in [1, {}), {}".format(self.bert_num_layers, self.exit_layers))
+        self.exit_heads = nn.ModuleList([nn.Linear(self.bert_hidden_size, self.label_size) for _ in self.exit_layers])
+
+    def _compute_bert_hidden_states(self, x):
+        """Compute the stack of all hidden states for feature-based, without gradients.
+        """
+        return compute_bert_hidden_states(self.config, self.bert_model, x)
+
     def _compute_bert_embedding(self, x):
         if self.bert_feature_based:
             # feature-based
-            with torch.no_grad():
-                if self.config['emb_class'] in ['bart', 'distilbert']:
-                    bert_outputs = self.bert_model(input_ids=x[0],
-                                                   attention_mask=x[1],
-                                                   output_hidden_states=True)
-                    # bart model's output(output_hidden_states == True)
-                    # [0] last decoder layer's output : [batch_size, seq_size, bert_hidden_size]
-                    # [1] all hidden states of decoder layer's
-                    # [2] last encoder layer's output : [seq_size, batch_size, bert_hidden_size]
-                    # [3] all hidden states of encoder layer's
-                    all_hidden_states = bert_outputs[1][0:]
-                elif 'electra' in self.config['emb_class']:
-                    bert_outputs = self.bert_model(input_ids=x[0],
-                                                   attention_mask=x[1],
-                                                   token_type_ids=x[2],
-                                                   output_hidden_states=True)
-                    # electra model's output
-                    # list of each layer's hidden states
-                    all_hidden_states = bert_outputs
-                else:
-                    bert_outputs = self.bert_model(input_ids=x[0],
-                                                   attention_mask=x[1],
-                                                   token_type_ids=None if self.config['emb_class'] in ['roberta'] else x[2], # RoBERTa don't use segment_ids
-                                                   output_hidden_states=True)
-                    all_hidden_states = bert_outputs[2][0:]
-                    # last hidden states, pooled output,   initial embedding layer, 1 ~ last layer's hidden states
-                    # bert_outputs[0],    bert_outputs[1], bert_outputs[2][0],      bert_outputs[2][1:]
-
-                '''
-                # 1) last layer
-                embedded = bert_outputs[0]
-                # embedded : [batch_size, seq_size, bert_hidden_size]
-                '''
-                '''
-                # 2) mean pooling
-                stack = torch.stack(all_hidden_states, dim=-1)
-                embedded = torch.mean(stack, dim=-1)
-                # ([batch_size, seq_size, bert_hidden_size], ..., [batch_size, seq_size, bert_hidden_size])
-                # -> stack(-1) -> [batch_size, seq_size, bert_hidden_size, *], ex) * == 25 for bert large
-                # -> max/mean(-1) ->  [batch_size, seq_size, bert_hidden_size]
-                '''
-                # 3) DSA pooling
-                stack = torch.stack(all_hidden_states, dim=-2)
-                # stack : [batch_size, seq_size, *, bert_hidden_size]
-                stack = stack.view(-1, self.bert_num_layers + 1, self.bert_hidden_size)
-                # stack : [*, bert_num_layers, bert_hidden_size]
-                dsa_mask = torch.ones(stack.shape[0], stack.shape[1]).to(self.device)
-                # dsa_mask : [*, bert_num_layers]
-                dsa_out = self.dsa(stack, dsa_mask)
-                # dsa_out : [*, self.dsa.last_dim]
+            # pool the non-pad tokens only, padding positions get zero vectors.
+            token_mask = x[1] != 0
+            # token_mask : [batch_size, seq_size]
+            if len(x) > 4:
+                # precomputed hidden states of the non-pad tokens from the feature cache(see dataset.FeatureCollate)
+                stack = x[4].to(self.layernorm_dsa.weight.dtype)
+            else:
+                stack = compute_bert_token_states(self.config, self.bert_model, x, token_mask)
+            # stack : [num_tokens, bert_num_layers + 1, bert_hidden_size]
+            # DSA is not trained, same as the original feature-based model
+            with stage('dsa'), torch.no_grad():
+                # every layer is valid, no mask
+                dsa_out = self.dsa(stack)
+                # dsa_out : [num_tokens, self.dsa.last_dim]
                 dsa_out = self.layernorm_dsa(dsa_out)
-                embedded = dsa_out.view(-1, self.seq_size, self.dsa.last_dim)
-                # embedded : [batch_size, seq_size, self.dsa.last_dim]
+            embedded = dsa_out.new_zeros(x[0].shape[0], x[0].shape[1], self.dsa.last_dim)
+            embedded[token_mask] = dsa_out
+            # embedded : [batch_size, seq_size, self.dsa.last_dim]
         else:
             # fine-tuning
             # x[0], x[1], x[2] : [batch_size, seq_size]
@@ -564,19 +897,26 @@ class BertLSTMCRF(BaseModel):
                 # embedded : [batch_size, seq_size, bert_hidden_size]
         return embedded
 
-    def forward(self, x):
-        # x[0,1,2] : [batch_size, seq_size]
-
-        mask = x[1].to(torch.uint8).to(self.device)
-        # mask == attention_mask : [batch_size, seq_size]
-        lengths = torch.sum(mask.to(torch.long), dim=1)
-        # lengths : [batch_size]
-
-        # 1. Embedding
-        bert_embed_out = self._compute_bert_embedding(x)
-        # bert_embed_out : [batch_size, seq_size, *]
+    def __compute_bert_embedding_with_exits(self, x):
+        # outputs of the exit layers are captured by forward hooks, hidden_states[layer] == output of modules[layer]
+        modules = get_bert_state_modules(self.bert_model)
+        exit_hidden_states = {}
+        def store(layer, output):
+            exit_hidden_states[layer] = output[0] if isinstance(output, tuple) else output
+        handles = [modules[layer].register_forward_hook(lambda module, inputs, output, layer=layer: store(layer, output))
+                   for layer in self.exit_layers]
+        try:
+            embedded = self._compute_bert_embedding(x)
+        finally:
+            for handle in handles: handle.remove()
+        return embedded, exit_hidden_states
+
+    def _forward_head(self, x, bert_embed_out, lengths):
+        # layers on top of bert, bert_embed_out : [batch_size, seq_size, *]
+        mask = x[1]
         pos_ids = x[3]
-        pos_embed_out = self.embed_pos(pos_ids)
+        with stage('embedding'):
+            pos_embed_out = self.embed_pos(pos_ids)
         # pos_embed_out : [batch_size, seq_size, pos_emb_dim]
         if self.use_pos:
             embed_out = torch.cat([bert_embed_out, pos_embed_out], dim=-1)
@@ -587,9 +927,8 @@ class BertLSTMCRF(BaseModel):
 
         # 2. LSTM
         if not self.disable_lstm:
-            packed_embed_out = torch.nn.utils.rnn.pack_padded_sequence(embed_out, lengths, batch_first=True, enforce_sorted=False)
-            lstm_out, (h_n, c_n) = self.lstm(packed_embed_out)
-            lstm_out, _ = torch.nn.utils.rnn.pad_packed_sequence(lstm_out, batch_first=True, total_length=self.seq_size)
+            with stage('encoder.lstm'):
+                lstm_out = self.encode_lstm(embed_out, lengths)
             # lstm_out : [batch_size, seq_size, lstm_hidden_dim*2]
             lstm_out = self.dropout(lstm_out)
         else:
@@ -597,14 +936,184 @@ class BertLSTMCRF(BaseModel):
             # lstm_out : [batch_size, seq_size, emb_dim]
 
         # 3. Output
-        logits = self.linear(lstm_out)
+        with stage('linear'):
+            logits = self.linear(lstm_out)
         # logits : [batch_size, seq_size, label_size]
         if not self.use_crf: return logits
-        prediction = self.crf.decode(logits)
-        prediction = torch.as_tensor(prediction, dtype=torch.long)
+        prediction = self.decode_crf(logits, mask)
         # prediction : [batch_size, seq_size]
         return logits, prediction
 
+    def forward(self, x, return_exits=False):
+        """
+        Args:
+          return_exits: if True, also return the logits of the exit heads, [[batch_size, seq_size, label_size], ...].
+        """
+        # x[0,1,2] : [batch_size, seq_size]
+
+        mask = x[1].to(torch.uint8).to(self.device)
+        # mask == attention_mask : [batch_size, seq_size]
+        lengths = torch.sum(mask.to(torch.long), dim=1)
+        # lengths : [batch_size]
+
+        # 1. Embedding
+        with stage('bert'):
+            if return_exits: bert_embed_out, exit_hidden_states = self.__compute_bert_embedding_with_exits(x)
+            else: bert_embed_out = self._compute_bert_embedding(x)
+        # bert_embed_out : [batch_size, seq_size, *]
+        outputs = self._forward_head(x, bert_embed_out, lengths)
+        if not return_exits: return outputs
+        exit_logits = [head(self.dropout(exit_hidden_states[layer])) for layer, head in zip(self.exit_layers, self.exit_heads)]
+        return outputs, exit_logits
+
+    def forward_early_exit(self, x, threshold, word_mask=None):
+        """Inference which stops each sentence at the first exit layer whose confidence clears threshold.
+
+        confidence of a sentence is the minimum of the max softmax probability of the exit head over its words,
+        word_mask : [batch_size, seq_size], True at the first sub-token of each word(label_ids != pad_label_id),
+        None means every non-pad token.
+        the remaining sentences go on with the rest of layers only, and the last layer uses the full model(lstm, crf).
+        returns logits, prediction and the exit layer of each sentence(bert_num_layers for the full model).
+        """
+        bert_model = self.bert_model
+        batch_size, seq_size = x[0].shape[0], x[0].shape[1]
+        logits_out = torch.zeros(batch_size, seq_size, self.label_size, device=x[0].device)
+        prediction_out = torch.zeros(batch_size, seq_size, dtype=torch.long, device=x[0].device)
+        exit_layer = torch.full((batch_size,), self.bert_num_layers, dtype=torch.long, device=x[0].device)
+        rows = torch.arange(batch_size, device=x[0].device)
+        # rows : indices of the remaining sentences in the batch
+        # [CLS], [SEP] and the other sub-tokens are not tagged, they should not hold a sentence back.
+        token_mask = word_mask if word_mask is not None else x[1] != 0
+        exit_heads = dict(zip(self.exit_layers, self.exit_heads))
+        with stage('bert'):
+            hidden = bert_model.embeddings(input_ids=x[0], token_type_ids=None if self.config['emb_class'] in ['roberta'] else x[2])
+            if hasattr(bert_model, 'embeddings_project'): hidden = bert_model.embeddings_project(hidden)
+            # hidden : [num_remaining, seq_size, bert_hidden_size]
+            # additive mask, same as get_extended_attention_mask() which is gone in transformers>=5
+            extended_mask = (1.0 - x[1][:, None, None, :].to(hidden.dtype)) * torch.finfo(hidden.dtype).min
+            # extended_mask : [num_remaining, 1, 1, seq_size]
+            for i, layer_module in enumerate(bert_model.encoder.layer):
+                hidden = layer_module(hidden, attention_mask=extended_mask)
+                # tuple in transformers<5
+                if isinstance(hidden, tuple): hidden = hidden[0]
+                head = exit_heads.get(i + 1)
+                if head is None: continue
+                with stage('exit'):
+                    head_logits = head(hidden)
+                    # head_logits : [num_remaining, seq_size, label_size]
+                    probs = torch.softmax(head_logits.float(), dim=-1).max(dim=-1)[0]
+                    confidence = probs.masked_fill(~token_mask, 1.0).min(dim=-1)[0]
+                    done = confidence >= threshold
+                    # done : [num_remaining]
+                if not done.any(): continue
+                logits_out[rows[done]] = head_logits[done].float()
+                prediction_out[rows[done]] = head_logits[done].argmax(dim=-1)
+                exit_layer[rows[done]] = i + 1
+                keep = ~done
+                rows, hidden, extended_mask, token_mask = rows[keep], hidden[keep], extended_mask[keep], token_mask[keep]
+                if rows.numel() == 0: break
+        if rows.numel() > 0:
+            x_rest = [t[rows] for t in x]
+            lengths = torch.sum(x_rest[1].to(torch.long), dim=1)
+            outputs = self._forward_head(x_rest, hidden, lengths)
+            if self.use_crf:
+                logits_out[rows] = outputs[0].float()
+                prediction_out[rows] = outputs[1].to(prediction_out.device)
+            else:
+                logits_out[rows] = outputs.float()
+                prediction_out[rows] = outputs.argmax(dim=-1)
+        return logits_out, prediction_out, exit_layer
+
+class ElmoTokenCache():
+    """Word-level cache of the ELMo character encoder(char-CNN + highway + projection) outputs.
+
+    the context-independent token layer depends only on the character ids of each token and is frozen
+    by Elmo(requires_grad=False), so it is computed once per distinct word and only the biLMs run per batch.
+    installed by replacing the forward of allennlp's _ElmoCharacterEncoder instance, parameter names are kept.
+    """
+
+    def __init__(self, encoder, max_size=0):
+        self.encoder = encoder
+        self.max_size = max_size # 0 means no limit
+        self.index = {}          # character ids(bytes) -> row of self.table
+        self.table = None
+        self.hits = 0
+        self.misses = 0
+
+    def __encode(self, char_ids):
+        # char_ids : [num_words, max_characters_per_token], no all-padding row
+        # encode each word as a sentence of length 1, ex) <S> word </S>
+        with torch.no_grad():
+            # forward of the class, the instance forward is this cache(and a bound method would not survive pickling to workers)
+            return type(self.encoder).forward(self.encoder, char_ids.unsqueeze(1))['token_embedding'][:, 1]
+        # returns : [num_words, token_dim]
+
+    def __put(self, keys, vectors):
+        if self.max_size > 0: keys = keys[:max(0, self.max_size - len(self.index))]
+        if not keys: return
+        size = len(self.index)
+        if self.table is None or self.table.shape[0] < size + len(keys):
+            # grow geometrically
+            capacity = max(size + len(keys), 2 * (self.table.shape[0] if self.table is not None else 0))
+            table = vectors.new_empty((capacity, vectors.shape[1]))
+            if self.table is not None: table[:size] = self.table[:size]
+            self.table = table
+        self.table[size:size+len(keys)] = vectors[:len(keys)]
+        for i, key in enumerate(keys):
+            self.index[key] = size + i
+
+    def build(self, words, batch_size=1024):
+        """Prebuild entries for the given words, ex) vocabulary of the training data."""
+        from allennlp.modules.elmo import batch_to_ids
+        device = next(self.encoder.parameters()).device
+        for i in range(0, len(words), batch_size):
+            char_ids = batch_to_ids([[word] for word in words[i:i+batch_size]])[:, 0].to(device)
+            keys = [row.tobytes() for row in char_ids.cpu().numpy()]
+            self.__put(keys, self.__encode(char_ids))
+
+    def lookup(self, char_ids):
+        # char_ids : [num_words, max_characters_per_token], unique words
+        keys = [row.tobytes() for row in char_ids.cpu().numpy()]
+        rows = [self.index.get(key) for key in keys]
+        # all-padding positions are masked out by the biLMs and in the outputs, any vector would do.
+        padding = char_ids.sum(dim=-1).eq(0).tolist()
+        missing = [i for i, row in enumerate(rows) if row is None and not padding[i]]
+        self.hits += sum(1 for i, row in enumerate(rows) if row is not None)
+        self.misses += len(missing)
+        if missing:
+            computed = self.__encode(char_ids[torch.tensor(missing, device=char_ids.device)])
+            self.__put([keys[i] for i in missing], computed)
+        # <S>, </S> are never padding, so there is at least one cached or computed vector.
+        ref = computed if missing else self.table
+        out = ref.new_zeros((char_ids.shape[0], ref.shape[1]))
+        cached = [i for i, row in enumerate(rows) if row is not None]
+        if cached:
+            out[torch.tensor(cached, device=out.device)] = self.table[torch.tensor([rows[i] for i in cached], device=out.device)]
+        if missing:
+            out[torch.tensor(missing, device=out.device)] = computed
+        return out
+        # out : [num_words, token_dim]
+
+    def __call__(self, inputs):
+        # same outputs as _ElmoCharacterEncoder.forward()
+        # inputs : [batch_size, seq_size, max_characters_per_token]
+        from allennlp.nn.util import add_sentence_boundary_token_ids
+        mask = ((inputs > 0).long().sum(dim=-1) > 0).long()
+        character_ids_with_bos_eos, mask_with_bos_eos = add_sentence_boundary_token_ids(
+            inputs, mask, self.encoder._beginning_of_sentence_characters, self.encoder._end_of_sentence_characters)
+        batch_size, sequence_length, max_chars = character_ids_with_bos_eos.shape
+        unique_ids, inverse = torch.unique(character_ids_with_bos_eos.view(-1, max_chars), dim=0, return_inverse=True)
+        token_embedding = self.lookup(unique_ids).index_select(0, inverse)
+        return {'mask': mask_with_bos_eos, 'token_embedding': token_embedding.view(batch_size, sequence_length, -1)}
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'capacity': self.max_size,
+                'size': len(self.index),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
 class ElmoLSTMCRF(BaseModel):
     def __init__(self, config, elmo_model, embedding_path, label_path, pos_path, emb_non_trainable=True, use_crf=False, use_char_cnn=False):
         super().__init__(config=config)
@@ -627,7 +1136,8 @@ class ElmoLSTMCRF(BaseModel):
         weights_matrix = super().load_embedding(embedding_path)
         vocab_dim, token_emb_dim = weights_matrix.size()
         padding_idx = config['pad_token_id']
-        self.embed_token = super().create_embedding_layer(vocab_dim, token_emb_dim, weights_matrix=weights_matrix, non_trainable=emb_non_trainable, padding_idx=padding_idx)
+        self.embed_token = super().create_embedding_layer(vocab_dim, token_emb_dim, weights_matrix=weights_matrix, non_trainable=emb_non_trainable, padding_idx=padding_idx,
+                                                          sparse=getattr(config['opt'], 'embedding_sparse', False))
 
         # pos embedding layer
         self.poss = super().load_dict(pos_path)
@@ -660,6 +1170,18 @@ class ElmoLSTMCRF(BaseModel):
         if self.use_crf:
             self.crf = CRF(num_tags=self.label_size, batch_first=True)
 
+        # word-level cache of the elmo character encoder, see enable_token_cache()
+        self.token_cache = None
+
+    def enable_token_cache(self, words=[], max_size=0):
+        """Cache the elmo character encoder outputs, prebuilt from words and filled lazily for unseen words."""
+        encoder = self.elmo_model._elmo_lstm._token_embedder
+        if any(p.requires_grad for p in encoder.parameters()):
+            raise ValueError("elmo token cache requires a frozen character encoder, ex) Elmo(..., requires_grad=False)")
+        self.token_cache = ElmoTokenCache(encoder, max_size=max_size)
+        self.token_cache.build(words)
+        encoder.forward = self.token_cache
+
     def forward(self, x):
         # x[0,1] : [batch_size, seq_size]
         # x[2]   : [batch_size, seq_size, max_characters_per_token]
@@ -673,21 +1195,24 @@ class ElmoLSTMCRF(BaseModel):
         # lengths : [batch_size]
 
         # 1. Embedding
-        elmo_embed_out = self.elmo_model(char_ids)['elmo_representations'][0]
+        with stage('elmo'):
+            elmo_embed_out = self.elmo_model(char_ids)['elmo_representations'][0]
         # elmo_embed_out  : [batch_size, seq_size, elmo_emb_dim]
         '''
         masks = mask.unsqueeze(2).to(torch.float)
         # masks : [batch_size, seq_size, 1]
         elmo_embed_out *= masks # auto-braodcasting
         '''
-        token_embed_out = self.embed_token(token_ids)
-        # token_embed_out : [batch_size, seq_size, token_emb_dim]
-        pos_embed_out = self.embed_pos(pos_ids)
-        # pos_embed_out   : [batch_size, seq_size, pos_emb_dim]
+        with stage('embedding'):
+            token_embed_out = self.embed_token(token_ids)
+            # token_embed_out : [batch_size, seq_size, token_emb_dim]
+            pos_embed_out = self.embed_pos(pos_ids)
+            # pos_embed_out   : [batch_size, seq_size, pos_emb_dim]
         if self.use_char_cnn:
             char_ids = x[2]
             # char_ids : [batch_size, seq_size, char_n_ctx]
-            charcnn_out = self.charcnn(char_ids)
+            with stage('charcnn'):
+                charcnn_out = self.charcnn(char_ids)
             # charcnn_out : [batch_size, seq_size, self.charcnn.last_dim]
             embed_out = torch.cat([elmo_embed_out, token_embed_out, pos_embed_out, charcnn_out], dim=-1)
             # embed_out : [batch_size, seq_size, emb_dim]
@@ -697,18 +1222,17 @@ class ElmoLSTMCRF(BaseModel):
         embed_out = self.dropout(embed_out)
 
         # 2. LSTM
-        packed_embed_out = torch.nn.utils.rnn.pack_padded_sequence(embed_out, lengths, batch_first=True, enforce_sorted=False)
-        lstm_out, (h_n, c_n) = self.lstm(packed_embed_out)
-        lstm_out, _ = torch.nn.utils.rnn.pad_packed_sequence(lstm_out, batch_first=True, total_length=self.seq_size)
+        with stage('encoder.lstm'):
+            lstm_out = self.encode_lstm(embed_out, lengths)
         # lstm_out : [batch_size, seq_size, lstm_hidden_dim*2]
         lstm_out = self.dropout(lstm_out)
 
         # 3. Output
-        logits = self.linear(lstm_out)
+        with stage('linear'):
+            logits = self.linear(lstm_out)
         # logits : [batch_size, seq_size, label_size]
         if not self.use_crf: return logits
-        prediction = self.crf.decode(logits)
-        prediction = torch.as_tensor(prediction, dtype=torch.long)
+        prediction = self.decode_crf(logits, mask)
         # prediction : [batch_size, seq_size]
         return logits, prediction
 
@@ -182,7 +182,11 @@ def build_data(input_path, tokenizer):
     logger.info("Vocab coverage : {:.2f}%\n".format(cover_token_cnt/total_token_cnt*100.0))
     return data
 
-def write_data(opt, data, output_path, tokenizer, poss, labels):
+def write_data(opt, data, output_path, tokenizer, poss, labels, unlabeled=False):
+    """
+    Args:
+      unlabeled: if True, write pad label ids and map unknown pos to pad pos id, ex) unlabeled text for distillation.
+    """
     logger.info("\n[Writing data]")
     config = tokenizer.config
     pad_id = tokenizer.pad_id
@@ -203,7 +207,8 @@ def write_data(opt, data, output_path, tokenizer, poss, labels):
         # pos ids
         pos_ids = []
         for pos in posseq:
-            pos_id = poss[pos]
+            if unlabeled: pos_id = poss.get(pos, config['pad_pos_id'])
+            else: pos_id = poss[pos]
             pos_ids.append(pos_id)
         for _ in range(config['n_ctx'] - len(pos_ids)):
             pos_ids.append(config['pad_pos_id'])
@@ -211,7 +216,8 @@ def write_data(opt, data, output_path, tokenizer, poss, labels):
         # label ids
         label_ids = []
         for label in labelseq:
-            label_id = labels[label]
+            if unlabeled: label_id = config['pad_label_id']
+            else: label_id = labels[label]
             label_ids.append(label_id)
         for _ in range(config['n_ctx'] - len(label_ids)):
             label_ids.append(config['pad_label_id'])
@@ -274,6 +280,13 @@ def preprocess_glove_or_elmo(config):
     path = os.path.join(opt.data_dir, _TEST_FILE + _SUFFIX)
     write_data(opt, test_data, path, tokenizer, poss, labels)
 
+    if opt.unlabeled_filename:
+        # unlabeled text in the same format(label column is ignored), for distillation
+        path = os.path.join(opt.data_dir, opt.unlabeled_filename)
+        unlabeled_data = build_data(path, tokenizer)
+        path = os.path.join(opt.data_dir, opt.unlabeled_filename + _SUFFIX)
+        write_data(opt, unlabeled_data, path, tokenizer, poss, labels, unlabeled=True)
+
     path = os.path.join(opt.data_dir, _VOCAB_FILE)
     write_vocab(vocab, path)
 
@@ -359,6 +372,8 @@ def main():
     parser.add_argument('--data_dir', type=str, default='data/conll2003')
     parser.add_argument('--embedding_path', type=str, default='embeddings/glove.6B.300d.txt')
     parser.add_argument("--seed", default=5, type=int)
+    parser.add_argument('--unlabeled_filename', type=str, default='',
+                        help="Unlabeled text file in data_dir for distillation, same format as train.txt(label column is ignored).")
     # for BERT
     parser.add_argument("--bert_model_name_or_path", type=str, default='bert-base-uncased',
                         help="Path to pre-trained model or shortcut name(ex, bert-base-uncased)")
@@ -0,0 +1,53 @@
+import argparse
+
+import torch
+
+from bundle import save_bundle, load_bundle
+
+def write_dict(path, dic):
+    with open(path, 'w', encoding='utf-8') as f:
+        for idx, key in dic.items(): f.write('{} {}\n'.format(key, idx))
+
+def create_bert_dir(tmp_path):
+    from transformers import BertConfig, BertTokenizer
+    bert_dir = tmp_path / 'bert'
+    bert_dir.mkdir()
+    vocab_path = tmp_path / 'vocab.txt'
+    vocab_path.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + ['w{}'.format(i) for i in range(45)]) + '\n')
+    BertTokenizer(str(vocab_path)).save_pretrained(str(bert_dir))
+    BertConfig(vocab_size=50, hidden_size=16, num_hidden_layers=2, num_attention_heads=2, intermediate_size=32).save_pretrained(str(bert_dir))
+    return str(bert_dir)
+
+def test_bundle_load_model(tmp_path):
+    from transformers import AutoConfig, AutoModel
+    from model import BertLSTMCRF
+    from evaluate import load_model, set_path
+    labels = {0: '<pad>', 1: 'O', 2: 'B-PER', 3: 'I-PER'}
+    poss = {0: '<pad>', 1: 'NN'}
+    write_dict(tmp_path / 'label.txt', labels)
+    write_dict(tmp_path / 'pos.txt', poss)
+    opt = argparse.Namespace(device='cpu', seed=42, bert_output_dir=create_bert_dir(tmp_path), use_crf=True,
+                             bert_use_pos=False, bert_disable_lstm=False, bert_use_feature_based=False, bert_exit_layers='',
+                             label_path=str(tmp_path / 'label.txt'), pos_path=str(tmp_path / 'pos.txt'))
+    config = {'opt': opt, 'emb_class': 'bert', 'n_ctx': 12, 'pad_pos_id': 0, 'pad_label_id': 0,
+              'dsa_num_attentions': 2, 'dsa_dim': 8, 'dsa_r': 2, 'pos_emb_dim': 4, 'dropout': 0.0, 'lstm_hidden_dim': 8, 'lstm_num_layers': 1, 'lstm_dropout': 0.0}
+    torch.manual_seed(0)
+    bert_config = AutoConfig.from_pretrained(opt.bert_output_dir)
+    model = BertLSTMCRF(config, bert_config, AutoModel.from_config(bert_config), None, opt.label_path, opt.pos_path, use_crf=True).eval()
+    bundle_path = str(tmp_path / 'model.bundle')
+    save_bundle(config, model.state_dict(), bundle_path)
+
+    # flags come from the bundle
+    load_opt = argparse.Namespace(device='cpu', seed=42, bundle_path=bundle_path, data_dir=str(tmp_path / 'missing'),
+                                  bert_output_dir=str(tmp_path / 'missing'), use_crf=False)
+    load_config, checkpoint = load_bundle(load_opt)
+    set_path(load_config)
+    assert load_opt.use_crf
+    loaded = load_model(load_config, checkpoint).eval()
+    input_ids = torch.randint(5, 50, (2, 12))
+    x = [input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids), torch.ones_like(input_ids)]
+    with torch.no_grad():
+        logits, prediction = model(x)
+        loaded_logits, loaded_prediction = loaded(x)
+    assert torch.allclose(logits, loaded_logits)
+    assert torch.equal(prediction, loaded_prediction)
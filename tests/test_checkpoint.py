@@ -0,0 +1,41 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import checkpoint
+from checkpoint import content_hash, exclude_frozen, restore_frozen
+
+def create_artifact(tmp_path, seed=0):
+    path = str(tmp_path / 'embedding.npy')
+    np.save(path, np.random.RandomState(seed).rand(10, 4).astype(np.float32))
+    return path
+
+def load_embedding(path):
+    return {'embed_token.weight': torch.as_tensor(np.load(path))}
+
+def test_restore_frozen_hash_cache(tmp_path, monkeypatch):
+    path = create_artifact(tmp_path)
+    sources = load_embedding(path)
+    state_dict = {'linear.weight': torch.zeros(2, 2)}
+    state_dict.update(sources)
+    refs = {'embed_token.weight': {'artifact': 'embedding.npy', 'sha1': content_hash(sources['embed_token.weight'])}}
+    slim = exclude_frozen(state_dict, refs)
+    calls = []
+    monkeypatch.setattr(checkpoint, 'content_hash', lambda tensor: calls.append(1) or content_hash(tensor))
+    artifact_paths = {'embedding.npy': path}
+    for _ in range(2):
+        restored = restore_frozen(slim, sources, artifact_paths=artifact_paths)
+        assert torch.equal(restored['embed_token.weight'], sources['embed_token.weight'])
+    # hashed on the first load only
+    assert len(calls) == 1
+    assert os.path.exists(path + '.sha1')
+
+    # the artifact changed, the cache is stale
+    path = create_artifact(tmp_path, seed=1)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    with pytest.raises(ValueError):
+        restore_frozen(slim, load_embedding(path), artifact_paths=artifact_paths)
+    assert len(calls) == 2
@@ -0,0 +1,45 @@
+import argparse
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import TensorDataset, Subset
+
+from dataset import CoNLLBertDataset, BertFeatureDataset, create_loader
+from model import compute_bert_hidden_states
+from test_model import create_bert_model, create_bert_inputs
+
+def create_feature_dataset(tmp_path, model, x):
+    # same as train.build_bert_feature_cache()
+    dataset = CoNLLBertDataset.__new__(CoNLLBertDataset)
+    dataset.x = TensorDataset(*x)
+    dataset.y = x[1].clone()
+    lengths = x[1].sum(dim=1).numpy()
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    with torch.no_grad():
+        stack = compute_bert_hidden_states(model.config, model.bert_model, x)
+    features = np.memmap(str(tmp_path / 'cache.feat'), dtype=np.float16, mode='w+', shape=(offsets[-1],) + stack.shape[2:])
+    features[:] = stack[x[1] != 0].to(torch.float16).numpy()
+    features.flush()
+    return BertFeatureDataset(model.config, dataset, str(tmp_path / 'cache.feat'), offsets, stack.shape[2], stack.shape[3])
+
+@pytest.mark.parametrize('max_tokens_per_batch', [0, 20])
+def test_feature_cache_loader(tmp_path, max_tokens_per_batch):
+    model = create_bert_model(use_crf=False, feature_based=True)
+    config = model.config
+    config['opt'] = argparse.Namespace(device='cpu', batch_size=2, max_tokens_per_batch=max_tokens_per_batch)
+    x = create_bert_inputs([9, 4, 6, 2, 12])
+    dataset = create_feature_dataset(tmp_path, model, x)
+    assert dataset[1][0][4].shape == (4, 4, 16)
+    for d in [dataset, Subset(dataset, [0, 2, 4])]:
+        loader = create_loader(config, d, sampling=False, num_workers=0)
+        num_examples = 0
+        for bx, _ in loader:
+            assert len(bx) == 5 and bx[4].shape[0] == int(bx[1].sum())
+            with torch.no_grad():
+                cached = model(bx)
+                # fp16 cache
+                expected = model(bx[:4])
+            assert torch.allclose(cached, expected, atol=1e-2)
+            num_examples += bx[0].shape[0]
+        assert num_examples == len(d)
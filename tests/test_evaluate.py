@@ -0,0 +1,65 @@
+import os
+
+import pytest
+import torch.multiprocessing as mp
+
+from evaluate import get_result
+
+def test_get_result_dead_worker():
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    p = ctx.Process(target=os._exit, args=(3,))
+    p.start()
+    with pytest.raises(RuntimeError, match='exited with code 3'):
+        get_result(result_queue, [p], timeout=0.1)
+    p.join()
+
+def test_get_result_finished_worker():
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    p = ctx.Process(target=result_queue.put, args=((0, 'done'),))
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+    assert get_result(result_queue, [p], timeout=0.1) == (0, 'done')
+
+@pytest.mark.parametrize('use_io_binding', [True, False])
+def test_onnx_backend(tmp_path, use_io_binding):
+    pytest.importorskip('onnxruntime')
+    import torch
+    from evaluate import convert_onnx
+    from util_ort import OrtBackend
+    from test_model import create_bert_model, create_bert_inputs
+    model = create_bert_model(use_crf=False)
+    config = model.config
+    opt = config['opt']
+    opt.onnx_path, opt.onnx_opset, opt.use_crf, opt.bert_use_pos = str(tmp_path / 'model.onnx'), 14, False, False
+    convert_onnx(config, model, create_bert_inputs([12, 12]))
+    ort_session = OrtBackend(config, opt.onnx_path, model.label_size, use_io_binding=use_io_binding)
+    # dynamic batch and sequence axes
+    x = [t[:, :9] for t in create_bert_inputs([9, 4, 6])]
+    with torch.no_grad():
+        logits = model(x)
+    ort_logits, prediction = ort_session.run(x)
+    assert prediction is None
+    assert torch.allclose(ort_logits, logits, atol=1e-4)
+
+def test_evaluate_sharded_keeps_opt():
+    import argparse
+    import numpy as np
+    import torch
+    from evaluate import evaluate_sharded, predict_loader
+    from dataset import create_loader
+    from test_inference import TinyTagger
+    opt = argparse.Namespace(device='cpu', num_examples=5, num_processes=2, cores_per_process=0, core_offset=0, num_threads=1,
+                             enable_ort=False, enable_dqm=False, stage_profile=False, use_crf=False, batch_size=2, max_tokens_per_batch=0)
+    config = {'opt': opt, 'n_ctx': 6, 'pad_label_id': 0}
+    torch.manual_seed(0)
+    model = TinyTagger().eval()
+    input_ids = torch.randint(1, 100, (7, 6))
+    dataset = [([ids, torch.ones_like(ids)], torch.ones_like(ids)) for ids in input_ids]
+    preds, ys, stats = evaluate_sharded(config, model, dataset)
+    assert opt.num_examples == 5
+    assert stats['total_examples'] == 5
+    expected, _, _ = predict_loader(config, model, create_loader(config, dataset, num_workers=0), verbose=False)
+    assert np.array_equal(preds, expected[:5])
@@ -0,0 +1,137 @@
+import argparse
+import io
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from inference import SentenceConverter
+
+class WordPieceTokenizer():
+    # splits a word into pieces of 3 characters, no piece for zero width spaces
+    cls_token = '[CLS]'
+    sep_token = '[SEP]'
+    pad_token = '[PAD]'
+
+    special_ids = {pad_token: 0, cls_token: 1, sep_token: 2}
+    vocab_size = 100
+
+    def tokenize(self, word):
+        word = word.replace('\u200b', '')
+        pieces = [word[i:i+3] for i in range(0, len(word), 3)]
+        return [piece if i == 0 else '##' + piece for i, piece in enumerate(pieces)]
+
+    def convert_tokens_to_ids(self, tokens):
+        # same ids in every process
+        return [self.special_ids.get(token, sum(map(ord, token)) % (self.vocab_size - 3) + 3) for token in tokens]
+
+def create_converter(n_ctx):
+    opt = argparse.Namespace(sliding_window=False, window_overlap=0)
+    config = {'opt': opt, 'emb_class': 'bert', 'n_ctx': n_ctx,
+              'pad_label_id': 0, 'pad_pos_id': 0, 'pad_pos': 'X', 'default_label': 'O',
+              'bundle': {'poss': {0: 'X', 1: 'NN'}}}
+    model = SimpleNamespace(bert_tokenizer=WordPieceTokenizer())
+    return SentenceConverter(config, model)
+
+def convert(converter, words):
+    windows = converter([[word, 'NN'] for word in words])
+    assert len(windows) == 1
+    x, word_positions, begin, end = windows[0]
+    assert all(len(t) == converter.config['n_ctx'] for t in x)
+    return x[0].tolist(), word_positions
+
+def test_zero_sub_token_word():
+    converter = create_converter(16)
+    input_ids, word_positions = convert(converter, ['John', '\u200b', 'lives', 'here'])
+    # [CLS] Joh ##n liv ##es her ##e [SEP]
+    assert word_positions == [1, None, 3, 5]
+    assert input_ids[3] == converter.tokenizer.convert_tokens_to_ids(['liv'])[0]
+
+@pytest.mark.parametrize('words', [['John', '\u200b', 'lives', 'here', 'now'],
+                                   ['\u200b', 'John', 'lives', 'here', '\u200b']])
+def test_zero_sub_token_word_truncated(words):
+    converter = create_converter(6)
+    input_ids, word_positions = convert(converter, words)
+    # 4 sub-tokens fit between [CLS] and [SEP], only the first two words with sub-tokens survive
+    positions = [position for position in word_positions if position is not None]
+    assert positions == [1, 3]
+    for word, position in zip(words, word_positions):
+        if word == '\u200b': assert position is None
+
+def test_produce_passes_error():
+    import queue
+    from inference import produce, _END_OF_STREAM
+
+    def converter(entries):
+        if entries[0][0] == 'bad': raise ValueError(entries[0][0])
+        return []
+
+    read_queue = queue.Queue()
+    produce(io.StringIO('good NN\n\nbad NN\n\nnever NN\n'), 'conll', converter, read_queue)
+    assert read_queue.get()[0] == [['good', 'NN']]
+    error = read_queue.get()
+    assert isinstance(error, ValueError)
+    assert read_queue.empty()
+
+    read_queue = queue.Queue()
+    produce(io.StringIO('good NN\n'), 'conll', converter, read_queue)
+    read_queue.get()
+    assert read_queue.get() is _END_OF_STREAM
+
+class TinyTagger(torch.nn.Module):
+    # token embedding and a linear layer, with the attributes inference.py reads from the models
+    def __init__(self):
+        super().__init__()
+        self.labels = {0: '<pad>', 1: 'O', 2: 'B-PER', 3: 'I-PER'}
+        self.label_size = len(self.labels)
+        self.bert_tokenizer = WordPieceTokenizer()
+        self.embed = torch.nn.Embedding(WordPieceTokenizer.vocab_size, 8)
+        self.linear = torch.nn.Linear(8, self.label_size)
+
+    def forward(self, x):
+        return self.linear(self.embed(x[0]))
+
+class CrashingTagger(TinyTagger):
+    def forward(self, x):
+        os._exit(7)
+
+def create_serve_config(tmp_path, num_processes):
+    config = create_converter(16).config
+    opt = config['opt']
+    for key, value in dict(device='cpu', num_threads=1, batch_size=2, max_tokens_per_batch=0, queue_size=4,
+                           num_processes=num_processes, cores_per_process=0, core_offset=0, use_crf=False,
+                           enable_ort=False, enable_dqm=False, ort_optimized_model_path='', exit_threshold=0,
+                           stage_profile=False, stage_trace_path='', input_format='conll',
+                           input_path=str(tmp_path / 'input.txt'), output_path=str(tmp_path / 'output.txt')).items():
+        setattr(opt, key, value)
+    words = ['John', 'lives', 'in', 'Seoul', 'now', '​', 'Mary']
+    with open(opt.input_path, 'w', encoding='utf-8') as f:
+        for i in range(11):
+            for word in words[i % 3:i % 3 + 3]:
+                f.write(word + ' NN\n')
+            f.write('\n')
+    return config
+
+def test_serve(tmp_path):
+    from inference import serve, tag_docs, write_batch, read_sentences
+    config = create_serve_config(tmp_path, 2)
+    opt = config['opt']
+    torch.manual_seed(0)
+    model = TinyTagger().eval()
+    serve(config, model)
+    with open(opt.output_path, encoding='utf-8') as f:
+        output = f.read()
+    converter = SentenceConverter(config, model)
+    with open(opt.input_path, encoding='utf-8') as f:
+        docs = [(entries, converter(entries)) for entries in read_sentences(f)]
+    expected = io.StringIO()
+    with torch.no_grad():
+        write_batch(expected, docs, tag_docs(config, model, docs), model.labels, config['default_label'])
+    assert output == expected.getvalue()
+
+def test_serve_dead_worker(tmp_path):
+    from inference import serve
+    config = create_serve_config(tmp_path, 2)
+    with pytest.raises(RuntimeError, match='exited with code 7'):
+        serve(config, CrashingTagger().eval())
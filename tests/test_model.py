@@ -0,0 +1,290 @@
+import argparse
+import pickle
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.multiprocessing as mp
+
+from model import ElmoTokenCache
+
+class CharacterEncoder(nn.Module):
+    # same inputs and outputs as allennlp's _ElmoCharacterEncoder, <S> and </S> are zero vectors
+    def __init__(self):
+        super().__init__()
+        self.embed = nn.Embedding(262, 4)
+        for p in self.parameters(): p.requires_grad = False
+
+    def forward(self, inputs):
+        # inputs : [batch_size, seq_size, max_characters_per_token]
+        token_embedding = F.pad(self.embed(inputs).sum(dim=-2), (0, 0, 1, 1))
+        mask = F.pad((inputs > 0).long().sum(dim=-1).gt(0).long(), (1, 1), value=1)
+        return {'mask': mask, 'token_embedding': token_embedding}
+
+def create_token_cache(char_ids):
+    encoder = CharacterEncoder()
+    cache = ElmoTokenCache(encoder)
+    encoder.forward = cache
+    cache.lookup(char_ids)
+    return encoder
+
+def encode(encoder, char_ids):
+    with torch.no_grad():
+        return type(encoder).forward(encoder, char_ids.unsqueeze(1))['token_embedding'][:, 1]
+
+def lookup_worker(encoder, char_ids, result_queue):
+    cache = encoder.forward
+    out = cache.lookup(char_ids)
+    # numpy, tensors would be shared with this process, which exits before they are received
+    result_queue.put((out.numpy(), cache.stats(), encode(encoder, char_ids).numpy()))
+
+@pytest.mark.parametrize('cache_first', [False, True])
+def test_token_cache_pickle(cache_first):
+    char_ids = torch.randint(1, 262, (5, 50))
+    encoder = create_token_cache(char_ids[:3])
+    # the model may reach the cache before the encoder, ex) ElmoLSTMCRF.token_cache
+    if cache_first: cache, encoder = pickle.loads(pickle.dumps((encoder.forward, encoder)))
+    else: encoder = pickle.loads(pickle.dumps(encoder))
+    cache = encoder.forward
+    assert isinstance(cache, ElmoTokenCache) and cache.encoder is encoder
+    assert torch.allclose(cache.lookup(char_ids), encode(encoder, char_ids))
+    assert cache.stats()['hits'] == 3 and cache.stats()['misses'] == 3 + 2
+
+def test_token_cache_spawn():
+    char_ids = torch.randint(1, 262, (5, 50))
+    encoder = create_token_cache(char_ids[:3])
+    encoder.share_memory()
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    p = ctx.Process(target=lookup_worker, args=(encoder, char_ids, result_queue))
+    p.start()
+    out, stats, expected = result_queue.get(timeout=60)
+    p.join()
+    assert p.exitcode == 0
+    out, expected = torch.from_numpy(out), torch.from_numpy(expected)
+    assert torch.allclose(out, expected)
+    assert torch.allclose(out, encode(encoder, char_ids))
+    assert stats['hits'] == 3 and stats['misses'] == 3 + 2
+
+def create_bert_model(use_crf=True, disable_lstm=False, feature_based=False, exit_layers=None):
+    from transformers import BertConfig, BertModel
+    from model import BertLSTMCRF
+    opt = argparse.Namespace(device='cpu', seed=42)
+    config = {'opt': opt, 'emb_class': 'bert', 'n_ctx': 12, 'pad_pos_id': 0, 'pad_label_id': 0,
+              'dsa_num_attentions': 2, 'dsa_dim': 8, 'dsa_r': 2, 'pos_emb_dim': 4, 'dropout': 0.0,
+              'lstm_hidden_dim': 8, 'lstm_num_layers': 1, 'lstm_dropout': 0.0}
+    torch.manual_seed(0)
+    bert_config = BertConfig(vocab_size=50, hidden_size=16, num_hidden_layers=3, num_attention_heads=2, intermediate_size=32)
+    bert_model = BertModel(bert_config)
+    labels = {0: '<pad>', 1: 'O', 2: 'B-PER', 3: 'I-PER', 4: 'B-LOC'}
+    model = BertLSTMCRF(config, bert_config, bert_model, None, labels, {0: '<pad>', 1: 'NN'}, use_crf=use_crf,
+                        disable_lstm=disable_lstm, feature_based=feature_based, exit_layers=exit_layers)
+    # random transitions, so that the padding would move the best path if it was decoded
+    if use_crf:
+        for p in model.crf.parameters(): nn.init.normal_(p, std=2.0)
+    return model.eval()
+
+def create_bert_inputs(lengths, n_ctx=12):
+    torch.manual_seed(1)
+    input_ids = torch.randint(3, 50, (len(lengths), n_ctx))
+    input_mask = torch.zeros(len(lengths), n_ctx, dtype=torch.long)
+    for i, length in enumerate(lengths): input_mask[i, :length] = 1
+    input_ids = input_ids * input_mask
+    return [input_ids, input_mask, torch.zeros_like(input_ids), input_mask.clone()]
+
+@pytest.mark.parametrize('disable_lstm, feature_based', [(True, True), (False, True), (False, False)])
+def test_crf_decode_ignores_padding(disable_lstm, feature_based):
+    model = create_bert_model(disable_lstm=disable_lstm, feature_based=feature_based)
+    lengths = [9, 4, 6]
+    x = create_bert_inputs(lengths)
+    with torch.no_grad():
+        logits, prediction = model(x)
+        # trimmed batch, ex) --max_tokens_per_batch
+        _, trimmed = model([t[:, :max(lengths)] for t in x])
+        # each sentence alone without padding
+        alone = [model([t[i:i+1, :length] for t in x])[1][0] for i, length in enumerate(lengths)]
+    assert prediction.shape == (3, 12)
+    assert torch.equal(prediction[:, :max(lengths)], trimmed)
+    for i, length in enumerate(lengths):
+        assert torch.equal(prediction[i, :length], alone[i])
+        assert prediction[i, length:].eq(0).all()
+
+def test_feature_based_dsa_is_frozen():
+    model = create_bert_model(use_crf=False, feature_based=True).train()
+    model(create_bert_inputs([9, 4])).sum().backward()
+    assert all(p.grad is None for p in list(model.dsa.parameters()) + list(model.layernorm_dsa.parameters()))
+    assert model.linear.weight.grad is not None
+
+def autocast_modes():
+    # bfloat16 on cpu, float16 on cuda if available
+    modes = [('cpu', torch.bfloat16)]
+    if torch.cuda.is_available(): modes.append(('cuda', torch.float16))
+    return modes
+
+def test_early_exit_word_mask():
+    model = create_bert_model(use_crf=False, exit_layers=[1])
+    x = create_bert_inputs([9])
+    with torch.no_grad():
+        _, exit_logits = model(x, return_exits=True)
+        probs = torch.softmax(exit_logits[0][0, :9], dim=-1).max(dim=-1)[0]
+        # only the most confident position is a word, the others are [CLS], [SEP] or sub-tokens
+        word_mask = torch.zeros_like(x[1], dtype=torch.bool)
+        word_mask[0, probs.argmax()] = True
+        threshold = (probs.max().item() + probs.min().item()) / 2
+        _, _, exit_layer = model.forward_early_exit(x, threshold, word_mask=word_mask)
+        _, _, all_tokens_exit_layer = model.forward_early_exit(x, threshold)
+        # no exit, the layer by layer path should match the full model
+        full_logits, _, _ = model.forward_early_exit(x, 2.0)
+        logits = model(x)
+    assert exit_layer.tolist() == [1]
+    assert all_tokens_exit_layer.tolist() == [model.bert_num_layers]
+    assert torch.allclose(full_logits[0, :9], logits[0, :9], atol=1e-5)
+
+def test_saved_tensors_counter_checkpointing():
+    from model import enable_checkpointing, SavedTensorsCounter
+    model = create_bert_model(use_crf=False).train()
+    x = create_bert_inputs([9, 4])
+    saved = []
+    for enabled in [False, True]:
+        if enabled:
+            for layer in model.bert_model.encoder.layer: enable_checkpointing(layer)
+        with SavedTensorsCounter() as counter:
+            loss = model(x).sum()
+        loss.backward()
+        saved.append(counter.bytes)
+    # only the inputs of the checkpointed layers are kept
+    assert 0 < saved[1] < saved[0]
+
+def create_densenet(activation=F.relu):
+    from model import DenseNet
+    torch.manual_seed(0)
+    densenet = DenseNet([[1, 3], [3, 5], [5, 7]], 12, 10, 6, 8, activation=activation)
+    return densenet.eval()
+
+def create_densenet_inputs(device='cpu'):
+    torch.manual_seed(1)
+    x = torch.randn(3, 9, 12, device=device)
+    mask = torch.ones(3, 9, dtype=torch.long, device=device)
+    mask[1, 5:] = 0
+    mask[2, 2:] = 0
+    return x, mask
+
+@pytest.mark.parametrize('activation', [F.relu, torch.tanh])
+def test_densenet_preallocated(activation):
+    densenet = create_densenet(activation=activation)
+    x, mask = create_densenet_inputs()
+    with torch.no_grad():
+        # preallocated buffers
+        out = densenet(x, mask)
+    # concatenation, the path with autograd
+    expected = densenet(x, mask)
+    assert expected.requires_grad and not out.requires_grad
+    assert torch.allclose(out, expected.detach(), atol=1e-6)
+
+@pytest.mark.parametrize('device, dtype', autocast_modes())
+def test_densenet_autocast(device, dtype):
+    densenet = create_densenet().to(device)
+    x, mask = create_densenet_inputs(device)
+    with torch.no_grad():
+        expected = densenet(x, mask)
+        with torch.autocast(device, dtype=dtype):
+            out = densenet(x, mask)
+    assert torch.allclose(out.float(), expected, atol=5e-2, rtol=5e-2)
+
+def create_dsa():
+    from model import DSA
+    torch.manual_seed(0)
+    return DSA({'opt': argparse.Namespace(device='cpu')}, 3, 16, 8, dsa_r=2)
+
+def create_dsa_inputs(device='cpu'):
+    torch.manual_seed(1)
+    x = torch.randn(4, 7, 16, device=device)
+    mask = torch.ones(4, 7, dtype=torch.long, device=device)
+    mask[1, 3:] = 0
+    mask[3, 1:] = 0
+    return x, mask
+
+@pytest.mark.parametrize('use_mask', [True, False])
+def test_dsa_fused(use_mask):
+    dsa = create_dsa()
+    x, mask = create_dsa_inputs()
+    if not use_mask: mask = torch.ones_like(mask)
+    x_ref = x.clone().requires_grad_()
+    x.requires_grad_()
+    out = dsa(x, mask if use_mask else None)
+    expected = dsa.forward_reference(x_ref, mask)
+    assert torch.allclose(out, expected, atol=1e-5)
+    # same gradients, no gradient through the attention weights in both
+    grad = torch.randn_like(out)
+    params = list(dsa.parameters())
+    grads = torch.autograd.grad(out, [x] + params, grad)
+    expected_grads = torch.autograd.grad(expected, [x_ref] + params, grad)
+    for g, e in zip(grads, expected_grads):
+        assert torch.allclose(g, e, atol=1e-5)
+    with torch.no_grad():
+        assert torch.allclose(dsa.eval()(x, mask), dsa.forward_reference(x, mask), atol=1e-5)
+
+@pytest.mark.parametrize('device, dtype', autocast_modes())
+def test_dsa_fused_autocast(device, dtype):
+    dsa = create_dsa().to(device)
+    dsa.device = device
+    x, mask = create_dsa_inputs(device)
+    with torch.no_grad(), torch.autocast(device, dtype=dtype):
+        out = dsa(x, mask)
+        expected = dsa.forward_reference(x, mask)
+    assert out.dtype == torch.float32
+    assert torch.allclose(out, expected.float(), atol=5e-2)
+
+def create_charcnn(capacity):
+    from model import CharCNN
+    config = {'opt': argparse.Namespace(device='cpu'), 'n_ctx': 6, 'char_n_ctx': 5, 'char_vocab_size': 20,
+              'char_emb_dim': 4, 'char_num_filters': 3, 'char_kernel_sizes': [2, 3], 'char_padding_idx': 0}
+    torch.manual_seed(0)
+    charcnn = CharCNN(config)
+    charcnn.enable_cache(capacity)
+    return charcnn.eval()
+
+def create_char_ids():
+    # 2 sentences of 6 words, repeated words and padding
+    torch.manual_seed(1)
+    words = torch.randint(1, 20, (4, 5))
+    words[:, 3:] = 0
+    pad = torch.zeros(5, dtype=torch.long)
+    return torch.stack([torch.stack([words[0], words[1], words[0], words[2], pad, pad]),
+                        torch.stack([words[3], words[1], words[1], pad, pad, pad])])
+
+def encode_each(charcnn, char_ids):
+    # every position separately, the original implementation
+    return charcnn._CharCNN__encode(char_ids.reshape(-1, char_ids.shape[-1])).view(char_ids.shape[0], char_ids.shape[1], -1)
+
+@pytest.mark.parametrize('capacity', [0, 3, 100])
+def test_charcnn_cache(capacity):
+    charcnn = create_charcnn(capacity)
+    char_ids = create_char_ids()
+    with torch.no_grad():
+        expected = encode_each(charcnn, char_ids)
+        for _ in range(2):
+            out = charcnn(char_ids)
+            assert torch.allclose(out, expected, atol=1e-6)
+    if capacity == 100:
+        # 5 distinct words including padding, missed in the first pass and hit in the second
+        assert charcnn.cache.stats()['misses'] == 5 and charcnn.cache.stats()['hits'] == 5
+    # training and autograd do not use the cache
+    out = charcnn(char_ids)
+    assert out.requires_grad
+    assert torch.allclose(out, expected, atol=1e-6)
+
+@pytest.mark.parametrize('device, dtype', autocast_modes())
+def test_charcnn_cache_autocast(device, dtype):
+    charcnn = create_charcnn(100).to(device)
+    char_ids = create_char_ids().to(device)
+    with torch.no_grad():
+        expected = encode_each(charcnn, char_ids)
+        with torch.autocast(device, dtype=dtype):
+            out = charcnn(char_ids)
+        # vectors cached under autocast are not reused at full precision
+        full = charcnn(char_ids)
+    assert torch.allclose(out.float(), expected, atol=5e-2)
+    assert full.dtype == torch.float32
+    assert torch.allclose(full, expected, atol=1e-6)
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import subprocess
+
+import numpy as np
+import pytest
+
+from etc.token_eval import TokenEval, eval_files
+
+TOKEN_EVAL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'etc', 'token_eval.py')
+
+# tag, pred
+FILE_A = [('B-PER', 'B-PER'), ('I-PER', 'O'), ('O', 'O'), None, ('B-LOC', 'B-LOC'), ('O', 'B-LOC')]
+FILE_B = [('B-LOC', 'B-PER'), ('O', 'O'), None, ('B-PER', 'B-PER')]
+
+def write_file(path, rows, skip_line=False):
+    with open(path, 'wb') as f:
+        if skip_line: f.write(b'USING SKIP CONNECTIONS\n')
+        for row in rows:
+            if row is None: f.write(b'\n')
+            else: f.write('w NN B-NP {} {}\n'.format(*row).encode('utf-8'))
+    return str(path)
+
+def test_update_lines_misformed():
+    ev = TokenEval()
+    # 3 + 7 + 5 columns, 15 in total like 3 valid lines
+    ev.update_lines([b'USING SKIP CONNECTIONS\n', b'EU NNP B-NP B-ORG B-ORG extra junk\n', b'EU NNP B-NP B-ORG O\n'])
+    assert ev.num_skipped == 2
+    assert ev.labels == ['B-ORG', 'O']
+    assert ev.confusion.tolist() == [[0, 1], [0, 0]]
+
+def test_scores():
+    ev = TokenEval()
+    ev.update_lines(['w NN B-NP {} {}\n'.format(*row).encode('utf-8') if row else b'\n' for row in FILE_A + FILE_B])
+    ret = ev.scores()
+    per_label = ret['per_label']
+    assert (per_label['B-PER']['tp'], per_label['B-PER']['fp'], per_label['B-PER']['fn']) == (2, 1, 0)
+    assert (per_label['B-LOC']['tp'], per_label['B-LOC']['fp'], per_label['B-LOC']['fn']) == (1, 1, 1)
+    assert (per_label['I-PER']['tp'], per_label['I-PER']['fp'], per_label['I-PER']['fn']) == (0, 0, 1)
+    # micro over the labels except 'O'
+    assert (per_label['I']['tp'], per_label['I']['fp'], per_label['I']['fn']) == (3, 2, 2)
+    assert ret['micro']['precision'] == pytest.approx(3 / 5)
+    assert ret['micro']['fscore'] == pytest.approx(3 / 5)
+    assert ret['macro']['precision'] == pytest.approx((2 / 3 + 1 / 2 + 0) / 3)
+    assert ret['macro']['recall'] == pytest.approx((1 + 1 / 2 + 0) / 3)
+    assert ret['accuracy'] == pytest.approx(5 / 8)
+    assert ret['num_tokens'] == 8
+
+@pytest.mark.parametrize('num_processes', [1, 2])
+def test_eval_files_merge(tmp_path, num_processes):
+    paths = [write_file(tmp_path / 'a.txt', FILE_A), write_file(tmp_path / 'b.txt', FILE_B, skip_line=True)]
+    evs = eval_files(paths, num_processes=num_processes)
+    assert evs[paths[1]].num_skipped == 1
+    # merging the per-file matrices, indexed by different label orders, equals reading both files at once
+    merged = TokenEval()
+    for path in paths: merged.merge(evs[path].labels, evs[path].confusion)
+    whole = TokenEval()
+    for path in paths:
+        with open(path, 'rb') as f: whole.read(f)
+    order = [merged.labels.index(label) for label in whole.labels]
+    assert np.array_equal(merged.confusion[np.ix_(order, order)], whole.confusion)
+    assert merged.scores()['micro'] == whole.scores()['micro']
+
+def test_json_output(tmp_path):
+    paths = [write_file(tmp_path / 'a.txt', FILE_A), write_file(tmp_path / 'b.txt', FILE_B, skip_line=True)]
+    out = subprocess.run([sys.executable, TOKEN_EVAL_PATH, '--json'] + paths, stdout=subprocess.PIPE, check=True).stdout
+    rets = json.loads(out)
+    assert sorted(rets.keys()) == sorted(paths)
+    assert rets[paths[1]]['num_skipped'] == 1
+    assert rets[paths[0]]['micro']['fscore'] == pytest.approx(eval_files(paths[:1])[paths[0]].scores()['micro']['fscore'])
+    # regression gate
+    ret = subprocess.run([sys.executable, TOKEN_EVAL_PATH, '--min_fscore', '0.99'] + paths, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert ret.returncode == 1
@@ -0,0 +1,291 @@
+import copy
+import contextlib
+import os
+import socket
+
+import pytest
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from model import enable_checkpointing
+from test_model import create_bert_model, create_bert_inputs
+
+def init_process_group(tmp_path, rank=0, world_size=1):
+    dist.init_process_group('gloo', init_method='file://' + str(tmp_path / 'store'), rank=rank, world_size=world_size)
+
+def compute_grads(train_model, model, batches, use_amp, accumulation):
+    # same bert dropout masks in both runs
+    torch.manual_seed(0)
+    model.zero_grad()
+    for i, (x, y) in enumerate(batches):
+        update_step = (i + 1) % accumulation == 0
+        # skip gradient all-reduce while accumulating, same as train_epoch()
+        sync_context = train_model.no_sync() if isinstance(train_model, DistributedDataParallel) and not update_step else contextlib.nullcontext()
+        with sync_context:
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=use_amp):
+                loss = train_model(x, y) / accumulation
+            loss.backward()
+    return {name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None}
+
+@pytest.mark.parametrize('use_amp', [False, True])
+def test_checkpointing_ddp_accumulation(tmp_path, use_amp):
+    from train import ModelWithLoss
+    model = create_bert_model(use_crf=False).train()
+    model.config['opt'].use_crf = False
+    checkpointed = copy.deepcopy(model)
+    for layer in checkpointed.bert_model.encoder.layer: enable_checkpointing(layer)
+    lengths = [[9, 4], [6, 11]]
+    batches = []
+    for i, batch_lengths in enumerate(lengths):
+        x = create_bert_inputs(batch_lengths)
+        torch.manual_seed(i)
+        batches.append((x, torch.randint(1, 5, x[0].shape) * x[1]))
+
+    expected = compute_grads(ModelWithLoss(model.config, model), model, batches, use_amp, len(batches))
+    init_process_group(tmp_path)
+    try:
+        # some parameters are unused, ex) dsa for fine-tuning, same as train.py
+        train_model = DistributedDataParallel(ModelWithLoss(checkpointed.config, checkpointed), find_unused_parameters=True)
+        grads = compute_grads(train_model, checkpointed, batches, use_amp, len(batches))
+    finally:
+        dist.destroy_process_group()
+    assert grads.keys() == expected.keys()
+    for name, grad in grads.items():
+        assert torch.allclose(grad, expected[name], atol=1e-5 if not use_amp else 1e-2), name
+
+class PositionTeacher(torch.nn.Module):
+    # logits are the position, input id and pos id of each token
+    def __init__(self, n_ctx):
+        super().__init__()
+        from test_inference import WordPieceTokenizer
+        self.config = {'emb_class': 'bert', 'n_ctx': n_ctx, 'pad_pos_id': 0}
+        self.bert_tokenizer = WordPieceTokenizer()
+        self.label_size = 3
+        self.use_crf = False
+
+    def forward(self, x):
+        positions = torch.arange(x[0].shape[1]).expand_as(x[0])
+        return torch.stack([positions, x[0], x[3]], dim=-1).float()
+
+def test_compute_teacher_outputs(tmp_path):
+    import argparse
+    from train import compute_teacher_outputs
+    path = tmp_path / 'train.txt.ids'
+    sentences = [(['John', '\u200b', 'lives', 'here', 'now'], [1, 2, 3, 1, 2]), (['Hi'], [3])]
+    with open(path, 'w', encoding='utf-8') as f:
+        for words, pos_ids in sentences:
+            f.write('0\t0\t{}\t{}\n'.format(' '.join(map(str, pos_ids)), ' '.join(words)))
+    opt = argparse.Namespace(device='cpu', eval_batch_size=2, use_amp=False)
+    config = {'opt': opt, 'n_ctx': 6, 'pad_label_id': 0}
+    teacher = PositionTeacher(8)
+    logits, preds, _ = compute_teacher_outputs(config, teacher, str(path))
+    assert logits.shape == (2, 6, 3)
+    # [CLS] Joh ##n liv ##es her ##e [SEP], 'now' is truncated by the teacher
+    assert logits[0, :, 0].tolist() == [1, 0, 3, 5, 0, 0]
+    assert logits[0, :, 2].tolist() == [1, 0, 3, 1, 0, 0]
+    ids = teacher.bert_tokenizer.convert_tokens_to_ids(['Joh', 'liv', 'her', 'Hi'])
+    assert logits[0, [0, 2, 3], 1].tolist() == ids[:3]
+    assert logits[1, :, 0].tolist() == [1, 0, 0, 0, 0, 0]
+    assert logits[1, 0, 1] == ids[3]
+
+class SparseTagger(torch.nn.Module):
+    # trainable sparse embedding + dense linear, same split as --embedding_sparse
+    def __init__(self):
+        super().__init__()
+        self.embed = torch.nn.Embedding(10, 4, padding_idx=0, sparse=True)
+        self.linear = torch.nn.Linear(4, 3)
+
+    def forward(self, x):
+        return self.linear(self.embed(x))
+
+def sparse_step(optimizer, model, x):
+    from train import clip_grad_norm
+    model(x).sum().backward()
+    clip_grad_norm(model.parameters(), 1.0)
+    optimizer.step()
+    optimizer.zero_grad()
+
+def test_multiple_optimizer_sparse_embedding():
+    import argparse
+    from train import prepare_osws, MultipleOptimizer
+    opt = argparse.Namespace(lr=0.1, adam_epsilon=1e-8, weight_decay=0.01, lr_decay_rate=1.0, use_transformers_optimizer=False,
+                             distributed=False, rank=1)
+    torch.manual_seed(0)
+    model = SparseTagger()
+    resumed_model = copy.deepcopy(model)
+    optimizer, _, _, _ = prepare_osws({'opt': opt}, model, [])
+    assert isinstance(optimizer, MultipleOptimizer)
+    # x : [batch_size, seq_size], 0 is the padding
+    x = torch.tensor([[3, 5, 0], [5, 7, 0]])
+    weight = model.embed.weight.detach().clone()
+    sparse_step(optimizer, model, x)
+    changed = (model.embed.weight != weight).any(dim=-1).nonzero().flatten().tolist()
+    assert changed == [3, 5, 7]
+    assert torch.equal(model.embed.weight[0], weight[0])
+    # same as torch.optim.Optimizer.zero_grad()
+    assert all(p.grad is None for p in model.parameters())
+
+    # state_dict round trip, the next step is the same as without a restart
+    resumed_optimizer, _, _, _ = prepare_osws({'opt': opt}, resumed_model, [])
+    resumed_model.load_state_dict(model.state_dict())
+    resumed_optimizer.load_state_dict(copy.deepcopy(optimizer.state_dict()))
+    x = torch.tensor([[5, 8, 0]])
+    sparse_step(optimizer, model, x)
+    sparse_step(resumed_optimizer, resumed_model, x)
+    for name, p in model.state_dict().items():
+        assert torch.equal(p, resumed_model.state_dict()[name]), name
+
+class TinyGloveDataset(torch.utils.data.Dataset):
+    # same items as CoNLLGloveDataset, ((token_ids, pos_ids), label_ids)
+    def __init__(self, n_examples, n_ctx):
+        g = torch.Generator().manual_seed(0)
+        lengths = torch.randint(1, n_ctx + 1, (n_examples,), generator=g)
+        mask = (torch.arange(n_ctx)[None, :] < lengths[:, None]).long()
+        self.x = torch.utils.data.TensorDataset(torch.randint(1, 10, (n_examples, n_ctx), generator=g) * mask,
+                                                torch.randint(1, 3, (n_examples, n_ctx), generator=g) * mask)
+        self.y = torch.randint(1, 6, (n_examples, n_ctx), generator=g) * mask
+
+    def __len__(self):
+        return len(self.y)
+
+    def __getitem__(self, idx):
+        return self.x[idx], self.y[idx]
+
+def create_glove_model(opt, dropout=0.0, seed=0):
+    from model import GloveLSTMCRF
+    config = {'opt': opt, 'emb_class': 'glove', 'n_ctx': 6, 'pad_token_id': 0, 'pad_pos_id': 0, 'pad_label_id': 0,
+              'pos_emb_dim': 3, 'lstm_hidden_dim': 4, 'lstm_num_layers': 1, 'lstm_dropout': 0.0, 'dropout': dropout}
+    labels = {0: '<pad>', 1: 'O', 2: 'B-PER', 3: 'I-PER', 4: 'B-LOC', 5: 'I-LOC'}
+    # same frozen embedding in every model, the rest is initialized by the seed
+    embedding = torch.randn(10, 4, generator=torch.Generator().manual_seed(0))
+    torch.manual_seed(seed)
+    model = GloveLSTMCRF(config, embedding, labels, {0: '<pad>', 1: 'NN', 2: 'VB'})
+    return config, model
+
+def run_validations(opt, n_examples, n_validations):
+    """Predictions gathered from every rank and the early stopping of a series of validations on perturbed weights."""
+    from dataset import create_loader
+    from early_stopping import EarlyStopping
+    from train import evaluate, gather_predictions, consume_eval_result, logger
+    config, model = create_glove_model(opt)
+    model.eval()
+    loader = create_loader(config, TinyGloveDataset(n_examples, config['n_ctx']), batch_size=2)
+    preds, ys = [], []
+    with torch.no_grad():
+        for x, y in loader:
+            preds.append(model(x).argmax(dim=-1).numpy())
+            ys.append(y.numpy())
+    preds, ys = gather_predictions(opt, np.concatenate(preds), np.concatenate(ys), n_examples)
+
+    config.update({'optimizer': torch.optim.SGD(model.parameters(), lr=0.1), 'scheduler': None, 'writer': None,
+                   'early_stopping': EarlyStopping(logger, patience=1, measure='f1'), 'stop_training': False,
+                   'progress': {'epoch': -1, 'local_worse_steps': 0, 'prev_eval_f1': -float('inf'), 'best_eval_f1': -float('inf')}})
+    f1s = []
+    for global_step in range(n_validations):
+        # same weights on every rank, ex) after an all-reduced update
+        torch.manual_seed(global_step)
+        with torch.no_grad():
+            for p in model.parameters(): p.add_(torch.randn_like(p))
+        eval_ret = evaluate(model, config, loader)
+        f1s.append(eval_ret['f1'])
+        consume_eval_result(model, config, eval_ret, {'epoch': 0, 'global_step': global_step})
+        if config['stop_training']: break
+    return {'preds': preds, 'ys': ys, 'f1s': f1s, 'stop_step': global_step}
+
+def validation_worker(rank, world_size, port, tmp_path, n_examples, n_validations):
+    import argparse
+    from train import init_distributed
+    opt = argparse.Namespace(distributed=True, local_rank=rank, device='cpu', dist_backend='gloo', seed=0,
+                             use_crf=False, batch_size=2, save_path=None, lr_decay_steps=2, warmup_epoch=0, use_transformers_optimizer=False)
+    os.environ.update({'RANK': str(rank), 'WORLD_SIZE': str(world_size), 'LOCAL_RANK': str(rank),
+                       'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port)})
+    init_distributed(opt)
+    try:
+        torch.save(run_validations(opt, n_examples, n_validations), tmp_path / 'rank{}.pt'.format(rank))
+    finally:
+        dist.destroy_process_group()
+
+def test_distributed_validation(tmp_path):
+    import argparse
+    # the last example is padded by DistributedSampler, rank 1 sees example 0 twice
+    n_examples, n_validations, world_size = 7, 8, 2
+    opt = argparse.Namespace(distributed=False, rank=0, world_size=1, device='cpu', seed=0,
+                             use_crf=False, batch_size=2, save_path=None, lr_decay_steps=2, warmup_epoch=0, use_transformers_optimizer=False)
+    expected = run_validations(opt, n_examples, n_validations)
+    # stops before the last validation, otherwise the step is not a test
+    assert expected['stop_step'] < n_validations - 1
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    mp.spawn(validation_worker, args=(world_size, port, tmp_path, n_examples, n_validations), nprocs=world_size)
+    for rank in range(world_size):
+        result = torch.load(tmp_path / 'rank{}.pt'.format(rank), weights_only=False)
+        assert np.array_equal(result['preds'], expected['preds'])
+        assert np.array_equal(result['ys'], expected['ys'])
+        assert result['f1s'] == pytest.approx(expected['f1s'])
+        assert result['stop_step'] == expected['stop_step']
+
+class PendingEvaluator():
+    # one result of --async_eval which arrives only when waited for
+    def __init__(self, f1):
+        self.results = [({'epoch': 0, 'global_step': 0}, {'loss': 1.0, 'f1': f1}, None)]
+
+    def poll(self, wait=False):
+        if not wait: return []
+        results = self.results
+        self.results = []
+        return results
+
+def create_train_config(tmp_path, model_seed, evaluator=None):
+    import argparse
+    from dataset import create_loader
+    from early_stopping import EarlyStopping
+    from checkpoint import AsyncCheckpointer
+    from train import ModelWithLoss, prepare_osws, logger
+    opt = argparse.Namespace(device='cpu', distributed=False, rank=0, world_size=1, seed=0, batch_size=2, use_crf=False, use_amp=False,
+                             use_profiler=False, gradient_accumulation_steps=1, max_grad_norm=1.0, log_interval=50, eval_steps=1000,
+                             lr=0.1, adam_epsilon=1e-8, weight_decay=0.01, lr_decay_rate=1.0, use_transformers_optimizer=False,
+                             lr_decay_steps=2, warmup_epoch=0, save_path=None, save_frozen_params=False, embedding_path='embedding.npy',
+                             log_dir=str(tmp_path / 'runs'), checkpoint_dir=str(tmp_path / 'checkpoints'), checkpoint_steps=3)
+    # dropout makes the steps depend on the restored rng
+    config, model = create_glove_model(opt, dropout=0.5, seed=model_seed)
+    train_loader = create_loader(config, TinyGloveDataset(10, config['n_ctx']), sampling=True, num_workers=0)
+    optimizer, scheduler, writer, scaler = prepare_osws(config, model, train_loader)
+    config.update({'optimizer': optimizer, 'scheduler': scheduler, 'writer': writer, 'scaler': scaler,
+                   'train_model': ModelWithLoss(config, model), 'evaluator': evaluator, 'stop_training': False,
+                   'early_stopping': EarlyStopping(logger, patience=1, measure='f1'), 'checkpointer': AsyncCheckpointer(keep=2),
+                   'progress': {'epoch': -1, 'global_step': -1, 'local_step': 0, 'local_worse_steps': 0,
+                                'prev_eval_f1': -float('inf'), 'best_eval_f1': -float('inf')}})
+    return config, model, train_loader
+
+def test_resume_checkpoint_steps(tmp_path):
+    from checkpoint import latest_checkpoint
+    from train import train_epoch, load_checkpoint
+    config, model, train_loader = create_train_config(tmp_path, 0, evaluator=PendingEvaluator(0.5))
+    assert len(train_loader) == 5
+    for epoch_i in range(2):
+        train_epoch(model, config, train_loader, None, epoch_i)
+        config['progress']['epoch'] = epoch_i
+    config['checkpointer'].close()
+    # saved at the global steps 3, 6, 9 without the end of an epoch, the last 2 are kept
+    checkpoint_path = latest_checkpoint(config['opt'].checkpoint_dir)
+    assert os.path.basename(checkpoint_path) == 'checkpoint-0001-00000004.pt'
+    assert len(os.listdir(config['opt'].checkpoint_dir)) == 2
+    state = torch.load(checkpoint_path, weights_only=False)
+    assert state['progress']['global_step'] == 8
+    # the pending result is consumed before the first save
+    assert state['progress']['best_eval_f1'] == 0.5
+    assert state['early_stopping'] == {'step': 0, 'value': 0.5}
+
+    # resume the 5th batch of the 2nd epoch in another process, a different initialization
+    resumed_config, resumed_model, resumed_loader = create_train_config(tmp_path, 1)
+    progress = load_checkpoint(resumed_config, resumed_model)
+    resumed_config['progress'] = progress
+    assert (progress['epoch'], progress['local_step']) == (0, 4)
+    train_epoch(resumed_model, resumed_config, resumed_loader, None, progress['epoch'] + 1)
+    resumed_config['checkpointer'].close()
+    for name, p in model.state_dict().items():
+        assert torch.equal(p, resumed_model.state_dict()[name]), name
@@ -0,0 +1,39 @@
+import threading
+
+from util import AsyncSummaryWriter
+
+class BlockingWriter():
+    def __init__(self):
+        self.release = threading.Event()
+        self.scalars = []
+        self.closed = False
+
+    def add_scalar(self, tag, value, step):
+        if tag == 'fail': raise OSError('disk full')
+        self.release.wait()
+        self.scalars.append((tag, value, step))
+
+    def close(self):
+        self.closed = True
+
+def test_async_summary_writer_drops_when_full():
+    writer = BlockingWriter()
+    summary_writer = AsyncSummaryWriter(writer, max_queue_size=2)
+    # the thread blocks on the first call, the next two fill the queue, the rest are dropped
+    for step in range(10):
+        summary_writer.add_scalar('Loss/train', 0.1, step)
+    assert summary_writer.num_dropped >= 7
+    writer.release.set()
+    summary_writer.close()
+    assert writer.closed
+    assert 1 <= len(writer.scalars) <= 3
+
+def test_async_summary_writer_write_error():
+    writer = BlockingWriter()
+    writer.release.set()
+    summary_writer = AsyncSummaryWriter(writer)
+    summary_writer.add_scalar('fail', 0.0, 0)
+    summary_writer.add_scalar('Loss/train', 0.1, 1)
+    summary_writer.close()
+    assert isinstance(summary_writer.error, OSError)
+    assert writer.scalars == [('Loss/train', 0.1, 1)]
@@ -7,12 +7,21 @@ import time
 import pdb
 import json
 import logging
+import contextlib
+import resource
+import copy
+import queue
+import hashlib
+from collections import OrderedDict
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.cuda.amp import autocast, GradScaler
+from torch.utils.data import DataLoader, SequentialSampler, Subset, ConcatDataset
 import torch.autograd.profiler as profiler
 
 try:
@@ -23,11 +32,15 @@ import numpy as np
 import random
 from seqeval.metrics import precision_score, recall_score, f1_score, classification_report
 
-from util    import load_config, to_device, to_numpy
-from model   import GloveLSTMCRF, GloveDensenetCRF, BertLSTMCRF, ElmoLSTMCRF
-from dataset import prepare_dataset, CoNLLGloveDataset, CoNLLBertDataset, CoNLLElmoDataset
+from util    import load_config, to_device, to_numpy, pad_to_seq_size, load_conll_words, AsyncSummaryWriter, get_memory_usage
+from model   import GloveLSTMCRF, GloveDensenetCRF, BertLSTMCRF, ElmoLSTMCRF, enable_checkpointing, SavedTensorsCounter
+from dataset import prepare_dataset, create_loader, skip_batches, CoNLLGloveDataset, CoNLLBertDataset, CoNLLElmoDataset, BertFeatureDataset, DistillDataset
+from util_bert import InputExample, convert_single_example_to_feature
 from progbar import Progbar # instead of tqdm
+import util_profile
+from util_profile import stage
 from early_stopping import EarlyStopping
+from checkpoint import AsyncCheckpointer, to_cpu, latest_checkpoint, content_hash, exclude_frozen, restore_frozen, get_artifact_paths
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -38,6 +51,215 @@ def set_seed(opt):
     torch.manual_seed(opt.seed)
     torch.cuda.manual_seed(opt.seed)
 
+def init_distributed(opt):
+    opt.rank = 0
+    opt.world_size = 1
+    if not opt.distributed: return
+    # launched by torchrun(or torch.distributed.launch --use_env), which sets RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT
+    opt.local_rank = int(os.environ.get('LOCAL_RANK', opt.local_rank))
+    use_cuda = opt.device.startswith('cuda') and torch.cuda.is_available()
+    backend = opt.dist_backend
+    if not backend: backend = 'nccl' if use_cuda else 'gloo'
+    dist.init_process_group(backend=backend, init_method='env://')
+    opt.rank = dist.get_rank()
+    opt.world_size = dist.get_world_size()
+    if use_cuda:
+        torch.cuda.set_device(opt.local_rank)
+        opt.device = 'cuda:%d' % opt.local_rank
+    if opt.rank != 0:
+        logging.getLogger().setLevel(logging.WARNING)
+    logger.info("[distributed] backend {}, world size {}".format(backend, opt.world_size))
+
+def gather_predictions(opt, preds, ys, num_examples):
+    # DistributedSampler(shuffle=False) gives rank r the examples r, r + world_size, r + 2*world_size, ...
+    if not opt.distributed: return preds, ys
+    gathered = [None] * opt.world_size
+    dist.all_gather_object(gathered, (preds, ys))
+    preds = np.stack([g[0] for g in gathered], axis=1).reshape((-1,) + preds.shape[1:])[:num_examples]
+    ys = np.stack([g[1] for g in gathered], axis=1).reshape((-1,) + ys.shape[1:])[:num_examples]
+    return preds, ys
+
+def all_reduce_mean(opt, value):
+    if not opt.distributed: return value
+    t = torch.tensor(value, dtype=torch.float64, device=opt.device)
+    dist.all_reduce(t)
+    return t.item() / opt.world_size
+
+class ModelWithLoss(nn.Module):
+    """Compute the training loss inside forward(),
+    so that DistributedDataParallel sees every parameter used in the loss(ex, crf).
+    """
+
+    def __init__(self, config, model):
+        super(ModelWithLoss, self).__init__()
+        self.config = config
+        self.model = model
+        self.criterion = nn.CrossEntropyLoss(ignore_index=config['pad_label_id'])
+
+    def forward(self, x, y):
+        model = self.model
+        use_exits = len(getattr(model, 'exit_layers', [])) > 0
+        with stage('train.forward'):
+            if use_exits: outputs, exit_logits = model(x, return_exits=True)
+            else: outputs = model(x)
+        if self.config['opt'].use_crf:
+            logits, prediction = outputs
+            with stage('train.loss'):
+                mask = torch.sign(torch.abs(x[0])).to(torch.uint8).to(logits.device)
+                log_likelihood = model.crf(logits, y, mask=mask, reduction='mean')
+                loss = -1 * log_likelihood
+        else:
+            logits = outputs
+            with stage('train.loss'):
+                # reshape for computing loss
+                logits_view = logits.view(-1, model.label_size)
+                y_view = y.view(-1)
+                loss = self.criterion(logits_view, y_view)
+        if use_exits:
+            with stage('train.loss'):
+                loss = loss + self.config['opt'].exit_loss_weight * self.exit_loss(logits, exit_logits, y)
+        return loss
+
+    def exit_loss(self, logits, exit_logits, y):
+        """Average loss of the exit heads, on the gold labels(joint) or on the final logits(self-distillation).
+        """
+        opt = self.config['opt']
+        label_size = self.model.label_size
+        token_mask = (y != self.config['pad_label_id']).to(torch.float)
+        # token_mask : [batch_size, seq_size], first sub-tokens of the words
+        losses = []
+        for head_logits in exit_logits:
+            if opt.exit_training == 'distill':
+                teacher_probs = F.softmax(logits.detach().float(), dim=-1)
+                student_log_probs = F.log_softmax(head_logits.float(), dim=-1)
+                kl = (teacher_probs * (torch.log(teacher_probs.clamp(min=1e-12)) - student_log_probs)).sum(dim=-1)
+                # kl : [batch_size, seq_size]
+                losses.append((kl * token_mask).sum() / token_mask.sum().clamp(min=1))
+            else:
+                losses.append(self.criterion(head_logits.view(-1, label_size), y.view(-1)))
+        return sum(losses) / len(losses)
+
+class DistillModelWithLoss(ModelWithLoss):
+    """Combined loss of the hard labels and the soft labels of a teacher, y == [label_ids, teacher_logits].
+    """
+
+    def forward(self, x, y):
+        opt = self.config['opt']
+        model = self.model
+        pad_label_id = self.config['pad_label_id']
+        y, teacher_logits = y[0], y[1]
+        # sentences of unlabeled text have only pad labels
+        labeled = (y != pad_label_id).any(dim=1)
+        with stage('train.forward'):
+            if opt.use_crf: logits, prediction = model(x)
+            else: logits = model(x)
+        with stage('train.loss'):
+            if opt.use_crf:
+                mask = torch.sign(torch.abs(x[0])).to(torch.uint8).to(logits.device)
+                log_likelihood = model.crf(logits, y, mask=mask, reduction='none')
+                hard_loss = -1 * (log_likelihood * labeled.to(log_likelihood.dtype)).sum() / labeled.sum().clamp(min=1)
+            else:
+                hard_loss = F.cross_entropy(logits.view(-1, model.label_size), y.view(-1), ignore_index=pad_label_id, reduction='sum')
+                hard_loss = hard_loss / (y != pad_label_id).sum().clamp(min=1)
+            # KL(teacher || student) over the words, all-zero teacher logits mark the words truncated for the teacher.
+            T = opt.distill_temperature
+            token_mask = (x[0] != self.config['pad_token_id']) & (teacher_logits != 0).any(dim=-1)
+            student_log_probs = F.log_softmax(logits.float() / T, dim=-1)
+            teacher_probs = F.softmax(teacher_logits.float() / T, dim=-1)
+            kl = (teacher_probs * (torch.log(teacher_probs.clamp(min=1e-12)) - student_log_probs)).sum(dim=-1)
+            # kl : [batch_size, seq_size]
+            soft_loss = (kl * token_mask.to(kl.dtype)).sum() / token_mask.sum().clamp(min=1) * T * T
+            loss = (1 - opt.distill_alpha) * hard_loss + opt.distill_alpha * soft_loss
+        return loss
+
+def count_tokens(config, x):
+    # number of non-pad tokens of a batch on the host
+    if config['emb_class'] in ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']: return int(x[1].sum()) # input_mask
+    return int((x[0] != config['pad_token_id']).sum())
+
+class ThroughputMeter():
+    """Sentences/s, non-pad tokens/s, data loader wait and peak memory of a training epoch.
+
+    with --log_step_timing, the 'train.*' stages(h2d, forward, loss, backward, optimizer) are measured
+    by util_profile, which synchronizes the device at the stage boundaries.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.opt = config['opt']
+        self.use_cuda = self.opt.device.startswith('cuda') and torch.cuda.is_available()
+        self.profiler = util_profile.get_profiler()
+        if self.profiler: self.profiler.reset()
+        if self.use_cuda: torch.cuda.reset_peak_memory_stats(self.opt.device)
+        self.num_sentences = 0
+        self.num_tokens = 0
+        self.data_wait = 0.0
+        self.paused = 0.0
+        self.start = time.perf_counter()
+
+    def step(self, x, step_end):
+        # x : batch on the host, step_end : time when the previous step finished
+        now = time.perf_counter()
+        self.data_wait += now - step_end
+        if self.profiler: self.profiler.add('train.data_wait', step_end, now, 0)
+        self.num_sentences += x[0].shape[0]
+        self.num_tokens += count_tokens(self.config, x)
+
+    @contextlib.contextmanager
+    def pause(self):
+        # exclude validation from the throughput and the stage stats
+        st = time.perf_counter()
+        profiler = util_profile.disable()
+        try:
+            yield
+        finally:
+            util_profile.set_profiler(profiler)
+            self.paused += time.perf_counter() - st
+
+    def report(self, epoch_i, global_step, n_steps):
+        opt = self.opt
+        writer = self.config['writer']
+        elapsed = max(1e-6, time.perf_counter() - self.start - self.paused)
+        # sum over ranks
+        num_sentences = all_reduce_mean(opt, self.num_sentences) * opt.world_size
+        num_tokens = all_reduce_mean(opt, self.num_tokens) * opt.world_size
+        ret = {'epoch': epoch_i,
+               'global_step': global_step,
+               'steps': n_steps,
+               'elapsed_sec': elapsed,
+               'sentences_per_sec': num_sentences / elapsed,
+               'tokens_per_sec': num_tokens / elapsed,
+               'data_wait_ratio': self.data_wait / elapsed,
+               'peak_device_mb': torch.cuda.max_memory_allocated(opt.device) / 2**20 if self.use_cuda else 0,
+               # ru_maxrss is the peak since the process started(KB on linux), not reset per epoch like the device peak
+               'lifetime_peak_host_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+               'host_rss_mb': get_memory_usage().get('rss', 0.0),
+               'step_ms': {}}
+        if self.profiler:
+            stages = self.profiler.summary()
+            for name, st in stages.items():
+                if name.startswith('train.'): ret['step_ms'][name[len('train.'):]] = st['total_ms'] / n_steps
+            ret['stages'] = stages
+        logger.info("[throughput] {:.1f} sentences/s, {:.1f} tokens/s, data wait {:.1f}% | peak memory device {:.1f}MB(epoch), host {:.1f}MB(lifetime) | host rss {:.1f}MB".\
+            format(ret['sentences_per_sec'], ret['tokens_per_sec'], ret['data_wait_ratio'] * 100, ret['peak_device_mb'],
+                   ret['lifetime_peak_host_mb'], ret['host_rss_mb']))
+        if ret['step_ms']:
+            logger.info("[throughput] ms/step : {}".format(', '.join('{} {:.2f}'.format(k, v) for k, v in ret['step_ms'].items())))
+        if opt.rank != 0: return ret
+        if writer:
+            writer.add_scalar('Throughput/sentences_per_sec', ret['sentences_per_sec'], global_step)
+            writer.add_scalar('Throughput/tokens_per_sec', ret['tokens_per_sec'], global_step)
+            writer.add_scalar('Throughput/data_wait_ratio', ret['data_wait_ratio'], global_step)
+            writer.add_scalar('Memory/peak_device_mb', ret['peak_device_mb'], global_step)
+            writer.add_scalar('Memory/lifetime_peak_host_mb', ret['lifetime_peak_host_mb'], global_step)
+            writer.add_scalar('Memory/host_rss_mb', ret['host_rss_mb'], global_step)
+            for name, ms in ret['step_ms'].items():
+                writer.add_scalar('StepTime/{}_ms'.format(name), ms, global_step)
+        if not os.path.exists(opt.log_dir): os.makedirs(opt.log_dir)
+        with open(os.path.join(opt.log_dir, 'throughput-epoch-{}.json'.format(epoch_i)), 'w', encoding='utf-8') as f:
+            json.dump(ret, f, indent=2)
+        return ret
+
 def train_epoch(model, config, train_loader, val_loader, epoch_i):
     opt = config['opt']
 
@@ -47,79 +269,288 @@ def train_epoch(model, config, train_loader, val_loader, epoch_i):
     scaler = config['scaler']
     pad_label_id = config['pad_label_id']
 
-    criterion = nn.CrossEntropyLoss(ignore_index=pad_label_id).to(opt.device)
+    train_model = config['train_model']
+    progress = config['progress']
     n_batches = len(train_loader)
-    prog = Progbar(target=n_batches)
+    prog = Progbar(target=n_batches, verbose=int(opt.rank == 0))
+    # reshuffle differently at every epoch
+    for sampler in [train_loader.sampler, train_loader.batch_sampler]:
+        if hasattr(sampler, 'set_epoch'): sampler.set_epoch(epoch_i)
+    # resumed from a checkpoint in the middle of this epoch(--checkpoint_steps), same order of batches by the epoch seed.
+    skip_steps = progress.get('local_step', 0)
+    progress['local_step'] = 0
+    loader = train_loader
+    if skip_steps > 0:
+        logger.info("[Resume in the middle of epoch {}] : skip {} of {} batches".format(epoch_i, skip_steps, n_batches))
+        loader = skip_batches(train_loader, skip_steps)
     # train one epoch
     model.train()
-    train_loss = 0.
+    # accumulate losses on the device, synchronize only when logging is flushed.
+    train_loss = torch.zeros((), device=opt.device)
+    interval_loss = torch.zeros((), device=opt.device)
+    interval_steps = 0
+    meter = ThroughputMeter(config)
     st_time = time.time()
     optimizer.zero_grad()
-    for local_step, (x,y) in enumerate(train_loader):
+    step_end = time.perf_counter()
+    for local_step, (x,y) in enumerate(loader, start=skip_steps):
         global_step = (len(train_loader) * epoch_i) + local_step
-        x = to_device(x, opt.device)
-        y = to_device(y, opt.device)
-        if opt.use_crf:
-            with autocast(enabled=opt.use_amp):
-                if opt.use_profiler:
-                    with profiler.profile(profile_memory=True, record_shapes=True) as prof:
-                        logits, prediction = model(x)
-                    print(prof.key_averages().table(sort_by="self_cpu_memory_usage", row_limit=10))
-                else:
-                    logits, prediction = model(x)
-                mask = torch.sign(torch.abs(x[0])).to(torch.uint8).to(opt.device)
-                log_likelihood = model.crf(logits, y, mask=mask, reduction='mean')
-                loss = -1 * log_likelihood
-                if opt.gradient_accumulation_steps > 1:
-                    loss = loss / opt.gradient_accumulation_steps
-        else:
+        meter.step(x, step_end)
+        with stage('train.h2d'):
+            x = to_device(x, opt.device)
+            y = to_device(y, opt.device)
+        update_step = (local_step + 1) % opt.gradient_accumulation_steps == 0
+        # skip gradient all-reduce while accumulating
+        if opt.distributed and not update_step: sync_context = train_model.no_sync()
+        else: sync_context = contextlib.nullcontext()
+        with sync_context:
             with autocast(enabled=opt.use_amp):
                 if opt.use_profiler:
                     with profiler.profile(profile_memory=True, record_shapes=True) as prof:
-                        logits = model(x)
+                        loss = train_model(x, y)
                     print(prof.key_averages().table(sort_by="self_cpu_memory_usage", row_limit=10))
                 else:
-                    logits = model(x)
-                # reshape for computing loss
-                logits_view = logits.view(-1, model.label_size)
-                y_view = y.view(-1)
-                loss = criterion(logits_view, y_view)
+                    loss = train_model(x, y)
                 if opt.gradient_accumulation_steps > 1:
                     loss = loss / opt.gradient_accumulation_steps
-        # back-propagation - begin
-        scaler.scale(loss).backward()
-        if (local_step + 1) % opt.gradient_accumulation_steps == 0:
-            scaler.unscale_(optimizer)
-            torch.nn.utils.clip_grad_norm_(model.parameters(), opt.max_grad_norm)
-            scaler.step(optimizer)
-            scaler.update()
-            optimizer.zero_grad()
-            if opt.use_transformers_optimizer: scheduler.step()
+            # back-propagation - begin
+            with stage('train.backward'):
+                scaler.scale(loss).backward()
+        if update_step:
+            with stage('train.optimizer'):
+                scaler.unscale_(optimizer)
+                clip_grad_norm(model.parameters(), opt.max_grad_norm)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+                if opt.use_transformers_optimizer: scheduler.step()
         # back-propagation - end
-        train_loss += loss.item()
-        if writer: writer.add_scalar('Loss/train', loss.item(), global_step)
-        curr_lr = scheduler.get_last_lr()[0] if scheduler else optimizer.param_groups[0]['lr']
-        prog.update(local_step+1,
-                    [('global step', global_step),
-                     ('train curr loss', loss.item()),
-                     ('lr', curr_lr)])
-    train_loss = train_loss / n_batches
-
-    # evaluate
-    eval_ret = evaluate(model, config, val_loader)
+        train_loss += loss.detach()
+        interval_loss += loss.detach()
+        interval_steps += 1
+        if (local_step + 1) % opt.log_interval == 0 or local_step + 1 == n_batches:
+            # flush, the only point to synchronize with the device
+            curr_loss = interval_loss.item() / interval_steps
+            interval_loss.zero_()
+            interval_steps = 0
+            if writer: writer.add_scalar('Loss/train', curr_loss, global_step)
+            curr_lr = scheduler.get_last_lr()[0] if scheduler else optimizer.param_groups[0]['lr']
+            prog.update(local_step+1,
+                        [('global step', global_step),
+                         ('train curr loss', curr_loss),
+                         ('lr', curr_lr)])
+        # evaluate every opt.eval_steps, results may be consumed later(--async_eval)
+        if opt.eval_steps > 0 and (global_step + 1) % opt.eval_steps == 0:
+            with meter.pause():
+                validate(model, config, val_loader, epoch_i, global_step)
+        if config['evaluator']: poll_eval_results(model, config)
+        # full training state after an optimizer update, the end of an epoch is saved by train()
+        if opt.checkpoint_dir and opt.checkpoint_steps > 0 and update_step and (global_step + 1) % opt.checkpoint_steps == 0 and \
+           local_step + 1 < n_batches and not config['stop_training']:
+            with meter.pause():
+                progress['local_step'] = local_step + 1
+                progress['global_step'] = global_step
+                save_checkpoint(config, model, progress, epoch_i=epoch_i)
+                progress['local_step'] = 0
+        if config['stop_training']: break
+        step_end = time.perf_counter()
+    n_steps = local_step + 1 - skip_steps
+    train_loss = train_loss.item() / n_steps
+    train_time = time.time() - st_time
+    steps_per_sec = n_steps / max(1e-6, train_time)
+    logger.info('{:3d} epoch | {:5d}/{:5d} steps | train loss : {:10.6f} | {:.2f} steps/s | {:5.2f} min elapsed'.\
+            format(epoch_i, n_steps, n_batches, train_loss, steps_per_sec, train_time / 60))
+    if writer: writer.add_scalar('Speed/train_steps_per_sec', steps_per_sec, global_step)
+    meter.report(epoch_i, global_step, n_steps)
+
+    # evaluate at the end of epoch
+    if opt.eval_steps <= 0 and not config['stop_training']:
+        validate(model, config, val_loader, epoch_i, global_step)
+
+def validate(model, config, val_loader, epoch_i, global_step):
+    """Run a scheduled validation, on the current weights or on a snapshot in the evaluator process.
+    """
+    info = {'epoch': epoch_i, 'global_step': global_step}
+    if config['evaluator']:
+        config['evaluator'].submit(get_state_dict(config, model), info)
+        poll_eval_results(model, config)
+    else:
+        eval_ret = evaluate(model, config, val_loader)
+        consume_eval_result(model, config, eval_ret, info)
+        model.train()
+
+def poll_eval_results(model, config, wait=False):
+    for info, eval_ret, checkpoint in config['evaluator'].poll(wait=wait):
+        if config['stop_training']: break
+        consume_eval_result(model, config, eval_ret, info, checkpoint=checkpoint)
+
+def consume_eval_result(model, config, eval_ret, info, checkpoint=None):
+    """Early stopping, best model saving and lr decay on a validation result.
+
+    Args:
+      checkpoint: cpu snapshot of the evaluated weights, None if they are the current weights of model.
+    """
+    opt = config['opt']
+    optimizer = config['optimizer']
+    scheduler = config['scheduler']
+    writer = config['writer']
+    early_stopping = config['early_stopping']
+    progress = config['progress']
+    epoch_i = info['epoch']
+    global_step = info['global_step']
+
     eval_loss = eval_ret['loss']
     eval_f1 = eval_ret['f1']
-    curr_time = time.time()
-    elapsed_time = (curr_time - st_time) / 60
-    st_time = curr_time
     curr_lr = scheduler.get_last_lr()[0] if scheduler else optimizer.param_groups[0]['lr']
-    logger.info('{:3d} epoch | {:5d}/{:5d} | train loss : {:10.6f}, valid loss {:10.6f}, valid f1 {:.4f}| lr :{:7.6f} | {:5.2f} min elapsed'.\
-            format(epoch_i, local_step+1, len(train_loader), train_loss, eval_loss, eval_f1, curr_lr, elapsed_time)) 
+    logger.info('{:3d} epoch | {:7d} global step | valid loss {:10.6f}, valid f1 {:.4f}| lr :{:7.6f}'.\
+            format(epoch_i, global_step, eval_loss, eval_f1, curr_lr))
     if writer:
         writer.add_scalar('Loss/valid', eval_loss, global_step)
         writer.add_scalar('F1/valid', eval_f1, global_step)
         writer.add_scalar('LearningRate/train', curr_lr, global_step)
-    return eval_loss, eval_f1
+
+    # early stopping
+    if early_stopping.validate(eval_f1, measure='f1'):
+        config['stop_training'] = True
+        return
+    if eval_f1 > progress['best_eval_f1']:
+        progress['best_eval_f1'] = eval_f1
+        if opt.save_path and opt.rank == 0:
+            logger.info("[Best model saved] : {:10.6f}, {} global step".format(eval_f1, global_step))
+            # also save finetuned bert model/config/tokenizer
+            save_model(config, model, checkpoint=checkpoint)
+        early_stopping.reset(eval_f1)
+    early_stopping.status()
+    # begin: scheduling, apply rate decay at the measure(ex, loss) getting worse for the number of deacy evaluation steps.
+    if progress['prev_eval_f1'] >= eval_f1:
+        progress['local_worse_steps'] += 1
+    else:
+        progress['local_worse_steps'] = 0
+    logger.info('Scheduler: local_worse_steps / opt.lr_decay_steps = %d / %d' % (progress['local_worse_steps'], opt.lr_decay_steps))
+    if not opt.use_transformers_optimizer and \
+       epoch_i > opt.warmup_epoch and \
+       (progress['local_worse_steps'] >= opt.lr_decay_steps or early_stopping.step() > opt.lr_decay_steps):
+        scheduler.step()
+        progress['local_worse_steps'] = 0
+    progress['prev_eval_f1'] = eval_f1
+    # end: scheduling
+
+def make_stratified_subset(config, dataset, labels, size, seed):
+    """Sample a subset of the validation set, stratified by the rarest entity type in each sentence.
+    """
+    pad_label_id = config['pad_label_id']
+    base = dataset.dataset if isinstance(dataset, BertFeatureDataset) else dataset
+    ys = base.y.numpy()
+    if size >= len(ys): return dataset
+    # entity types of each sentence, ex) 'B-PER', 'I-PER' -> 'PER'
+    sent_types = []
+    for y in ys:
+        types = set()
+        for label_id in y:
+            if label_id == pad_label_id: continue
+            label = labels[label_id]
+            if len(label) > 2 and label[1] == '-': types.add(label[2:])
+        sent_types.append(types)
+    type_freq = {}
+    for types in sent_types:
+        for t in types: type_freq[t] = type_freq.get(t, 0) + 1
+    strata = {}
+    for i, types in enumerate(sent_types):
+        key = min(types, key=lambda t: (type_freq[t], t)) if types else ''
+        strata.setdefault(key, []).append(i)
+    rs = np.random.RandomState(seed)
+    indices = []
+    for key in sorted(strata.keys()):
+        members = strata[key]
+        n = max(1, int(round(size * len(members) / len(ys))))
+        indices.extend(rs.choice(members, min(n, len(members)), replace=False).tolist())
+    indices.sort()
+    logger.info("[stratified validation subset] : {} of {} sentences, {} strata".format(len(indices), len(ys), len(strata)))
+    return Subset(dataset, indices)
+
+def prepare_valid_loader(config, model, valid_loader):
+    opt = config['opt']
+    # compute frozen bert features once, train only dsa, lstm, crf on them
+    if opt.bert_use_feature_based and opt.bert_feature_cache_dir:
+        valid_loader = prepare_bert_feature_cache(config, model, valid_loader, sampling=False, batch_size=opt.eval_batch_size)
+    if opt.eval_subset_size > 0:
+        subset = make_stratified_subset(config, valid_loader.dataset, model.labels, opt.eval_subset_size, opt.seed)
+        valid_loader = create_loader(config, subset, sampling=False, num_workers=2, batch_size=opt.eval_batch_size)
+    return valid_loader
+
+def async_eval_worker(opt, in_queue, out_queue):
+    torch.set_num_threads(max(1, opt.async_eval_num_threads))
+    config = load_config(opt)
+    config['opt'] = opt
+    set_path(config)
+    valid_loader = prepare_dataset(config, opt.valid_path, get_dataset_class(config), sampling=False, num_workers=2, batch_size=opt.eval_batch_size)
+    model = prepare_model(config)
+    valid_loader = prepare_valid_loader(config, model, valid_loader)
+    while True:
+        item = in_queue.get()
+        if item is None: break
+        info, checkpoint = item
+        # frozen parameters are the same as the ones built by prepare_model()
+        model.load_state_dict(restore_frozen(checkpoint, model.state_dict(), verify=False))
+        del checkpoint
+        eval_ret = evaluate(model, config, valid_loader)
+        out_queue.put((info, {'loss': eval_ret['loss'], 'f1': eval_ret['f1'],
+                              'precision': eval_ret['precision'], 'recall': eval_ret['recall']}))
+
+class AsyncEvaluator():
+    """Evaluate snapshots of the weights in a separate process while training goes on.
+
+    Args:
+      max_pending: max number of snapshots in flight, submit() waits for a result beyond it.
+    """
+
+    def __init__(self, opt, max_pending=2):
+        eval_opt = copy.copy(opt)
+        eval_opt.device = opt.async_eval_device if opt.async_eval_device else opt.device
+        eval_opt.distributed = False
+        eval_opt.rank = -1 # silent, not a distributed rank
+        eval_opt.world_size = 1
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.in_queue = ctx.Queue()
+        self.out_queue = ctx.Queue()
+        self.process = ctx.Process(target=async_eval_worker, args=(eval_opt, self.in_queue, self.out_queue), daemon=True)
+        self.process.start()
+        self.max_pending = max_pending
+        self.pending = {}
+        self.results = []
+
+    def __receive(self, block):
+        try:
+            info, eval_ret = self.out_queue.get(block=block)
+        except queue.Empty:
+            return False
+        checkpoint = self.pending.pop(info['global_step'])
+        self.results.append((info, eval_ret, checkpoint))
+        return True
+
+    def submit(self, state_dict, info):
+        while len(self.pending) >= self.max_pending:
+            self.__receive(block=True)
+        checkpoint = to_cpu(state_dict)
+        # keep the snapshot to save it when the result turns out to be the best
+        self.pending[info['global_step']] = checkpoint
+        self.in_queue.put((info, checkpoint))
+
+    def poll(self, wait=False):
+        """Return the arrived results, [(info, eval_ret, checkpoint), ...].
+
+        Args:
+          wait: if True, wait for all pending results.
+        """
+        while self.pending and self.__receive(block=wait):
+            pass
+        results = self.results
+        self.results = []
+        return results
+
+    def close(self):
+        self.in_queue.put(None)
+        self.process.join()
  
 def evaluate(model, config, val_loader):
     model.eval()
@@ -129,7 +560,7 @@ def evaluate(model, config, val_loader):
     eval_loss = 0.
     criterion = nn.CrossEntropyLoss(ignore_index=pad_label_id).to(opt.device)
     n_batches = len(val_loader)
-    prog = Progbar(target=n_batches)
+    prog = Progbar(target=n_batches, verbose=int(opt.rank == 0))
     preds = None
     ys    = None
     with torch.no_grad():
@@ -144,19 +575,24 @@ def evaluate(model, config, val_loader):
             else:
                 logits = model(x)
                 loss = criterion(logits.view(-1, model.label_size), y.view(-1))
+            # batches may be trimmed to their longest example(--max_tokens_per_batch), pad back to n_ctx.
+            if opt.use_crf: pred = pad_to_seq_size(to_numpy(prediction), config['n_ctx'])
+            else: pred = pad_to_seq_size(to_numpy(logits), config['n_ctx'])
+            y_np = pad_to_seq_size(to_numpy(y), config['n_ctx'], value=config['pad_label_id'])
             if preds is None:
-                if opt.use_crf: preds = to_numpy(prediction)
-                else: preds = to_numpy(logits)
-                ys = to_numpy(y)
+                preds = pred
+                ys = y_np
             else:
-                if opt.use_crf: preds = np.append(preds, to_numpy(prediction), axis=0)
-                else: preds = np.append(preds, to_numpy(logits), axis=0)
-                ys = np.append(ys, to_numpy(y), axis=0)
+                preds = np.append(preds, pred, axis=0)
+                ys = np.append(ys, y_np, axis=0)
             eval_loss += loss.item()
             prog.update(i+1,
                         [('eval curr loss', loss.item())])
     eval_loss = eval_loss / n_batches
     if not opt.use_crf: preds = np.argmax(preds, axis=2)
+    # every rank computes the same measure from the predictions of all ranks
+    eval_loss = all_reduce_mean(opt, eval_loss)
+    preds, ys = gather_predictions(opt, preds, ys, len(val_loader.dataset))
     # compute measure using seqeval
     labels = model.labels
     ys_lbs = [[] for _ in range(ys.shape[0])]
@@ -173,16 +609,111 @@ def evaluate(model, config, val_loader):
         "f1": f1_score(ys_lbs, preds_lbs),
         "report": classification_report(ys_lbs, preds_lbs, digits=4),
     }
-    print(ret['report'])
+    if opt.rank == 0: print(ret['report'])
     return ret
 
-def save_model(config, model):
+def get_frozen_refs(config, model):
+    """References to the frozen parameters which the model constructors rebuild from data artifacts, see exclude_frozen().
+
+    they do not change while training, hashed only once.
+    """
     opt = config['opt']
-    optimizer = config['optimizer']
-    checkpoint_path = opt.save_path
-    with open(checkpoint_path, 'wb') as f:
-        checkpoint = model.state_dict()
-        torch.save(checkpoint,f)
+    if opt.save_frozen_params: return {}
+    if 'frozen_refs' not in config:
+        # parameter name prefix -> artifact
+        artifacts = {}
+        if config['emb_class'] in ['glove', 'elmo']: artifacts['embed_token.'] = os.path.basename(opt.embedding_path)
+        if config['emb_class'] == 'elmo': artifacts['elmo_model.'] = os.path.basename(opt.elmo_weights_file)
+        frozen_refs = {}
+        for name, param in model.named_parameters():
+            if param.requires_grad: continue
+            for prefix, artifact in artifacts.items():
+                if name.startswith(prefix):
+                    frozen_refs[name] = {'artifact': artifact, 'sha1': content_hash(param)}
+        config['frozen_refs'] = frozen_refs
+    return config['frozen_refs']
+
+def get_state_dict(config, model):
+    # state_dict without the frozen parameters shared with data artifacts
+    return exclude_frozen(model.state_dict(), get_frozen_refs(config, model))
+
+def save_model(config, model, checkpoint=None):
+    opt = config['opt']
+    checkpointer = config['checkpointer']
+    # snapshot once, the background thread writes the model and the finetuned bert weights from it.
+    if checkpoint is None: checkpoint = to_cpu(get_state_dict(config, model))
+    checkpointer.save(checkpoint, opt.save_path, snapshot=False)
+    if config['emb_class'] in ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']:
+        # tokenizer and config do not change while training, save them only once.
+        if not config.get('bert_pretrained_saved', False):
+            if not os.path.exists(opt.bert_output_dir):
+                os.makedirs(opt.bert_output_dir)
+            model.bert_tokenizer.save_pretrained(opt.bert_output_dir)
+            model.bert_model.config.save_pretrained(opt.bert_output_dir)
+            config['bert_pretrained_saved'] = True
+        # same weights file as bert_model.save_pretrained() writes.
+        bert_checkpoint = OrderedDict((k[len('bert_model.'):], v) for k, v in checkpoint.items() if k.startswith('bert_model.'))
+        checkpointer.save(bert_checkpoint, os.path.join(opt.bert_output_dir, 'pytorch_model.bin'), snapshot=False)
+
+def get_rng_state():
+    np_state = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': (np_state[0], torch.from_numpy(np_state[1].copy()), np_state[2], np_state[3], np_state[4]),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+def set_rng_state(rng):
+    random.setstate(rng['python'])
+    np_state = rng['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy(), np_state[2], np_state[3], np_state[4]))
+    torch.set_rng_state(rng['torch'])
+    if torch.cuda.is_available() and len(rng['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(rng['cuda'])
+
+def save_checkpoint(config, model, progress, epoch_i=None):
+    """Save full training state at the end of an epoch or in the middle of it(--checkpoint_steps), rotate old ones.
+
+    Args:
+      epoch_i: the current epoch for a checkpoint in the middle of it, progress['local_step'] batches of it are consumed.
+    """
+    opt = config['opt']
+    checkpointer = config['checkpointer']
+    # consume the results of the pending snapshots first, so that early stopping is the same after a resume.
+    if config['evaluator']: poll_eval_results(model, config, wait=True)
+    if config['stop_training'] or opt.rank != 0: return
+    state = {
+        'model': get_state_dict(config, model),
+        'optimizer': config['optimizer'].state_dict(),
+        'scheduler': config['scheduler'].state_dict(),
+        'scaler': config['scaler'].state_dict(),
+        'early_stopping': config['early_stopping'].state_dict(),
+        'rng': get_rng_state(),
+        'progress': progress,
+    }
+    checkpoint_path = os.path.join(opt.checkpoint_dir, 'checkpoint-{:04d}.pt'.format(progress['epoch']))
+    # sorted before the end of the same epoch, after the end of the previous one
+    if epoch_i is not None: checkpoint_path = os.path.join(opt.checkpoint_dir, 'checkpoint-{:04d}-{:08d}.pt'.format(epoch_i, progress['local_step']))
+    checkpointer.save(state, checkpoint_path, rotate_pattern=os.path.join(opt.checkpoint_dir, 'checkpoint-*.pt'))
+
+def load_checkpoint(config, model):
+    """Restore training state from the latest checkpoint in opt.checkpoint_dir, return progress or None.
+    """
+    opt = config['opt']
+    checkpoint_path = latest_checkpoint(opt.checkpoint_dir)
+    if not checkpoint_path:
+        logger.info("[No checkpoint to resume in {}]".format(opt.checkpoint_dir))
+        return None
+    state = torch.load(checkpoint_path, map_location='cpu')
+    model.load_state_dict(restore_frozen(state['model'], model.state_dict(), artifact_paths=get_artifact_paths(opt)))
+    config['optimizer'].load_state_dict(state['optimizer'])
+    config['scheduler'].load_state_dict(state['scheduler'])
+    config['scaler'].load_state_dict(state['scaler'])
+    config['early_stopping'].load_state_dict(state['early_stopping'])
+    set_rng_state(state['rng'])
+    progress = state['progress']
+    logger.info("[Checkpoint resumed] : {}, epoch {}, local step {}, best f1 {:10.6f}".\
+            format(checkpoint_path, progress['epoch'], progress.get('local_step', 0), progress['best_eval_f1']))
+    return progress
 
 def set_path(config):
     opt = config['opt']
@@ -199,18 +730,259 @@ def set_path(config):
     opt.pos_path = os.path.join(opt.data_dir, opt.pos_filename)
     opt.embedding_path = os.path.join(opt.data_dir, opt.embedding_filename)
 
-def prepare_datasets(config):
-    opt = config['opt']
+def get_dataset_class(config):
     if config['emb_class'] == 'glove':
         DatasetClass = CoNLLGloveDataset
     if config['emb_class'] in ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']:
         DatasetClass = CoNLLBertDataset
     if config['emb_class'] == 'elmo':
         DatasetClass = CoNLLElmoDataset
+    return DatasetClass
+
+def prepare_datasets(config):
+    opt = config['opt']
+    DatasetClass = get_dataset_class(config)
     train_loader = prepare_dataset(config, opt.train_path, DatasetClass, sampling=True, num_workers=2)
     valid_loader = prepare_dataset(config, opt.valid_path, DatasetClass, sampling=False, num_workers=2, batch_size=opt.eval_batch_size)
     return train_loader, valid_loader
 
+def get_bert_feature_cache_key(config, model, path):
+    # invalidated by the bert model(name, reduced config) and the data file
+    opt = config['opt']
+    stat = os.stat(path)
+    key = {'bert_model_name_or_path': opt.bert_model_name_or_path,
+           'bert_remove_layers': opt.bert_remove_layers,
+           'bert_config': model.bert_config.to_json_string(),
+           'emb_class': config['emb_class'],
+           'n_ctx': config['n_ctx'],
+           'path': os.path.abspath(path),
+           'size': stat.st_size,
+           'mtime': stat.st_mtime}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def build_bert_feature_cache(config, model, dataset, feature_path, offsets):
+    opt = config['opt']
+    num_layers = model.bert_num_layers + 1
+    hidden_size = model.bert_hidden_size
+    tmp_path = feature_path + '.tmp'
+    features = np.memmap(tmp_path, dtype=np.float16, mode='w+', shape=(max(1, offsets[-1]), num_layers, hidden_size))
+    loader = DataLoader(dataset, batch_size=opt.eval_batch_size, sampler=SequentialSampler(dataset), num_workers=2)
+    n_batches = len(loader)
+    prog = Progbar(target=n_batches)
+    model.eval()
+    idx = 0
+    for i, (x, y) in enumerate(loader):
+        x = to_device(x, opt.device)
+        with autocast(enabled=opt.use_amp):
+            stack = model._compute_bert_hidden_states(x)
+        # stack : [batch_size, seq_size, bert_num_layers + 1, bert_hidden_size]
+        stack = stack.to(torch.float16).cpu().numpy()
+        for j in range(stack.shape[0]):
+            begin, end = offsets[idx], offsets[idx+1]
+            features[begin:end] = stack[j, :end-begin]
+            idx += 1
+        prog.update(i+1)
+    features.flush()
+    del features
+    os.replace(tmp_path, feature_path)
+
+def prepare_bert_feature_cache(config, model, loader, sampling=False, batch_size=0):
+    """Compute the frozen bert hidden states of a dataset once, return a loader reading them from the cache.
+    """
+    opt = config['opt']
+    dataset = loader.dataset
+    path = opt.train_path if sampling else opt.valid_path
+    key = get_bert_feature_cache_key(config, model, path)
+    prefix = os.path.join(opt.bert_feature_cache_dir, os.path.basename(path) + '.' + key)
+    feature_path = prefix + '.feat'
+    # only non-pad tokens are stored, x[1] is the attention mask
+    lengths = dataset.x.tensors[1].sum(dim=1).numpy()
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    if opt.rank == 0 and not os.path.exists(feature_path):
+        if not os.path.exists(opt.bert_feature_cache_dir):
+            os.makedirs(opt.bert_feature_cache_dir)
+        st_time = time.time()
+        build_bert_feature_cache(config, model, dataset, feature_path, offsets)
+        logger.info("[bert feature cache built] : {}, {} tokens, {:.2f} min".format(feature_path, offsets[-1], (time.time() - st_time) / 60))
+    if opt.distributed: dist.barrier()
+    dataset = BertFeatureDataset(config, dataset, feature_path, offsets, model.bert_num_layers + 1, model.bert_hidden_size)
+    logger.info("[bert feature cache loaded] : {}".format(feature_path))
+    return create_loader(config, dataset, sampling=sampling, num_workers=2, batch_size=batch_size)
+
+def load_teacher(config, model):
+    opt = config['opt']
+    teacher_opt = copy.copy(opt)
+    teacher_opt.config = opt.teacher_config
+    teacher_opt.bert_output_dir = opt.teacher_bert_output_dir
+    teacher_opt.use_crf = opt.teacher_use_crf
+    teacher_opt.bert_use_pos = opt.teacher_bert_use_pos
+    teacher_opt.bert_disable_lstm = opt.teacher_bert_disable_lstm
+    teacher_opt.bert_use_feature_based = opt.teacher_bert_use_feature_based
+    teacher_config = load_config(teacher_opt)
+    teacher_config['opt'] = teacher_opt
+    checkpoint = torch.load(opt.teacher_model_path, map_location='cpu')
+    # only for distillation, not imported at the top
+    from evaluate import load_model
+    teacher = load_model(teacher_config, checkpoint)
+    if teacher.labels != model.labels:
+        raise ValueError("teacher and student labels are different, use the same data_dir for both")
+    teacher.eval()
+    logger.info("[teacher loaded] : {}".format(opt.teacher_model_path))
+    return teacher
+
+def compute_teacher_outputs(config, teacher, path):
+    """Run the teacher on the sentences of a .ids file, map the outputs of the first subwords back to the words.
+
+    Returns:
+      logits: [num_sentences, seq_size, label_size] float16, all zeros for the words truncated by the teacher.
+      preds: [num_sentences, seq_size].
+      forward_time: elapsed time(sec) of the teacher forward only.
+    """
+    opt = config['opt']
+    teacher_config = teacher.config
+    tokenizer = teacher.bert_tokenizer
+    seq_size = config['n_ctx']
+    use_cuda = opt.device.startswith('cuda') and torch.cuda.is_available()
+    sentences = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            items = line.strip().split('\t')
+            words = items[3].split()
+            pos_ids = [int(d) for d in items[2].split()][:len(words)]
+            sentences.append((words, pos_ids))
+    n = len(sentences)
+    all_logits = np.zeros((n, seq_size, teacher.label_size), dtype=np.float16)
+    all_preds = np.full((n, seq_size), config['pad_label_id'], dtype=np.int64)
+    pad_token = tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0]
+    bz = opt.eval_batch_size
+    prog = Progbar(target=(n + bz - 1) // bz)
+    forward_time = 0.
+    for b, begin in enumerate(range(0, n, bz)):
+        features = []
+        all_word_starts = []
+        for words, pos_ids in sentences[begin:begin+bz]:
+            # the same converter as the teacher's training, word index + 1 as the label marks the first subword of each word.
+            word_ids = list(range(1, len(words) + 1))
+            example = InputExample(guid='teacher', words=words, poss=pos_ids, labels=word_ids)
+            feature = convert_single_example_to_feature(example, dict(zip(pos_ids, pos_ids)), dict(zip(word_ids, word_ids)),
+                                                        teacher_config['n_ctx'], tokenizer,
+                                                        cls_token=tokenizer.cls_token,
+                                                        cls_token_segment_id=0,
+                                                        sep_token=tokenizer.sep_token,
+                                                        sep_token_extra=bool(teacher_config['emb_class'] in ['roberta']),
+                                                        pad_token=pad_token,
+                                                        pad_token_pos_id=teacher_config['pad_pos_id'],
+                                                        pad_token_label_id=0,
+                                                        pad_token_segment_id=0,
+                                                        sequence_a_segment_id=0)
+            # -1 for the words without subword or truncated
+            word_starts = [-1] * len(words)
+            for j, word_id in enumerate(feature.label_ids):
+                if word_id > 0: word_starts[word_id - 1] = j
+            features.append(feature)
+            all_word_starts.append(word_starts)
+        x = [torch.tensor([f.input_ids for f in features], dtype=torch.long),
+             torch.tensor([f.input_mask for f in features], dtype=torch.long),
+             torch.tensor([f.segment_ids for f in features], dtype=torch.long),
+             torch.tensor([f.pos_ids for f in features], dtype=torch.long)]
+        x = to_device(x, opt.device)
+        st_time = time.time()
+        with torch.no_grad(), autocast(enabled=opt.use_amp):
+            if teacher.use_crf:
+                logits, prediction = teacher(x)
+            else:
+                logits = teacher(x)
+                prediction = torch.argmax(logits, dim=-1)
+        if use_cuda: torch.cuda.synchronize()
+        forward_time += time.time() - st_time
+        logits = to_numpy(logits.float())
+        prediction = to_numpy(prediction)
+        # logits : [batch_size, teacher seq_size, label_size]
+        for i, word_starts in enumerate(all_word_starts):
+            for j, start in enumerate(word_starts[:seq_size]):
+                if start < 0: continue
+                all_logits[begin+i, j] = logits[i, start]
+                all_preds[begin+i, j] = prediction[i, start]
+        prog.update(b+1)
+    return all_logits, all_preds, forward_time
+
+def get_teacher_key(config, path):
+    # invalidated by the teacher checkpoint and the data file
+    opt = config['opt']
+    key = {'teacher_model_path': os.path.abspath(opt.teacher_model_path),
+           'teacher_mtime': os.stat(opt.teacher_model_path).st_mtime,
+           'path': os.path.abspath(path),
+           'mtime': os.stat(path).st_mtime}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def prepare_distillation(config, model, train_loader):
+    """Precompute the teacher soft labels of train(and unlabeled) data and the teacher valid measure,
+    return the train loader paired with the soft labels.
+    """
+    opt = config['opt']
+    if config['emb_class'] != 'glove':
+        raise ValueError("distillation supports glove students only")
+    paths = [opt.train_path]
+    if opt.distill_unlabeled_filename:
+        paths.append(os.path.join(opt.data_dir, opt.distill_unlabeled_filename + '.ids'))
+    logits_paths = [path + '.teacher-' + get_teacher_key(config, path) + '.npy' for path in paths]
+    report_path = opt.valid_path + '.teacher-' + get_teacher_key(config, opt.valid_path) + '.json'
+    if opt.rank == 0:
+        teacher = None
+        for path, logits_path in zip(paths, logits_paths):
+            if os.path.exists(logits_path): continue
+            if teacher is None: teacher = load_teacher(config, model)
+            logits, _, _ = compute_teacher_outputs(config, teacher, path)
+            with open(logits_path + '.tmp', 'wb') as f:
+                np.save(f, logits)
+            os.replace(logits_path + '.tmp', logits_path)
+            logger.info("[teacher soft labels saved] : {}".format(logits_path))
+        if not os.path.exists(report_path):
+            if teacher is None: teacher = load_teacher(config, model)
+            _, preds, forward_time = compute_teacher_outputs(config, teacher, opt.valid_path)
+            ys = CoNLLGloveDataset(config, opt.valid_path).y.numpy()
+            labels = teacher.labels
+            ys_lbs = [[labels[l] for l in y if l != config['pad_label_id']] for y in ys]
+            preds_lbs = [[labels[p] for p, l in zip(pred, y) if l != config['pad_label_id']] for pred, y in zip(preds, ys)]
+            report = {'f1': f1_score(ys_lbs, preds_lbs), 'ms_per_example': forward_time / max(1, len(ys)) * 1000}
+            with open(report_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f)
+        if teacher is not None:
+            del teacher
+            if torch.cuda.is_available(): torch.cuda.empty_cache()
+    if opt.distributed: dist.barrier()
+    with open(report_path, 'r', encoding='utf-8') as f:
+        config['teacher_report'] = json.load(f)
+    datasets = [DistillDataset(train_loader.dataset, logits_paths[0])]
+    if opt.distill_unlabeled_filename:
+        datasets.append(DistillDataset(CoNLLGloveDataset(config, paths[1]), logits_paths[1]))
+    dataset = ConcatDataset(datasets)
+    logger.info("[distillation] {} train sentences, teacher valid f1 {:.4f}".format(len(dataset), config['teacher_report']['f1']))
+    return create_loader(config, dataset, sampling=True, num_workers=2)
+
+def report_distillation(config, model, valid_loader):
+    """Log the f1 and latency trade-off of the teacher and the student on the validation set.
+    """
+    opt = config['opt']
+    use_cuda = opt.device.startswith('cuda') and torch.cuda.is_available()
+    model.eval()
+    forward_time = 0.
+    n_examples = 0
+    with torch.no_grad():
+        for x, y in valid_loader:
+            x = to_device(x, opt.device)
+            st_time = time.time()
+            model(x)
+            if use_cuda: torch.cuda.synchronize()
+            forward_time += time.time() - st_time
+            n_examples += y.shape[0]
+    teacher_report = config['teacher_report']
+    student_ms = forward_time / max(1, n_examples) * 1000
+    logger.info("[distillation] teacher : valid f1 {:.4f}, {:.3f}ms/example | student : best valid f1 {:.4f}, {:.3f}ms/example | {:.1f}x faster".\
+        format(teacher_report['f1'], teacher_report['ms_per_example'],
+               config['progress']['best_eval_f1'], student_ms,
+               teacher_report['ms_per_example'] / max(1e-6, student_ms)))
+
 def get_bert_embed_layer_list(config, bert_model):
     opt = config['opt']
     embed_list = list(bert_model.embeddings.parameters())
@@ -254,21 +1026,195 @@ def prepare_model(config):
         reduce_bert_model(config, bert_model, bert_config)
         ModelClass = BertLSTMCRF
         model = ModelClass(config, bert_config, bert_model, bert_tokenizer, opt.label_path, opt.pos_path,
-                           use_crf=opt.use_crf, use_pos=opt.bert_use_pos, disable_lstm=opt.bert_disable_lstm, feature_based=opt.bert_use_feature_based)
+                           use_crf=opt.use_crf, use_pos=opt.bert_use_pos, disable_lstm=opt.bert_disable_lstm, feature_based=opt.bert_use_feature_based,
+                           exit_layers=[int(layer) for layer in opt.bert_exit_layers.split(',') if layer.strip()])
     if config['emb_class'] == 'elmo':
         from allennlp.modules.elmo import Elmo
         elmo_model = Elmo(opt.elmo_options_file, opt.elmo_weights_file, 2, dropout=0)
         model = ElmoLSTMCRF(config, elmo_model, opt.embedding_path, opt.label_path, opt.pos_path,
                             emb_non_trainable=emb_non_trainable, use_crf=opt.use_crf, use_char_cnn=opt.use_char_cnn)
     model.to(opt.device)
-    print(model)
+    if config['emb_class'] == 'elmo' and opt.elmo_token_cache:
+        # the character encoder is frozen, only the biLMs run per batch
+        model.enable_token_cache(load_conll_words(os.path.join(opt.data_dir, 'train.txt')), max_size=opt.elmo_token_cache_size)
+    if opt.activation_checkpointing: apply_activation_checkpointing(config, model)
+    if opt.rank == 0: print(model)
     logger.info("[model prepared]")
     return model
 
+def apply_activation_checkpointing(config, model):
+    """Recompute the activations of the given blocks in backward, ex) --activation_checkpointing=bert,lstm
+    """
+    opt = config['opt']
+    blocks = [b.strip() for b in opt.activation_checkpointing.split(',') if b.strip()]
+    for block in blocks:
+        if block == 'bert' and hasattr(model, 'bert_model'):
+            bert_model = model.bert_model
+            # distilbert has transformer.layer instead of encoder.layer
+            if hasattr(bert_model, 'encoder'): layer_list = bert_model.encoder.layer
+            else: layer_list = bert_model.transformer.layer
+            layer_indexes = range(len(layer_list))
+            if opt.checkpoint_bert_layers:
+                layer_indexes = [int(x) for x in opt.checkpoint_bert_layers.split(',')]
+            for layer_idx in layer_indexes:
+                enable_checkpointing(layer_list[layer_idx])
+            logger.info("[activation checkpointing] bert layers {}".format(list(layer_indexes)))
+        elif block == 'lstm' and hasattr(model, 'lstm'):
+            model.use_lstm_checkpointing = True
+            logger.info("[activation checkpointing] lstm")
+        elif block == 'densenet' and hasattr(model, 'densenet'):
+            model.densenet.use_checkpointing = True
+            logger.info("[activation checkpointing] densenet")
+        else:
+            logger.info("[activation checkpointing] {} is not in the model, ignored".format(block))
+
+def disable_activation_checkpointing(model):
+    """Disable the blocks applied by apply_activation_checkpointing(), return them to enable again.
+    """
+    disabled = []
+    for module in model.modules():
+        for name in ['use_checkpointing', 'use_lstm_checkpointing']:
+            if getattr(module, name, False):
+                setattr(module, name, False)
+                disabled.append((module, name))
+    return disabled
+
+def report_activation_checkpointing(config, model, train_loader):
+    """Compare peak memory and time of forward/backward with and without activation checkpointing on a few batches.
+
+    parameters are not updated, and the rng state is restored after the measurement.
+    the activations saved for backward are counted on any device, the peak memory on cuda only.
+    """
+    opt = config['opt']
+    train_model = config['train_model']
+    use_cuda = opt.device.startswith('cuda') and torch.cuda.is_available()
+    rng = get_rng_state()
+    batches = []
+    for i, (x, y) in enumerate(train_loader):
+        if i >= opt.activation_checkpointing_report_steps: break
+        batches.append((x, y))
+    model.train()
+    results = {}
+    for enabled in [True, False]:
+        # 'False' measures the baseline, the blocks applied are enabled again at the end.
+        disabled = [] if enabled else disable_activation_checkpointing(model)
+        if use_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        st_time = time.time()
+        saved = 0
+        try:
+            for x, y in batches:
+                x = to_device(x, opt.device)
+                y = to_device(y, opt.device)
+                with autocast(enabled=opt.use_amp), SavedTensorsCounter() as counter:
+                    loss = train_model(x, y)
+                saved = max(saved, counter.bytes)
+                loss.backward()
+                model.zero_grad()
+            if use_cuda: torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() if use_cuda else 0
+            results[enabled] = ((time.time() - st_time) / max(1, len(batches)) * 1000, peak, saved)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e): raise
+            model.zero_grad()
+            results[enabled] = None
+        for module, name in disabled:
+            setattr(module, name, True)
+    set_rng_state(rng)
+    if use_cuda: torch.cuda.empty_cache()
+    on, off = results[True], results[False]
+    if on is None:
+        logger.info("[activation checkpointing] out of memory even with checkpointing")
+    elif off is None:
+        logger.info("[activation checkpointing] {:.2f}ms/step, peak memory {:.1f}MB, out of memory without checkpointing".\
+            format(on[0], on[1] / 2**20))
+    else:
+        logger.info("[activation checkpointing] {:.2f}ms/step vs {:.2f}ms/step without, {:+.1f}% compute | peak memory {:.1f}MB vs {:.1f}MB without, {:.1f}MB saved".\
+            format(on[0], off[0], (on[0] / max(1e-6, off[0]) - 1) * 100, on[1] / 2**20, off[1] / 2**20, (off[1] - on[1]) / 2**20))
+        logger.info("[activation checkpointing] activations for backward {:.1f}MB vs {:.1f}MB without, max over the batches".\
+            format(on[2] / 2**20, off[2] / 2**20))
+    if config['writer']:
+        if on: config['writer'].add_scalar('ActivationCheckpointing/peak_memory_mb', on[1] / 2**20, 0)
+        if off: config['writer'].add_scalar('ActivationCheckpointing/peak_memory_mb_baseline', off[1] / 2**20, 0)
+        if on: config['writer'].add_scalar('ActivationCheckpointing/saved_activation_mb', on[2] / 2**20, 0)
+        if off: config['writer'].add_scalar('ActivationCheckpointing/saved_activation_mb_baseline', off[2] / 2**20, 0)
+
+def adjust_for_token_budget(config, train_loader):
+    """Keep the number of sentences per update close to --batch_size * --gradient_accumulation_steps
+    when batches are packed by --max_tokens_per_batch, scale lr linearly if it can not be matched.
+    """
+    opt = config['opt']
+    if opt.max_tokens_per_batch <= 0: return
+    n_batches = len(train_loader)
+    avg_batch_size = len(train_loader.dataset) / max(1, n_batches * opt.world_size)
+    target = opt.batch_size * opt.gradient_accumulation_steps
+    accum = max(1, int(round(target / max(1.0, avg_batch_size))))
+    accum = min(accum, max(1, n_batches))
+    lr = opt.lr * (avg_batch_size * accum) / target
+    logger.info("[token budget] max_tokens_per_batch {}, {} batches, {:.1f} sentences/batch | gradient_accumulation_steps {} -> {}, lr {} -> {}".\
+        format(opt.max_tokens_per_batch, n_batches, avg_batch_size, opt.gradient_accumulation_steps, accum, opt.lr, lr))
+    opt.gradient_accumulation_steps = accum
+    opt.lr = lr
+
+class MultipleOptimizer(torch.optim.Optimizer):
+    """Step several optimizers as one, ex) SparseAdam for sparse embeddings + AdamW for the rest.
+
+    param_groups are the groups of the wrapped optimizers(same dicts),
+    so lr schedulers and GradScaler work on it as on a single optimizer.
+    """
+
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+        super().__init__([group for optimizer in optimizers for group in optimizer.param_groups], {})
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+        for optimizer in self.optimizers:
+            optimizer.step()
+        return loss
+
+    def state_dict(self):
+        return {'optimizers': [optimizer.state_dict() for optimizer in self.optimizers]}
+
+    def load_state_dict(self, state_dict):
+        for optimizer, state in zip(self.optimizers, state_dict['optimizers']):
+            optimizer.load_state_dict(state)
+
+def clip_grad_norm(parameters, max_norm):
+    """torch.nn.utils.clip_grad_norm_() which also accepts sparse gradients, ex) --embedding_sparse."""
+    parameters = [p for p in parameters if p.grad is not None]
+    if not any(p.grad.is_sparse for p in parameters):
+        return torch.nn.utils.clip_grad_norm_(parameters, max_norm)
+    grads = []
+    for p in parameters:
+        # rows of a sparse gradient may be repeated, ex) the same word twice in a batch
+        if p.grad.is_sparse: p.grad = p.grad.coalesce()
+        grads.append(p.grad._values() if p.grad.is_sparse else p.grad)
+    total_norm = torch.norm(torch.stack([torch.norm(g.detach()) for g in grads]))
+    # no device synchronization, same as clip_grad_norm_()
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    for g in grads:
+        g.detach().mul_(clip_coef.to(g.device))
+    return total_norm
+
+def get_sparse_parameters(model):
+    # weights of the trainable embeddings with sparse gradients
+    return [m.weight for m in model.modules() if isinstance(m, nn.Embedding) and m.sparse and m.weight.requires_grad]
+
 def prepare_osws(config, model, train_loader):
     opt = config['opt']
-    optimizer = torch.optim.AdamW(model.parameters(), lr=opt.lr, eps=opt.adam_epsilon, weight_decay=opt.weight_decay)
-    scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer=optimizer, gamma=opt.lr_decay_rate)
+    sparse_params = get_sparse_parameters(model)
+    sparse_ids = set(id(p) for p in sparse_params)
+    if sparse_params and opt.distributed and dist.get_backend() == 'nccl':
+        raise ValueError("--embedding_sparse is not supported by the nccl backend, use --dist_backend=gloo")
+    named_parameters = [(n, p) for n, p in model.named_parameters() if id(p) not in sparse_ids]
+    optimizer = torch.optim.AdamW([p for n, p in named_parameters], lr=opt.lr, eps=opt.adam_epsilon, weight_decay=opt.weight_decay)
     if opt.use_transformers_optimizer:
         from transformers import AdamW, get_linear_schedule_with_warmup
         num_training_steps_for_epoch = len(train_loader) // opt.gradient_accumulation_steps
@@ -278,18 +1224,27 @@ def prepare_osws(config, model, train_loader):
             format(num_training_steps_for_epoch, num_training_steps, num_warmup_steps))        
         no_decay = ['bias', 'LayerNorm.weight']
         optimizer_grouped_parameters = [
-            {'params': [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+            {'params': [p for n, p in named_parameters if not any(nd in n for nd in no_decay)],
              'weight_decay': opt.weight_decay},
-            {'params': [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+            {'params': [p for n, p in named_parameters if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
         ]
         optimizer = AdamW(optimizer_grouped_parameters, lr=opt.lr, eps=opt.adam_epsilon)
+    if sparse_params:
+        # lazy adam on the rows in a batch, no weight decay. the dense optimizer keeps no state for the embeddings.
+        sparse_optimizer = torch.optim.SparseAdam(sparse_params, lr=opt.lr, eps=opt.adam_epsilon)
+        optimizer = MultipleOptimizer([optimizer, sparse_optimizer])
+        logger.info("[sparse embeddings] {} parameters on SparseAdam".format(sum(p.numel() for p in sparse_params)))
+    scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer=optimizer, gamma=opt.lr_decay_rate)
+    if opt.use_transformers_optimizer:
         scheduler = get_linear_schedule_with_warmup(optimizer,
             num_warmup_steps=num_warmup_steps,
             num_training_steps=num_training_steps)
-    try:
-        writer = SummaryWriter(log_dir=opt.log_dir)
-    except:
-        writer = None
+    writer = None
+    if opt.rank == 0:
+        try:
+            writer = AsyncSummaryWriter(SummaryWriter(log_dir=opt.log_dir))
+        except:
+            writer = None
     scaler = GradScaler()
     logger.info("[optimizer, scheduler, summary writer, scaler prepared]")
     return optimizer, scheduler, writer, scaler
@@ -298,9 +1253,11 @@ def train(opt):
     if torch.cuda.is_available():
         logger.info("%s", torch.cuda.get_device_name(0))
 
-    # set seed, etc
+    # set distributed, seed, etc
+    init_distributed(opt)
     set_seed(opt)
-    torch.autograd.set_detect_anomaly(True)
+    if opt.debug:
+        torch.autograd.set_detect_anomaly(True)
 
     # set config
     config = load_config(opt)
@@ -316,49 +1273,74 @@ def train(opt):
     # prepare model
     model = prepare_model(config)
 
+    # compute frozen bert features once, train only dsa, lstm, crf on them
+    if opt.bert_use_feature_based and opt.bert_feature_cache_dir:
+        train_loader = prepare_bert_feature_cache(config, model, train_loader, sampling=True)
+    valid_loader = prepare_valid_loader(config, model, valid_loader)
+    if opt.teacher_model_path:
+        # distill the teacher soft labels into the student
+        train_loader = prepare_distillation(config, model, train_loader)
+        train_model = DistillModelWithLoss(config, model)
+    else:
+        train_model = ModelWithLoss(config, model)
+    if opt.distributed:
+        device_ids = [opt.local_rank] if opt.device.startswith('cuda') else None
+        # some parameters are not used in every configuration, ex) dsa for fine-tuning, embed_pos without --bert_use_pos
+        train_model = DistributedDataParallel(train_model, device_ids=device_ids, find_unused_parameters=True)
+    config['train_model'] = train_model
+
     # create optimizer, scheduler, summary writer, scaler
+    adjust_for_token_budget(config, train_loader)
     optimizer, scheduler, writer, scaler = prepare_osws(config, model, train_loader)
     config['optimizer'] = optimizer
     config['scheduler'] = scheduler
     config['writer'] = writer
     config['scaler'] = scaler
+    if opt.activation_checkpointing and opt.activation_checkpointing_report_steps > 0 and not opt.distributed:
+        report_activation_checkpointing(config, model, train_loader)
 
     # training
     early_stopping = EarlyStopping(logger, patience=opt.patience, measure='f1', verbose=1)
-    local_worse_steps = 0
-    prev_eval_f1 = -float('inf')
-    best_eval_f1 = -float('inf')
-    for epoch_i in range(opt.epoch):
-        epoch_st_time = time.time()
-        eval_loss, eval_f1 = train_epoch(model, config, train_loader, valid_loader, epoch_i)
-        # early stopping
-        if early_stopping.validate(eval_f1, measure='f1'): break
-        if eval_f1 > best_eval_f1:
-            best_eval_f1 = eval_f1
-            if opt.save_path:
-                logger.info("[Best model saved] : {:10.6f}".format(best_eval_f1))
-                save_model(config, model)
-                # save finetuned bert model/config/tokenizer
-                if config['emb_class'] in ['bert', 'distilbert', 'albert', 'roberta', 'bart', 'electra']:
-                    if not os.path.exists(opt.bert_output_dir):
-                        os.makedirs(opt.bert_output_dir)
-                    model.bert_tokenizer.save_pretrained(opt.bert_output_dir)
-                    model.bert_model.save_pretrained(opt.bert_output_dir)
-            early_stopping.reset(best_eval_f1)
-        early_stopping.status()
-        # begin: scheduling, apply rate decay at the measure(ex, loss) getting worse for the number of deacy epoch steps.
-        if prev_eval_f1 >= eval_f1:
-            local_worse_steps += 1
+    config['early_stopping'] = early_stopping
+    config['checkpointer'] = AsyncCheckpointer(keep=opt.keep_checkpoints) if opt.rank == 0 else None
+    # epoch : the last finished epoch, local_step : consumed batches of the next epoch
+    config['progress'] = {'epoch': -1,
+                          'global_step': -1,
+                          'local_step': 0,
+                          'local_worse_steps': 0,
+                          'prev_eval_f1': -float('inf'),
+                          'best_eval_f1': -float('inf')}
+    config['stop_training'] = False
+    if opt.resume and opt.checkpoint_dir:
+        progress = load_checkpoint(config, model)
+        if progress: config['progress'] = progress
+    start_epoch = config['progress']['epoch'] + 1
+    config['evaluator'] = None
+    if opt.async_eval:
+        if opt.distributed:
+            logger.info("[--async_eval is not supported with --distributed, evaluate synchronously]")
         else:
-            local_worse_steps = 0
-        logger.info('Scheduler: local_worse_steps / opt.lr_decay_steps = %d / %d' % (local_worse_steps, opt.lr_decay_steps))
-        if not opt.use_transformers_optimizer and \
-           epoch_i > opt.warmup_epoch and \
-           (local_worse_steps >= opt.lr_decay_steps or early_stopping.step() > opt.lr_decay_steps):
-            scheduler.step()
-            local_worse_steps = 0
-        prev_eval_f1 = eval_f1
-        # end: scheduling
+            config['evaluator'] = AsyncEvaluator(opt)
+    if opt.log_step_timing:
+        util_profile.enable(use_cuda=(opt.device != 'cpu'))
+    for epoch_i in range(start_epoch, opt.epoch):
+        train_epoch(model, config, train_loader, valid_loader, epoch_i)
+        if config['stop_training']: break
+        config['progress']['epoch'] = epoch_i
+        config['progress']['global_step'] = len(train_loader) * (epoch_i + 1) - 1
+        if opt.checkpoint_dir:
+            save_checkpoint(config, model, config['progress'])
+    if config['evaluator']:
+        # consume the results of the last snapshots
+        poll_eval_results(model, config, wait=True)
+        config['evaluator'].close()
+    if opt.teacher_model_path and opt.rank == 0:
+        report_distillation(config, model, valid_loader)
+    util_profile.disable()
+    # wait for the pending checkpoints
+    if config['checkpointer']: config['checkpointer'].close()
+    if writer: writer.close()
+    if opt.distributed: dist.destroy_process_group()
 
 def main():
     parser = argparse.ArgumentParser()
@@ -376,21 +1358,70 @@ def main():
     parser.add_argument('--lr_decay_rate', type=float, default=1.0, help="Disjoint with --use_transformers_optimizer")
     parser.add_argument('--lr_decay_steps', type=float, default=2, help="Number of decay epoch steps to be paitent. disjoint with --use_transformers_optimizer")
     parser.add_argument('--warmup_epoch', type=int, default=4,  help="Number of warmup epoch steps")
-    parser.add_argument('--patience', default=7, type=int, help="Max number of epoch to be patient for early stopping.")
+    parser.add_argument('--patience', default=7, type=int, help="Max number of evaluations(epochs by default) to be patient for early stopping.")
     parser.add_argument('--adam_epsilon', type=float, default=1e-8)
     parser.add_argument('--weight_decay', type=float, default=0.01)
     parser.add_argument('--gradient_accumulation_steps', type=int, default=1,
                         help="Number of updates steps to accumulate before performing a backward/update pass.")
     parser.add_argument('--max_grad_norm', default=1.0, type=float, help="Max gradient norm.")
+    parser.add_argument('--max_tokens_per_batch', type=int, default=0,
+                        help="Pack sentences of similar length into batches of at most this many padded tokens and trim padding,"
+                             " gradient_accumulation_steps and lr are adjusted to the average batch size. 0 means fixed --batch_size.")
     parser.add_argument('--save_path', type=str, default='pytorch-model-glove.pt')
     parser.add_argument('--log_dir', type=str, default='runs')
+    parser.add_argument('--log_step_timing', action='store_true',
+                        help="Measure time of data wait, h2d copy, forward, loss, backward and optimizer step per step."
+                             " synchronizes the device at every stage, so that it slows down training a little.")
+    parser.add_argument('--checkpoint_dir', type=str, default='',
+                        help="Directory to save full training state(model, optimizer, scheduler, scaler, early stopping, rng) at every epoch.")
+    parser.add_argument('--checkpoint_steps', type=int, default=0,
+                        help="Also save the training state every this number of training steps(at an optimizer update) to resume in the middle of an epoch, 0 means at the end of every epoch only.")
+    parser.add_argument('--keep_checkpoints', type=int, default=2, help="Number of latest training state checkpoints to keep.")
+    parser.add_argument('--resume', action='store_true', help="Resume training from the latest checkpoint in --checkpoint_dir.")
     parser.add_argument('--seed', default=42, type=int)
     parser.add_argument('--use_crf', action='store_true', help="Add CRF layer")
     parser.add_argument('--embedding_trainable', action='store_true', help="Set word embedding(Glove) trainable")
+    parser.add_argument('--save_frozen_params', action='store_true',
+                        help="Save the frozen embeddings(GloVe, ELMo) into checkpoints too. default, they are referenced by content hash and rebuilt from the embedding files at load time.")
+    parser.add_argument('--embedding_sparse', action='store_true',
+                        help="Sparse gradients for the trainable word embedding, updated by SparseAdam and the rest by AdamW. used with --embedding_trainable.")
     parser.add_argument('--use_char_cnn', action='store_true', help="Add Character features")
     parser.add_argument('--use_transformers_optimizer', action='store_true', help="Use transformers AdamW, get_linear_schedule_with_warmup.")
     parser.add_argument('--use_amp', action='store_true', help="Use automatic mixed precision.")
     parser.add_argument('--use_profiler', action='store_true', help="Use profiler.")
+    parser.add_argument('--log_interval', type=int, default=50,
+                        help="Number of steps to accumulate train loss on the device before logging(syncing) it.")
+    parser.add_argument('--eval_steps', type=int, default=0,
+                        help="Evaluate every this number of training steps, 0 means at the end of every epoch.")
+    parser.add_argument('--eval_subset_size', type=int, default=0,
+                        help="Evaluate on a subset of validation sentences stratified by entity type, 0 means the full set.")
+    parser.add_argument('--async_eval', action='store_true',
+                        help="Evaluate snapshots of the weights in a separate process while training goes on.")
+    parser.add_argument('--async_eval_device', type=str, default='', help="Device for --async_eval, default --device.")
+    parser.add_argument('--async_eval_num_threads', type=int, default=4, help="Number of torch threads for --async_eval.")
+    parser.add_argument('--activation_checkpointing', type=str, default='',
+                        help="Comma separated blocks to recompute activations in backward, bert | lstm | densenet, ex) bert,lstm")
+    parser.add_argument('--checkpoint_bert_layers', type=str, default='',
+                        help="Comma separated bert layer indexes for --activation_checkpointing=bert, default all layers.")
+    parser.add_argument('--activation_checkpointing_report_steps', type=int, default=3,
+                        help="Number of batches to compare memory/time with and without activation checkpointing before training, 0 to skip.")
+    parser.add_argument('--debug', action='store_true', help="Enable autograd anomaly detection.")
+    # for distributed training, ex) torchrun --nproc_per_node=4 train.py --distributed ...
+    parser.add_argument('--distributed', action='store_true', help="Use DistributedDataParallel, launched by torchrun.")
+    parser.add_argument('--dist_backend', type=str, default='', help="nccl | gloo, default nccl for cuda, gloo for cpu.")
+    parser.add_argument('--local_rank', type=int, default=0, help="Overridden by LOCAL_RANK environment variable.")
+    # for distillation, ex) --teacher_config=configs/config-bert.json --teacher_model_path=pytorch-model-bert.pt --teacher_bert_output_dir=bert-checkpoint
+    parser.add_argument('--teacher_model_path', type=str, default='', help="Path to the teacher(BERT) model, enable distillation into the glove student.")
+    parser.add_argument('--teacher_config', type=str, default='configs/config-bert.json')
+    parser.add_argument('--teacher_bert_output_dir', type=str, default='bert-checkpoint')
+    parser.add_argument('--teacher_use_crf', action='store_true')
+    parser.add_argument('--teacher_bert_use_pos', action='store_true')
+    parser.add_argument('--teacher_bert_disable_lstm', action='store_true')
+    parser.add_argument('--teacher_bert_use_feature_based', action='store_true')
+    parser.add_argument('--distill_alpha', type=float, default=0.5, help="Weight of the soft label loss, (1 - alpha) for the hard label loss.")
+    parser.add_argument('--distill_temperature', type=float, default=2.0)
+    parser.add_argument('--distill_unlabeled_filename', type=str, default='',
+                        help="Unlabeled text in data_dir preprocessed by preprocess.py --unlabeled_filename, ex) unlabeled.txt")
     # for BERT
     parser.add_argument('--bert_model_name_or_path', type=str, default='bert-base-uncased',
                         help="Path to pre-trained model or shortcut name(ex, bert-base-uncased)")
@@ -398,8 +1429,15 @@ def main():
                         help="Set this flag if you are using an uncased model.")
     parser.add_argument('--bert_output_dir', type=str, default='bert-checkpoint',
                         help="The output directory where the model predictions and checkpoints will be written.")
+    parser.add_argument('--bert_exit_layers', type=str, default='',
+                        help="Comma separated layers(1 ~ num_hidden_layers-1) with exit heads for early-exit inference, ex) 4,8,12,16,20.")
+    parser.add_argument('--exit_training', type=str, default='joint', choices=['joint', 'distill'],
+                        help="Train the exit heads on the gold labels(joint) or on the final logits(distill, self-distillation).")
+    parser.add_argument('--exit_loss_weight', type=float, default=1.0, help="Weight of the exit heads loss.")
     parser.add_argument('--bert_use_feature_based', action='store_true',
                         help="Use BERT as feature-based, default fine-tuning")
+    parser.add_argument('--bert_feature_cache_dir', type=str, default='',
+                        help="Directory to cache the frozen hidden states(float16, memory-mapped) for --bert_use_feature_based.")
     parser.add_argument('--bert_disable_lstm', action='store_true',
                         help="Disable lstm layer")
     parser.add_argument('--bert_use_pos', action='store_true', help="Add Part-Of-Speech features")
@@ -408,6 +1446,10 @@ def main():
     # for ELMo
     parser.add_argument('--elmo_options_file', type=str, default='embeddings/elmo_2x4096_512_2048cnn_2xhighway_5.5B_options.json')
     parser.add_argument('--elmo_weights_file', type=str, default='embeddings/elmo_2x4096_512_2048cnn_2xhighway_5.5B_weights.hdf5')
+    parser.add_argument('--elmo_token_cache', action='store_true',
+                        help="Cache the elmo character encoder outputs per word, prebuilt from the training words.")
+    parser.add_argument('--elmo_token_cache_size', type=int, default=0,
+                        help="Max number of cached words for --elmo_token_cache, 0 means no limit.")
 
     opt = parser.parse_args()
 
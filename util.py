@@ -3,6 +3,14 @@ from __future__ import absolute_import, division, print_function
 import os
 import pdb
 import json
+import threading
+import queue
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
 
 def load_config(opt):
     try:
@@ -27,3 +35,82 @@ def to_numpy(x):
         for i in range(len(x)):
             x[i] = x[i].detach().cpu().numpy()
     return x
+
+def pad_to_seq_size(x, seq_size, value=0):
+    # pad numpy array [batch_size, *, ...] along the second axis up to seq_size, ex) outputs of trimmed batches
+    if x.shape[1] >= seq_size: return x
+    pad_width = [(0, 0), (0, seq_size - x.shape[1])] + [(0, 0)] * (x.ndim - 2)
+    return np.pad(x, pad_width, mode='constant', constant_values=value)
+
+def load_conll_words(path):
+    # distinct words(first column) of a CoNLL file in order of appearance
+    words = OrderedDict()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            toks = line.split()
+            if not toks or toks[0] == '-DOCSTART-': continue
+            words[toks[0]] = None
+    return list(words)
+
+def get_memory_usage():
+    """Memory of this process in MB from /proc/self/smaps_rollup(linux), empty if not available.
+
+    pages shared with other processes(ex, weights in shared memory) count fully in rss, proportionally in pss, not in uss.
+    """
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as f:
+            for line in f:
+                toks = line.split()
+                if len(toks) >= 2 and toks[0] in ['Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:']:
+                    usage[toks[0][:-1]] = int(toks[1]) / 1024
+    except OSError:
+        return {}
+    return {'rss': usage.get('Rss', 0.0),
+            'pss': usage.get('Pss', 0.0),
+            'uss': usage.get('Private_Clean', 0.0) + usage.get('Private_Dirty', 0.0)}
+
+class AsyncSummaryWriter():
+    """Forward SummaryWriter calls(add_scalar, ...) to a background thread,
+    so that the training loop is not blocked by event file writes.
+    pass python values only, not device tensors.
+    calls are dropped with a warning when the queue is full, ex) the thread is stuck or dead, training never waits for it.
+    """
+
+    def __init__(self, writer, max_queue_size=10000):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.error = None
+        self.num_dropped = 0
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            name, args, kwargs = item
+            try:
+                getattr(self.writer, name)(*args, **kwargs)
+            except Exception as e:
+                # keep draining the queue, a failed write loses one summary only
+                if self.error is None: logger.warning("[Summary write failed] : {}, {}".format(name, str(e)))
+                self.error = e
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            try:
+                self.queue.put_nowait((name, args, kwargs))
+            except queue.Full:
+                self.num_dropped += 1
+                # 1, 2, 4, 8, ... not to flood the log
+                if self.num_dropped & (self.num_dropped - 1) == 0:
+                    logger.warning("[Summary dropped] : {} calls, writer thread is {}".\
+                        format(self.num_dropped, 'alive' if self.thread.is_alive() else 'dead'))
+        return call
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.writer.close()
@@ -101,6 +101,8 @@ def convert_single_example_to_feature(example,
     for word, pos, label in zip(example.words, example.poss, example.labels):
         # word extension
         word_tokens = tokenizer.tokenize(word)
+        # words without sub-tokens(ex, '\u200b') have no position to carry the label
+        if not word_tokens: continue
         tokens.extend(word_tokens)
         # pos extension: set same pos_id
         pos_id = pos_map[pos]
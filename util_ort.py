@@ -0,0 +1,162 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import pdb
+import time
+import logging
+
+import torch
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_ORT_TYPES = {
+    'tensor(float)': (np.float32, torch.float32),
+    'tensor(float16)': (np.float16, torch.float16),
+    'tensor(int64)': (np.int64, torch.int64),
+    'tensor(int32)': (np.int32, torch.int32),
+}
+
+_TORCH_TO_NUMPY = dict((torch_type, np_type) for np_type, torch_type in _ORT_TYPES.values())
+
+class OrtBackend():
+    """Reusable onnxruntime session for the tagger models.
+
+    Args:
+      graph_optimization_level: disable | basic | extended | all.
+      optimized_model_path: if given, the optimized graph is saved to this path at the first run
+        and later sessions load it with graph optimization disabled.
+      providers: list of execution providers, ex) ['CUDAExecutionProvider', 'CPUExecutionProvider'].
+      use_io_binding: if True, bind input tensors and preallocated output buffers directly,
+        otherwise feed numpy arrays and copy the outputs back(previous behavior).
+    """
+
+    def __init__(self, config, onnx_path, label_size, providers=None, intra_op_num_threads=0, inter_op_num_threads=0,
+                 graph_optimization_level='all', execution_mode='sequential', optimized_model_path='', use_io_binding=True):
+        import onnxruntime as ort
+        self.config = config
+        self.label_size = label_size
+        self.use_io_binding = use_io_binding
+
+        levels = {'disable': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+                  'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                  'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                  'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL}
+        sess_options = ort.SessionOptions()
+        if intra_op_num_threads > 0: sess_options.intra_op_num_threads = intra_op_num_threads
+        if inter_op_num_threads > 0: sess_options.inter_op_num_threads = inter_op_num_threads
+        if execution_mode == 'parallel':
+            sess_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        else:
+            sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        model_path = onnx_path
+        if optimized_model_path and os.path.exists(optimized_model_path) and \
+           os.path.getmtime(optimized_model_path) >= os.path.getmtime(onnx_path):
+            # already optimized, skip graph optimization at load time
+            model_path = optimized_model_path
+            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            logger.info("[Loading optimized ONNX model from {}]".format(optimized_model_path))
+        else:
+            sess_options.graph_optimization_level = levels[graph_optimization_level]
+            if optimized_model_path:
+                sess_options.optimized_model_filepath = optimized_model_path
+                logger.info("[Saving optimized ONNX model to {}]".format(optimized_model_path))
+        st_time = time.time()
+        if providers:
+            self.session = ort.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+        else:
+            self.session = ort.InferenceSession(model_path, sess_options=sess_options)
+        logger.info("[ONNX session created] : {:.2f}ms, providers {}".format((time.time()-st_time)*1000, self.session.get_providers()))
+
+        self.inputs = self.session.get_inputs()
+        self.outputs = self.session.get_outputs()
+        self.io_binding = self.session.io_binding() if use_io_binding else None
+        # preallocated flat output buffers, grown on demand and viewed per batch
+        self.buffers = {}
+        self.num_batches = 0
+        self.run_time = 0.0
+        self.total_time = 0.0
+
+    def __feed(self, x):
+        # select model inputs as the exported graph expects
+        config = self.config
+        opt = config['opt']
+        inputs = self.inputs
+        if config['emb_class'] in ['glove', 'elmo']:
+            feed = [(inputs[0].name, x[0]), (inputs[1].name, x[1])]
+            if opt.use_char_cnn:
+                feed.append((inputs[2].name, x[2]))
+        else:
+            if config['emb_class'] in ['distilbert', 'bart']:
+                feed = [(inputs[0].name, x[0]), (inputs[1].name, x[1])]
+            else:
+                feed = [(inputs[0].name, x[0]), (inputs[1].name, x[1]), (inputs[2].name, x[2])]
+            if opt.bert_use_pos:
+                feed.append((inputs[3].name, x[3]))
+        return feed
+
+    def __output_buffer(self, output, shape, device):
+        np_type, torch_type = _ORT_TYPES[output.type]
+        numel = int(np.prod(shape))
+        buf = self.buffers.get(output.name)
+        if buf is None or buf.numel() < numel or buf.device != device:
+            buf = torch.empty(numel, dtype=torch_type, device=device)
+            self.buffers[output.name] = buf
+        return buf[:numel].view(*shape), np_type
+
+    def __bind(self, tensor, name, np_type, is_output=False):
+        device_type = 'cuda' if tensor.is_cuda else 'cpu'
+        device_id = tensor.device.index if tensor.device.index is not None else 0
+        if is_output:
+            self.io_binding.bind_output(name, device_type, device_id, np_type, list(tensor.shape), tensor.data_ptr())
+        else:
+            self.io_binding.bind_input(name, device_type, device_id, np_type, list(tensor.shape), tensor.data_ptr())
+
+    def run(self, x):
+        """Run a batch, return logits, prediction(None if the graph has no prediction output) as torch tensors.
+
+        with io binding, the returned tensors are views of the preallocated buffers,
+        they are valid until the next call of run().
+        """
+        st_time = time.perf_counter()
+        feed = self.__feed(x)
+        if self.use_io_binding:
+            self.io_binding.clear_binding_inputs()
+            self.io_binding.clear_binding_outputs()
+            # keep references of the bound inputs alive until the run is done
+            bound = [(name, tensor.contiguous()) for name, tensor in feed]
+            for name, tensor in bound:
+                self.__bind(tensor, name, _TORCH_TO_NUMPY[tensor.dtype])
+            batch_size, seq_size = feed[0][1].shape[0], feed[0][1].shape[1]
+            device = feed[0][1].device
+            rets = []
+            for output in self.outputs:
+                if output.name == 'logits': shape = (batch_size, seq_size, self.label_size)
+                else: shape = (batch_size, seq_size)
+                buf, np_type = self.__output_buffer(output, shape, device)
+                self.__bind(buf, output.name, np_type, is_output=True)
+                rets.append(buf)
+            run_st_time = time.perf_counter()
+            self.session.run_with_iobinding(self.io_binding)
+            self.run_time += time.perf_counter() - run_st_time
+        else:
+            device = feed[0][1].device
+            ort_inputs = dict((name, tensor.detach().cpu().numpy()) for name, tensor in feed)
+            run_st_time = time.perf_counter()
+            outs = self.session.run(None, ort_inputs)
+            self.run_time += time.perf_counter() - run_st_time
+            rets = [torch.tensor(out).to(device) for out in outs]
+        self.total_time += time.perf_counter() - st_time
+        self.num_batches += 1
+        logits = rets[0]
+        prediction = rets[1] if len(rets) > 1 else None
+        return logits, prediction
+
+    def overhead(self):
+        """Average time per batch(ms) spent outside of the session run, ex) input conversion, output copy.
+        """
+        n = max(1, self.num_batches)
+        return {'num_batches': self.num_batches,
+                'run_ms': self.run_time / n * 1000,
+                'overhead_ms': (self.total_time - self.run_time) / n * 1000}
@@ -0,0 +1,157 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import pdb
+import json
+import time
+import threading
+
+import torch
+
+# ---------------------------------------------------------------------------- #
+# Per-stage profiling
+#   usage)
+#     import util_profile
+#     with util_profile.stage('embedding'):
+#         ...
+#   when profiling is disabled(default), stage() returns a shared no-op context.
+# ---------------------------------------------------------------------------- #
+
+class _NullRegion():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_REGION = _NullRegion()
+
+class _Region():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        # also visible in the torch.autograd.profiler table(train.py --use_profiler)
+        self.record = torch.autograd.profiler.record_function(self.name)
+        self.record.__enter__()
+        if profiler.sync: torch.cuda.synchronize()
+        self.mem = torch.cuda.memory_allocated() if profiler.use_cuda else 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        profiler = self.profiler
+        if profiler.sync: torch.cuda.synchronize()
+        end = time.perf_counter()
+        mem = torch.cuda.memory_allocated() if profiler.use_cuda else 0
+        self.record.__exit__(*args)
+        profiler.add(self.name, self.start, end, mem - self.mem)
+        return False
+
+def _new_stat():
+    return {'count': 0, 'total_ms': 0.0, 'min_ms': float('inf'), 'max_ms': 0.0, 'total_mem': 0, 'max_mem': 0}
+
+class StageProfiler():
+    """Aggregate wall time and memory of named regions across batches.
+
+    Args:
+      use_cuda: if True, measure allocated cuda memory and synchronize at region boundaries.
+      max_events: max number of events kept for the chrome trace.
+    """
+
+    def __init__(self, use_cuda=False, max_events=100000):
+        self.use_cuda = use_cuda and torch.cuda.is_available()
+        self.sync = self.use_cuda
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.events = []
+
+    def region(self, name):
+        return _Region(self, name)
+
+    def add(self, name, start, end, mem):
+        elapsed = (end - start) * 1000
+        with self.lock:
+            st = self.stats.setdefault(name, _new_stat())
+            st['count'] += 1
+            st['total_ms'] += elapsed
+            st['min_ms'] = min(st['min_ms'], elapsed)
+            st['max_ms'] = max(st['max_ms'], elapsed)
+            st['total_mem'] += mem
+            st['max_mem'] = max(st['max_mem'], mem)
+            if len(self.events) < self.max_events:
+                self.events.append({'name': name, 'ph': 'X', 'cat': 'stage',
+                                    'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6,
+                                    'pid': os.getpid(), 'tid': threading.get_ident(),
+                                    'args': {'mem': mem}})
+
+    def merge(self, stats, events):
+        # merge stats, events from other profiler, ex) the ones collected in worker processes
+        with self.lock:
+            for name, other in stats.items():
+                st = self.stats.setdefault(name, _new_stat())
+                st['count'] += other['count']
+                st['total_ms'] += other['total_ms']
+                st['min_ms'] = min(st['min_ms'], other['min_ms'])
+                st['max_ms'] = max(st['max_ms'], other['max_ms'])
+                st['total_mem'] += other['total_mem']
+                st['max_mem'] = max(st['max_mem'], other['max_mem'])
+            self.events.extend(events[:max(0, self.max_events - len(self.events))])
+
+    def summary(self):
+        ret = {}
+        with self.lock:
+            for name, st in self.stats.items():
+                ret[name] = dict(st)
+                ret[name]['avg_ms'] = st['total_ms'] / max(1, st['count'])
+        return ret
+
+    def table(self):
+        summary = self.summary()
+        total = sum(st['total_ms'] for st in summary.values())
+        lines = ['{:<24} {:>8} {:>12} {:>10} {:>10} {:>10} {:>8} {:>14}'.\
+                 format('stage', 'count', 'total(ms)', 'avg(ms)', 'min(ms)', 'max(ms)', '%', 'max mem(B)')]
+        for name, st in sorted(summary.items(), key=lambda item: -item[1]['total_ms']):
+            lines.append('{:<24} {:>8d} {:>12.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>7.2f}% {:>14d}'.\
+                         format(name, st['count'], st['total_ms'], st['avg_ms'], st['min_ms'], st['max_ms'],
+                                st['total_ms'] / max(1e-6, total) * 100, st['max_mem']))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        with self.lock:
+            trace = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f)
+
+_profiler = None
+
+def enable(use_cuda=False, max_events=100000):
+    global _profiler
+    _profiler = StageProfiler(use_cuda=use_cuda, max_events=max_events)
+    return _profiler
+
+def disable():
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    return profiler
+
+def get_profiler():
+    return _profiler
+
+def set_profiler(profiler):
+    # restore a profiler returned by disable()
+    global _profiler
+    _profiler = profiler
+
+def stage(name):
+    if _profiler is None: return _NULL_REGION
+    return _profiler.region(name)